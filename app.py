@@ -1,6 +1,6 @@
 from fastapi import FastAPI, File, UploadFile, Form, Depends, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 import uvicorn
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any, Union, Tuple
@@ -13,13 +13,19 @@ import dotenv
 import datetime
 import random
 import hashlib
-import requests
+import functools
+import httpx
 import time
 import logging
-from PIL import Image
+import threading
+import sqlite3
+from image_processing import preprocess_image_bytes
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 # Updated OpenAI import style
-from openai import OpenAI
+from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
 import shutil
 import tempfile
@@ -63,9 +69,98 @@ NOTES_DATA_FILE = os.path.join(DATA_DIR, "notes_data.json")
 CHAT_HISTORY_FILE = os.path.join(DATA_DIR, "chat_history.json")
 SESSIONS_DATA_FILE = os.path.join(DATA_DIR, "sessions_data.json")
 
+# Backend lưu trữ cho family/events/notes/chat history: "json" (mặc định) hoặc "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").strip().lower()
+SQLITE_DB_FILE = os.environ.get("SQLITE_DB_FILE", os.path.join(DATA_DIR, "family_assistant.db"))
+
+# Chu kỳ (giây) ghi nền các session thay đổi; 0 = ghi đồng bộ sau mỗi thay đổi
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "2"))
+# Mỗi session một file trong SESSIONS_DIR; index metadata nhẹ cho /sessions
+SESSIONS_DIR = os.path.join(DATA_DIR, "sessions")
+SESSION_INDEX_FILE = os.path.join(DATA_DIR, "sessions_index.json")
+# Số session tối đa giữ trong bộ nhớ (LRU)
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "200"))
+
 # Thư mục lưu trữ tạm thời
 TEMP_DIR = os.path.join(DATA_DIR, "temp_files")
 os.makedirs(TEMP_DIR, exist_ok=True)
+TEMP_FILE_MAX_AGE = int(os.environ.get("TEMP_FILE_MAX_AGE", "3600")) # Giây; file tạm sót lại cũ hơn sẽ bị dọn khi khởi động
+
+# Upload file: giới hạn kích thước (413 nếu vượt) và số upload được xử lý đồng thời
+AUDIO_UPLOAD_MAX_BYTES = int(os.environ.get("AUDIO_UPLOAD_MAX_BYTES", str(25 * 1024 * 1024))) # Giới hạn của Whisper
+IMAGE_UPLOAD_MAX_BYTES = int(os.environ.get("IMAGE_UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_CONCURRENCY = int(os.environ.get("UPLOAD_MAX_CONCURRENCY", "8"))
+# Cache transcript theo SHA-256 của audio (client gửi lại cùng audio khi mạng chập chờn)
+TRANSCRIPTION_CACHE_SIZE = int(os.environ.get("TRANSCRIPTION_CACHE_SIZE", "1024"))
+TRANSCRIPTION_CACHE_TTL = int(os.environ.get("TRANSCRIPTION_CACHE_TTL", str(24 * 3600)))
+
+# Kích thước log (bytes) để kích hoạt compaction nền cho các file dữ liệu
+DATA_LOG_COMPACT_BYTES = int(os.environ.get("DATA_LOG_COMPACT_BYTES", str(4 * 1024 * 1024)))
+
+# HTTP client dùng chung cho API bên thứ ba (Tavily, OpenWeatherMap)
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "20")) # Kết nối keep-alive tối đa (pool theo host)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2")) # Số lần thử lại khi lỗi mạng / 429 / 5xx
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", "0.5")) # Giây, nhân đôi sau mỗi lần thử
+
+# Cache dữ liệu thời tiết dùng chung (giây)
+WEATHER_CURRENT_TTL = int(os.environ.get("WEATHER_CURRENT_TTL", "600"))
+WEATHER_FORECAST_TTL = int(os.environ.get("WEATHER_FORECAST_TTL", "3600"))
+WEATHER_CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", "512"))
+
+# Cache tìm kiếm nhiều tầng (giây): truy vấn -> kết quả, URL -> nội dung, truy vấn + URL -> tóm tắt
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "512"))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "1800"))
+SEARCH_NEWS_CACHE_TTL = int(os.environ.get("SEARCH_NEWS_CACHE_TTL", "600")) # Tin tức thay đổi nhanh hơn
+EXTRACT_CACHE_TTL = int(os.environ.get("EXTRACT_CACHE_TTL", "3600"))
+# Trích xuất từng URL song song trong hạn chót chung; nguồn xong trước hạn được giữ, nguồn chậm hơn bị bỏ qua
+EXTRACT_DEADLINE = float(os.environ.get("EXTRACT_DEADLINE", "8"))
+EXTRACT_MAX_CONCURRENCY = int(os.environ.get("EXTRACT_MAX_CONCURRENCY", "0")) # Số request trích xuất chạy cùng lúc mỗi lượt tìm kiếm; 0: không giới hạn
+EXTRACT_MAX_CHARS_PER_SOURCE = 4000
+SEARCH_CONTEXT_MAX_CHARS = 15000
+
+# Phân tích phong thủy theo tuần: cache theo khoảng ngày, tạo sẵn hằng ngày nếu có OPENAI_API_KEY
+FENG_SHUI_CACHE_FILE = os.path.join(DATA_DIR, "feng_shui_cache.json")
+
+# Text-to-speech: pool thread giới hạn, cache audio trong bộ nhớ (LRU theo dung lượng) và trên đĩa
+TTS_MAX_WORKERS = int(os.environ.get("TTS_MAX_WORKERS", "4"))
+TTS_MEMORY_CACHE_BYTES = int(os.environ.get("TTS_MEMORY_CACHE_BYTES", str(32 * 1024 * 1024)))
+TTS_DISK_CACHE_FILES = int(os.environ.get("TTS_DISK_CACHE_FILES", "2000"))
+TTS_DISK_PRUNE_INTERVAL = int(os.environ.get("TTS_DISK_PRUNE_INTERVAL", "600")) # Giây giữa các lần dọn TTS_AUDIO_DIR
+TTS_AUDIO_DIR = os.path.join(DATA_DIR, "tts_audio")
+# TTS theo câu trong /chat/stream: số ký tự tối thiểu của một đoạn audio
+TTS_STREAM_MIN_CHARS = int(os.environ.get("TTS_STREAM_MIN_CHARS", "40"))
+
+# Tóm tắt lịch sử chat chạy nền: tóm tắt lại sau N tin nhắn mới hoặc T giây không hoạt động
+CHAT_SUMMARY_EVERY_N = int(os.environ.get("CHAT_SUMMARY_EVERY_N", "6"))
+CHAT_SUMMARY_IDLE_SECONDS = float(os.environ.get("CHAT_SUMMARY_IDLE_SECONDS", "30"))
+CHAT_SUMMARY_SHUTDOWN_TIMEOUT = float(os.environ.get("CHAT_SUMMARY_SHUTDOWN_TIMEOUT", "10")) # Giây chờ tóm tắt nốt khi tắt server
+
+# Cửa sổ ngữ cảnh gửi cho OpenAI: ngân sách token (ước lượng offline), số lượt gần nhất giữ nguyên văn
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_RECENT_TURNS = int(os.environ.get("CONTEXT_RECENT_TURNS", "4"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.environ.get("CONTEXT_SUMMARY_MAX_TOKENS", "300"))
+CONTEXT_SUMMARY_CACHE_SIZE = int(os.environ.get("CONTEXT_SUMMARY_CACHE_SIZE", "1024"))
+
+# Ảnh/audio base64 trong tin nhắn được lưu một lần theo SHA-256; session và lịch sử chỉ giữ tham chiếu
+BLOB_DIR = os.path.join(DATA_DIR, "blobs")
+BLOB_INLINE_MAX_BYTES = int(os.environ.get("BLOB_INLINE_MAX_BYTES", "1024")) # Payload nhỏ hơn được giữ nguyên trong tin nhắn
+
+# Tiền xử lý ảnh trước khi gọi vision (process pool): thu nhỏ, bỏ EXIF, nén lại JPEG/WebP
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2")) # 0: xử lý trong thread thay vì process pool
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "2048")) # Cạnh dài tối đa
+IMAGE_MAX_SHORT_SIDE = int(os.environ.get("IMAGE_MAX_SHORT_SIDE", "768")) # OpenAI thu cạnh ngắn về 768px ở detail=high
+IMAGE_MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", str(2048 * 768)))
+IMAGE_OUTPUT_FORMAT = os.environ.get("IMAGE_OUTPUT_FORMAT", "JPEG").strip().upper() # JPEG hoặc WEBP
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+
+# Cache kết quả phân loại ý định (theo câu hỏi đã chuẩn hóa + ngày)
+INTENT_CACHE_SIZE = int(os.environ.get("INTENT_CACHE_SIZE", "2048"))
+INTENT_CACHE_TTL = int(os.environ.get("INTENT_CACHE_TTL", str(6 * 3600)))
+# Tầng đĩa giúp cache còn sau khi khởi động lại; INTENT_CACHE_PERSIST=0 để tắt
+INTENT_CACHE_FILE = os.path.join(DATA_DIR, "intent_cache.json") if os.environ.get("INTENT_CACHE_PERSIST", "1") != "0" else None
 
 # Danh sách domain tin tức Việt Nam
 VIETNAMESE_NEWS_DOMAINS = [
@@ -81,6 +176,461 @@ OPENWEATHERMAP_API_KEY = os.getenv("OPENWEATHERMAP_API_KEY")
 
 openai_model = "gpt-4o-mini" # Or your preferred model supporting Tool Calling
 
+# "chain": mỗi bộ phân loại một lời gọi riêng; "unified": một lời gọi phân loại gộp
+INTENT_ROUTER_MODE = os.environ.get("INTENT_ROUTER_MODE", "chain").strip().lower()
+INTENT_FAST_PATH = os.environ.get("INTENT_FAST_PATH", "1") != "0" # Phân loại bằng luật trước khi gọi LLM
+
+# Connection pool dùng chung cho mọi request tới OpenAI
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "50"))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "32")) # Số request OpenAI đồng thời tối đa
+OPENAI_CLIENT_CACHE_SIZE = int(os.environ.get("OPENAI_CLIENT_CACHE_SIZE", "64")) # Số API key được cache client
+
+try:
+    import h2  # noqa: F401 - cần cho HTTP/2 trong httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class OpenAIClientPool:
+    """
+    Cache AsyncOpenAI client theo API key. Mọi client dùng chung một httpx.AsyncClient
+    (keep-alive, HTTP/2 nếu có gói h2) và một semaphore giới hạn số request đồng thời.
+    """
+    def __init__(self, max_connections=OPENAI_MAX_CONNECTIONS, max_concurrency=OPENAI_MAX_CONCURRENCY,
+                 max_clients=OPENAI_CLIENT_CACHE_SIZE):
+        self.max_connections = max_connections
+        self.max_clients = max_clients
+        self.limit = asyncio.Semaphore(max_concurrency)
+        self._clients = OrderedDict()
+        self._http_client = None
+
+    def _get_http_client(self):
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections,
+                                    keepalive_expiry=60),
+                timeout=httpx.Timeout(120, connect=10),
+            )
+            logger.info(f"Đã tạo HTTP client dùng chung cho OpenAI (HTTP/2: {HTTP2_AVAILABLE})")
+        return self._http_client
+
+    def get_client(self, api_key) -> AsyncOpenAI:
+        client = self._clients.get(api_key)
+        if client is not None and self._http_client is not None and not self._http_client.is_closed:
+            self._clients.move_to_end(api_key)
+            return client
+        client = AsyncOpenAI(api_key=api_key, http_client=self._get_http_client())
+        self._clients[api_key] = client
+        # Client chỉ là lớp bọc nhẹ quanh HTTP client dùng chung, bỏ khỏi cache không cần đóng
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+        return client
+
+    async def aclose(self):
+        self._clients.clear()
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
+
+openai_pool = OpenAIClientPool()
+
+class LimitedStream:
+    """
+    Bọc AsyncStream của OpenAI để giữ slot semaphore cho tới khi stream được đọc hết,
+    gặp lỗi hoặc bị đóng (close / async with). Caller dừng đọc giữa chừng phải gọi close().
+    """
+    def __init__(self, stream, semaphore):
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self._semaphore = semaphore
+        self._released = False
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._semaphore.release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            # Hết stream (StopAsyncIteration), lỗi mạng hoặc bị huỷ: trả slot ngay
+            await self.close()
+            raise
+
+    async def close(self):
+        try:
+            await self._stream.close()
+        finally:
+            self._release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __del__(self):
+        # Lưới an toàn nếu caller quên close(): không để rò slot semaphore
+        self._release()
+
+
+async def create_chat_completion(api_key, **kwargs):
+    """
+    Gọi chat.completions.create (async) qua client dùng chung, có giới hạn đồng thời.
+    Với stream=True, slot được giữ tới khi LimitedStream trả về được đọc hết hoặc đóng.
+    """
+    client = openai_pool.get_client(api_key)
+    if not kwargs.get("stream"):
+        async with openai_pool.limit:
+            return await client.chat.completions.create(**kwargs)
+    await openai_pool.limit.acquire()
+    try:
+        stream = await client.chat.completions.create(**kwargs)
+    except BaseException:
+        openai_pool.limit.release()
+        raise
+    return LimitedStream(stream, openai_pool.limit)
+
+async def create_transcription(api_key, **kwargs):
+    """Gọi audio.transcriptions.create (async) qua client dùng chung, có giới hạn đồng thời."""
+    client = openai_pool.get_client(api_key)
+    async with openai_pool.limit:
+        return await client.audio.transcriptions.create(**kwargs)
+
+class ExternalHttpClient:
+    """
+    httpx.AsyncClient dùng chung suốt vòng đời ứng dụng cho các API bên thứ ba:
+    giữ kết nối keep-alive theo host và thử lại với backoff khi gặp lỗi tạm thời.
+    Mở trong startup hook, đóng trong shutdown hook (tự tạo lại nếu dùng ngoài vòng đời đó).
+    """
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_connections=HTTP_MAX_CONNECTIONS, max_keepalive=HTTP_MAX_KEEPALIVE,
+                 connect_timeout=HTTP_CONNECT_TIMEOUT, timeout=HTTP_TIMEOUT,
+                 retries=HTTP_RETRIES, backoff=HTTP_RETRY_BACKOFF):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=60)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=self.limits, timeout=self.timeout)
+            logger.info(f"Đã tạo HTTP client dùng chung cho API bên thứ ba (HTTP/2: {HTTP2_AVAILABLE})")
+        return self._client
+
+    async def start(self):
+        self._get_client()
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    async def request(self, method, url, timeout=None, **kwargs) -> httpx.Response:
+        """
+        Gửi request, thử lại tối đa `retries` lần khi lỗi mạng hoặc status 429/5xx.
+        Lần thử cuối trả về response (kể cả lỗi) hoặc raise lỗi httpx như bình thường.
+        """
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=min(self.connect_timeout, timeout))
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = await self._get_client().request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if last_attempt:
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                logger.warning(f"Lỗi kết nối tới {url} ({e.__class__.__name__}), thử lại sau {delay:.1f}s")
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES or last_attempt:
+                    return response
+                delay = self.backoff * (2 ** attempt)
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, min(float(retry_after), 10.0))
+                logger.warning(f"{url} trả về {response.status_code}, thử lại sau {delay:.1f}s")
+            runtime_metrics.incr("http.retries")
+            await asyncio.sleep(delay + random.uniform(0, self.backoff / 2))
+
+http_client = ExternalHttpClient()
+
+# --- Runtime Metrics ---
+class RuntimeMetrics:
+    """Bộ đếm và thống kê thời gian (ms) trong bộ nhớ của tiến trình, xem qua GET /metrics."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, elapsed_ms):
+        with self._lock:
+            stat = self.timings.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0})
+            stat["count"] += 1
+            stat["total_ms"] += elapsed_ms
+            stat["max_ms"] = max(stat["max_ms"], elapsed_ms)
+            stat["last_ms"] = elapsed_ms
+
+    def snapshot(self):
+        with self._lock:
+            # Tỷ lệ trúng cho mọi cặp bộ đếm "<tên>.hit" / "<tên>.miss"
+            rates = {}
+            for name, hits in self.counters.items():
+                if name.endswith(".hit"):
+                    prefix = name[:-len(".hit")]
+                    total = hits + self.counters.get(prefix + ".miss", 0)
+                    rates[prefix + ".hit_rate"] = round(hits / total, 3) if total else 0.0
+            timings = {
+                name: {
+                    "count": stat["count"],
+                    "avg_ms": round(stat["total_ms"] / stat["count"], 1),
+                    "max_ms": round(stat["max_ms"], 1),
+                    "last_ms": round(stat["last_ms"], 1),
+                }
+                for name, stat in self.timings.items()
+            }
+            return {"counters": dict(self.counters), "rates": rates, "timings": timings}
+
+runtime_metrics = RuntimeMetrics()
+
+class TTLCache:
+    """
+    Cache LRU + TTL trong bộ nhớ, an toàn với thread. Bộ đếm hit/miss ghi vào
+    runtime_metrics dưới tên "cache.<name>".
+
+    Nếu có persist_file, mỗi thay đổi được ghi thêm qua save_data(changed_keys) và
+    được nạp lại (bỏ mục hết hạn) ở lần truy cập đầu tiên sau khi khởi động.
+    Key phải là chuỗi, value phải serialize được JSON khi bật persist.
+    Giá trị trả về là chính object đã lưu: caller coi là chỉ đọc (hoặc tự sao chép).
+    """
+    _MISSING = object()
+
+    def __init__(self, name, max_size=1024, ttl_seconds=3600, persist_file=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persist_file = persist_file
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._loaded = persist_file is None
+
+    def _load(self):
+        now = time.time()
+        stored = load_data(self.persist_file)
+        entries = sorted(
+            ((key, item) for key, item in stored.items()
+             if isinstance(item, dict) and item.get("exp", 0) > now),
+            key=lambda pair: pair[1]["exp"]
+        )[-self.max_size:]
+        for key, item in entries:
+            self._entries[key] = (item["exp"], item.get("v"))
+        self._loaded = True
+        if len(entries) != len(stored):
+            save_data(self.persist_file, self._disk_view())
+        logger.info(f"Đã nạp {len(entries)} mục cho cache '{self.name}' từ {self.persist_file}")
+
+    def _disk_view(self):
+        return {key: {"exp": expires_at, "v": value} for key, (expires_at, value) in self._entries.items()}
+
+    def _persist(self, changed_keys):
+        # Chỉ dựng các key thay đổi (key không còn trong cache được ghi là xóa), không dựng lại toàn bộ cache
+        if self.persist_file and changed_keys:
+            changed = {key: {"exp": self._entries[key][0], "v": self._entries[key][1]}
+                       for key in changed_keys if key in self._entries}
+            save_data(self.persist_file, changed, changed_keys)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = self._entries.get(key, self._MISSING)
+            expired = entry is not self._MISSING and entry[0] <= time.time()
+            if entry is self._MISSING or expired:
+                if expired:
+                    del self._entries[key]
+                    self._persist([key])
+                runtime_metrics.incr(f"cache.{self.name}.miss")
+                return default
+            self._entries.move_to_end(key)
+        runtime_metrics.incr(f"cache.{self.name}.hit")
+        return entry[1]
+
+    def set(self, key, value, ttl_seconds=None):
+        expires_at = time.time() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            changed_keys = [key]
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                changed_keys.append(evicted_key)
+            self._persist(changed_keys)
+
+    def delete(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._persist([key])
+
+    def __len__(self):
+        return len(self._entries)
+
+class SingleFlight:
+    """Gộp các lời gọi đồng thời có cùng key thành một tác vụ duy nhất (chống dồn request khi cache miss)."""
+    def __init__(self, name):
+        self.name = name
+        self._inflight = {}
+
+    async def do(self, key, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._inflight.pop(key, None) if self._inflight.get(key) is done else None)
+        else:
+            runtime_metrics.incr(f"singleflight.{self.name}.shared")
+        # shield: một caller bị huỷ không làm huỷ tác vụ của các caller khác
+        return await asyncio.shield(task)
+
+def api_key_scope(api_key):
+    """Dấu vân tay ngắn của API key, dùng trong key single-flight để lỗi do key của một người dùng không lan sang người khác."""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+intent_cache = TTLCache("intent", max_size=INTENT_CACHE_SIZE, ttl_seconds=INTENT_CACHE_TTL,
+                        persist_file=INTENT_CACHE_FILE)
+
+def intent_cache_key(classifier, query):
+    """Key cache phân loại: tên bộ phân loại + ngày hiện tại + câu hỏi viết thường, gộp khoảng trắng."""
+    normalized = " ".join(query.lower().split())
+    return f"{classifier}|{datetime.date.today().isoformat()}|{normalized}"
+
+BLOB_REF_PREFIX = "blob:sha256:"
+DATA_URL_PATTERN = re.compile(r"^data:([\w.+-]+/[\w.+-]+);base64,(.*)$", re.DOTALL)
+BLOB_DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+MISSING_BLOB_PLACEHOLDER = "[Tệp đính kèm không còn được lưu trữ]"
+# Kiểu được /blob/{digest} trả inline; mọi kiểu khác trả dạng tải về application/octet-stream
+BLOB_SERVABLE_MIME_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp",
+    "audio/mpeg", "audio/wav", "audio/x-wav", "audio/webm", "audio/ogg", "audio/mp4", "audio/m4a", "audio/x-m4a",
+}
+
+class BlobStore:
+    """Kho nội dung định danh theo SHA-256 trên đĩa (BLOB_DIR/ab/abcdef...), ghi một lần, đọc nhiều lần."""
+    def __init__(self, base_dir=BLOB_DIR):
+        self.base_dir = base_dir
+
+    def _path(self, digest):
+        return os.path.join(self.base_dir, digest[:2], digest)
+
+    def put(self, data):
+        """Lưu bytes và trả về digest hex; nội dung trùng chỉ được ghi một lần."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if os.path.exists(path):
+            runtime_metrics.incr("blob.dedup")
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        runtime_metrics.incr("blob.stored")
+        return digest
+
+    def get(self, digest):
+        """Đọc blob theo digest; None nếu digest không hợp lệ hoặc không tồn tại."""
+        if not BLOB_DIGEST_PATTERN.match(digest or ""):
+            return None
+        try:
+            with open(self._path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+blob_store = BlobStore()
+
+def offload_content_blobs(content):
+    """Thay data URL ảnh / audio base64 trong content list bằng tham chiếu blob:sha256:<hex>."""
+    if not isinstance(content, list):
+        return content
+    result = []
+    for item in content:
+        if not isinstance(item, dict):
+            result.append(item)
+            continue
+        image_url = item.get("image_url")
+        if isinstance(image_url, dict) and len(image_url.get("url") or "") > BLOB_INLINE_MAX_BYTES:
+            match = DATA_URL_PATTERN.match(image_url["url"])
+            if match:
+                try:
+                    digest = blob_store.put(base64.b64decode(match.group(2)))
+                    item = {**item, "image_url": {**image_url, "url": BLOB_REF_PREFIX + digest, "mime_type": match.group(1)}}
+                except (ValueError, OSError) as e:
+                    logger.warning(f"Không thể lưu ảnh vào blob store, giữ nguyên data URL: {e}")
+        audio_data = item.get("audio_data")
+        if isinstance(audio_data, str) and len(audio_data) > BLOB_INLINE_MAX_BYTES and not audio_data.startswith(BLOB_REF_PREFIX):
+            try:
+                item = {**item, "audio_data": BLOB_REF_PREFIX + blob_store.put(base64.b64decode(audio_data))}
+            except (ValueError, OSError) as e:
+                logger.warning(f"Không thể lưu audio vào blob store, giữ nguyên base64: {e}")
+        result.append(item)
+    return result
+
+def offload_message_blobs(messages):
+    """Áp dụng offload_content_blobs cho danh sách tin nhắn (trả về list mới)."""
+    return [{**msg, "content": offload_content_blobs(msg["content"])} if isinstance(msg.get("content"), list) else msg
+            for msg in messages]
+
+def resolve_message_blobs(messages):
+    """Khôi phục data URL / base64 từ tham chiếu blob ngay trước khi gửi request tới OpenAI."""
+    resolved_messages = []
+    for msg in messages:
+        content = msg.get("content")
+        if not isinstance(content, list) or not any(
+                isinstance(item, dict) and (str((item.get("image_url") or {}).get("url", "")).startswith(BLOB_REF_PREFIX)
+                                            or str(item.get("audio_data") or "").startswith(BLOB_REF_PREFIX))
+                for item in content):
+            resolved_messages.append(msg)
+            continue
+        resolved_content = []
+        for item in content:
+            image_url = item.get("image_url") if isinstance(item, dict) else None
+            if isinstance(image_url, dict) and str(image_url.get("url", "")).startswith(BLOB_REF_PREFIX):
+                data = blob_store.get(image_url["url"][len(BLOB_REF_PREFIX):])
+                if data is None:
+                    logger.warning(f"Không tìm thấy blob {image_url['url']}")
+                    resolved_content.append({"type": "text", "text": MISSING_BLOB_PLACEHOLDER})
+                    continue
+                resolved_image_url = {k: v for k, v in image_url.items() if k != "mime_type"}
+                resolved_image_url["url"] = f"data:{image_url.get('mime_type', 'image/jpeg')};base64,{base64.b64encode(data).decode('ascii')}"
+                item = {**item, "image_url": resolved_image_url}
+            elif isinstance(item, dict) and str(item.get("audio_data") or "").startswith(BLOB_REF_PREFIX):
+                data = blob_store.get(item["audio_data"][len(BLOB_REF_PREFIX):])
+                if data is None:
+                    logger.warning(f"Không tìm thấy blob {item['audio_data']}")
+                    resolved_content.append({"type": "text", "text": MISSING_BLOB_PLACEHOLDER})
+                    continue
+                item = {**item, "audio_data": base64.b64encode(data).decode("ascii")}
+            resolved_content.append(item)
+        resolved_messages.append({**msg, "content": resolved_content})
+    return resolved_messages
+
 # ------- Date/Time Helper Functions (Moved from WeatherService) --------
 VIETNAMESE_WEEKDAY_MAP = {
     "thứ 2": 0, "thứ hai": 0, "t2": 0,
@@ -327,49 +877,243 @@ def generate_recurring_cron(description, title, time_str="19:00"):
 # ------- Classes & Models -------------
 
 class SessionManager:
-    """Quản lý session và trạng thái cho mỗi client với khả năng lưu trạng thái"""
-    def __init__(self, sessions_file=SESSIONS_DATA_FILE): # Use constant
-        self.sessions = {}
-        self.sessions_file = sessions_file
-        self._load_sessions()
-
-    def _load_sessions(self):
-        """Tải dữ liệu session từ file"""
+    """
+    Quản lý session và trạng thái cho mỗi client với khả năng lưu trạng thái.
+
+    Mỗi session được lưu thành một file riêng trong sessions_dir và chỉ được tải khi
+    truy cập lần đầu. Các session trong bộ nhớ được giữ theo LRU (tối đa cache_size);
+    session ít dùng nhất bị đẩy ra sau khi đã được ghi. Session đang được một request giữ
+    (pin/unpin) không bị đẩy ra, để các thay đổi sau đó của request không bị mất. Metadata nhẹ (thời gian, member,
+    số tin nhắn) được giữ trong index_file để liệt kê mà không cần đọc nội dung tin nhắn.
+
+    Chế độ write-behind (flush_interval > 0): các session thay đổi chỉ được đánh dấu
+    "dirty" và một asyncio task nền ghi chúng sau mỗi khoảng flush_interval giây
+    (hoặc khi tắt server). Nhiều lần cập nhật trong cùng khoảng được gộp thành
+    một lần ghi. flush_interval <= 0 giữ hành vi ghi đồng bộ.
+    """
+    def __init__(self, sessions_dir=SESSIONS_DIR, index_file=SESSION_INDEX_FILE,
+                 flush_interval=SESSION_FLUSH_INTERVAL, cache_size=SESSION_CACHE_SIZE,
+                 legacy_sessions_file=SESSIONS_DATA_FILE):
+        self.sessions = OrderedDict() # LRU: session_id -> session data (chỉ các session đang nạp)
+        self.sessions_dir = sessions_dir
+        self.index_file = index_file
+        self.flush_interval = flush_interval
+        self.cache_size = max(1, cache_size)
+        self.legacy_sessions_file = legacy_sessions_file
+        self._dirty = set()
+        self._pins = {} # session_id -> số request đang giữ session
+        self._flush_task = None
+        os.makedirs(self.sessions_dir, exist_ok=True)
+        self.index = load_data(self.index_file)
+        logger.info(f"Đã tải index của {len(self.index)} session từ {self.index_file}")
+
+    # --- Lưu trữ từng session ---
+    def _session_path(self, session_id):
+        """Đường dẫn file của session; ID không an toàn cho tên file được băm."""
+        if re.fullmatch(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}", session_id):
+            file_name = session_id
+        else:
+            file_name = "sha256-" + hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.sessions_dir, file_name + ".json")
+
+    def _read_session_file(self, session_id):
+        path = self._session_path(session_id)
+        if not os.path.exists(path):
+            return None
         try:
-            if os.path.exists(self.sessions_file):
-                with open(self.sessions_file, "r", encoding="utf-8") as f:
-                    loaded_sessions = json.load(f)
-                    if isinstance(loaded_sessions, dict):
-                        self.sessions = loaded_sessions
-                        logger.info(f"Đã tải {len(self.sessions)} session từ {self.sessions_file}")
-                    else:
-                        logger.warning(f"Dữ liệu session trong {self.sessions_file} không hợp lệ (không phải dict), khởi tạo lại.")
-                        self.sessions = {} # Reset if invalid structure
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
+            logger.warning(f"Dữ liệu session trong {path} không hợp lệ (không phải dict), khởi tạo lại.")
         except json.JSONDecodeError as e:
-            logger.error(f"Lỗi JSON khi tải session từ {self.sessions_file}: {e}. Khởi tạo lại.")
-            self.sessions = {} # Reset on JSON error
+            logger.error(f"Lỗi JSON khi tải session từ {path}: {e}. Khởi tạo lại.")
         except Exception as e:
-            logger.error(f"Lỗi không xác định khi tải session: {e}", exc_info=True)
-            self.sessions = {} # Reset on other errors
+            logger.error(f"Lỗi không xác định khi tải session {session_id}: {e}", exc_info=True)
+        return None
+
+    def _write_session_file(self, session_id, session_data):
+        path = self._session_path(session_id)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(session_data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
 
+    @staticmethod
+    def _build_metadata(session_data):
+        return {
+            "created_at": session_data.get("created_at"),
+            "last_updated": session_data.get("last_updated"),
+            "member_id": session_data.get("current_member"),
+            "message_count": len(session_data.get("messages") or []),
+        }
+
+    def migrate_legacy_sessions(self):
+        """
+        Tách file sessions_data.json cũ (mọi session trong một file) thành các file riêng.
+        Gọi trong startup hook; chạy một lần (đánh dấu bằng file trong sessions_dir) và không
+        sửa/đổi tên file cũ.
+        """
+        legacy_sessions_file = self.legacy_sessions_file
+        marker_path = os.path.join(self.sessions_dir, ".legacy_migrated")
+        if not legacy_sessions_file or not os.path.exists(legacy_sessions_file) or os.path.exists(marker_path):
+            return
+        legacy_sessions = load_data(legacy_sessions_file)
+        migrated = 0
+        for session_id, session_data in legacy_sessions.items():
+            if session_id in self.index or not isinstance(session_data, dict):
+                continue
+            self._write_session_file(session_id, session_data)
+            self.index[session_id] = self._build_metadata(session_data)
+            migrated += 1
+        save_data(self.index_file, self.index)
+        with open(marker_path, "w", encoding="utf-8") as f:
+            f.write(datetime.datetime.now().isoformat())
+        logger.info(f"Đã tách {migrated} session từ {legacy_sessions_file} thành file riêng trong {self.sessions_dir}")
+
+    # --- LRU ---
+    def _admit(self, session_id, session_data):
+        self.sessions[session_id] = session_data
+        self.sessions.move_to_end(session_id)
+        self._evict_if_needed()
+
+    def _evict_if_needed(self):
+        # Duyệt từ cũ nhất; bỏ qua session đang được pin và session vừa dùng gần nhất
+        # (bộ nhớ có thể tạm vượt cache_size)
+        for session_id in list(self.sessions)[:-1]:
+            if len(self.sessions) <= self.cache_size:
+                return
+            if self._pins.get(session_id):
+                continue
+            session_data = self.sessions[session_id]
+            if session_id in self._dirty:
+                try:
+                    self._write_session_file(session_id, session_data)
+                    self._dirty.discard(session_id)
+                    save_data(self.index_file, self.index, [session_id])
+                except Exception as e:
+                    logger.error(f"Không thể ghi session {session_id} trước khi đẩy khỏi bộ nhớ: {e}", exc_info=True)
+                    continue
+            del self.sessions[session_id]
+            logger.debug(f"Đã đẩy session {session_id} khỏi bộ nhớ (LRU)")
+
+    def pin(self, session_id):
+        """Giữ session trong bộ nhớ trong suốt một request (không bị LRU đẩy ra)."""
+        self._pins[session_id] = self._pins.get(session_id, 0) + 1
+
+    def unpin(self, session_id):
+        count = self._pins.get(session_id, 0) - 1
+        if count > 0:
+            self._pins[session_id] = count
+        else:
+            self._pins.pop(session_id, None)
+            self._evict_if_needed()
+
+    def _get_loaded(self, session_id):
+        """Lấy session từ bộ nhớ hoặc tải lười từ file; None nếu không tồn tại."""
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+        if session_id not in self.index:
+            return None
+        session_data = self._read_session_file(session_id)
+        if session_data is None:
+            logger.warning(f"Không đọc được file của session {session_id}, khởi tạo lại.")
+            return None
+        self._admit(session_id, session_data)
+        return session_data
 
+    # --- Ghi ---
     def _save_sessions(self):
-        """Lưu dữ liệu session vào file"""
-        try:
-            os.makedirs(os.path.dirname(self.sessions_file) or '.', exist_ok=True)
-            with open(self.sessions_file, "w", encoding="utf-8") as f:
-                json.dump(self.sessions, f, ensure_ascii=False, indent=2)
-            logger.debug(f"Đã lưu {len(self.sessions)} session vào {self.sessions_file}") # Reduced log level
+        """Ghi toàn bộ session dirty và snapshot index (dùng khi tắt server)"""
+        flushed = self.flush()
+        if save_data(self.index_file, self.index):
+            logger.debug(f"Đã lưu index {len(self.index)} session vào {self.index_file}") # Reduced log level
+            return flushed
+        logger.error("Lỗi khi lưu index session.")
+        return False
+
+    def flush(self):
+        """Ghi các session dirty (đã gộp) và cập nhật index. Trả về False nếu có lỗi."""
+        if not self._dirty:
             return True
-        except Exception as e:
-            logger.error(f"Lỗi khi lưu session: {e}", exc_info=True)
+        dirty_ids = list(self._dirty)
+        self._dirty.clear()
+        failed = []
+        for session_id in dirty_ids:
+            try:
+                if session_id in self.sessions:
+                    self._write_session_file(session_id, self.sessions[session_id])
+                elif session_id not in self.index:
+                    path = self._session_path(session_id)
+                    if os.path.exists(path):
+                        os.remove(path)
+            except Exception as e:
+                logger.error(f"Lỗi khi ghi session {session_id}: {e}", exc_info=True)
+                failed.append(session_id)
+        if not save_data(self.index_file, self.index, dirty_ids):
+            failed = dirty_ids
+        if failed:
+            logger.error(f"Flush {len(failed)} session thất bại, sẽ thử lại ở lần flush sau.")
+            self._dirty.update(failed)
             return False
+        logger.debug(f"Đã flush {len(dirty_ids)} session vào {self.sessions_dir}")
+        return True
+
+    def _mark_dirty(self, session_id):
+        """Đánh dấu session cần lưu (cập nhật metadata ngay); ghi ngay nếu không dùng write-behind."""
+        if session_id in self.sessions:
+            self.index[session_id] = self._build_metadata(self.sessions[session_id])
+        else:
+            self.index.pop(session_id, None)
+        self._dirty.add(session_id)
+        if self.flush_interval <= 0:
+            return self.flush()
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self.start_background_flush()
+            except RuntimeError:
+                # Không có event loop đang chạy (ví dụ script đồng bộ): ghi ngay
+                return self.flush()
+        return True
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Lỗi trong vòng lặp flush session: {e}", exc_info=True)
+
+    def start_background_flush(self):
+        """Khởi động task flush nền trên event loop hiện tại (raise RuntimeError nếu không có loop)."""
+        if self.flush_interval <= 0 or (self._flush_task and not self._flush_task.done()):
+            return
+        self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+        logger.info(f"Đã bật write-behind cho session (flush mỗi {self.flush_interval}s)")
+
+    async def stop_background_flush(self):
+        """Dừng task flush nền và ghi nốt các session dirty."""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        self._flush_task = None
+        self.flush()
+
+    # --- API công khai ---
+    def list_metadata(self):
+        """Metadata của mọi session (không đọc nội dung tin nhắn)."""
+        return {session_id: dict(meta) for session_id, meta in self.index.items()}
 
     def get_session(self, session_id):
         """Lấy session hoặc tạo mới nếu chưa tồn tại"""
-        if session_id not in self.sessions:
+        session_data = self._get_loaded(session_id)
+        if session_data is None:
             logger.info(f"Tạo session mới: {session_id}")
-            self.sessions[session_id] = {
+            session_data = {
                 "messages": [],
                 "current_member": None,
                 "suggested_question": None,
@@ -378,17 +1122,18 @@ class SessionManager:
                 "created_at": datetime.datetime.now().isoformat(),
                 "last_updated": datetime.datetime.now().isoformat()
             }
-            self._save_sessions() # Save immediately after creation
-        return self.sessions[session_id]
+            self._admit(session_id, session_data)
+            self._mark_dirty(session_id)
+        return session_data
 
     def update_session(self, session_id, data):
         """Cập nhật dữ liệu session"""
-        if session_id in self.sessions:
+        session_data = self._get_loaded(session_id)
+        if session_data is not None:
             try:
-                self.sessions[session_id].update(data)
-                self.sessions[session_id]["last_updated"] = datetime.datetime.now().isoformat()
-                # Consider saving less often if performance is an issue.
-                if not self._save_sessions():
+                session_data.update(data)
+                session_data["last_updated"] = datetime.datetime.now().isoformat()
+                if not self._mark_dirty(session_id):
                      logger.error(f"Cập nhật session {session_id} thành công trong bộ nhớ nhưng LƯU THẤT BẠI.")
                 return True
             except Exception as e:
@@ -400,21 +1145,20 @@ class SessionManager:
 
     def delete_session(self, session_id):
         """Xóa session"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
-            self._save_sessions()
+        if session_id in self.index or session_id in self.sessions:
+            self.sessions.pop(session_id, None)
+            self._mark_dirty(session_id)
             logger.info(f"Đã xóa session: {session_id}")
             return True
         return False
 
     def cleanup_old_sessions(self, days_threshold=30):
-        """Xóa các session cũ không hoạt động sau số ngày nhất định"""
+        """Xóa các session cũ không hoạt động sau số ngày nhất định (dựa trên index)"""
         now = datetime.datetime.now(datetime.timezone.utc) # Use timezone-aware datetime
         sessions_to_remove = []
-        removed_count = 0
 
-        for session_id, session_data in list(self.sessions.items()): # Iterate over a copy
-            last_updated_str = session_data.get("last_updated")
+        for session_id, meta in list(self.index.items()): # Iterate over a copy
+            last_updated_str = meta.get("last_updated")
             if last_updated_str:
                 try:
                     last_updated_date = datetime.datetime.fromisoformat(last_updated_str)
@@ -432,14 +1176,11 @@ class SessionManager:
 
         if sessions_to_remove:
              for session_id in sessions_to_remove:
-                 if session_id in self.sessions:
-                     del self.sessions[session_id]
-                     removed_count += 1
-             if removed_count > 0:
-                 self._save_sessions()
-                 logger.info(f"Đã xóa {removed_count} session cũ (quá {days_threshold} ngày không hoạt động).")
-             else:
-                  logger.info("Không có session cũ nào cần xóa.")
+                 self.sessions.pop(session_id, None)
+                 self.index.pop(session_id, None)
+                 self._dirty.add(session_id)
+             self.flush()
+             logger.info(f"Đã xóa {len(sessions_to_remove)} session cũ (quá {days_threshold} ngày không hoạt động).")
         else:
             logger.info("Không có session cũ nào cần xóa.")
 
@@ -557,36 +1298,514 @@ available_tools = [
 
 
 # ------- Load/Save Data & Verification --------
-def load_data(file_path):
-    if os.path.exists(file_path):
+class JsonLogStore:
+    """
+    Lưu trữ dict JSON dạng snapshot + write-ahead log (append-only).
+
+    Mỗi thay đổi theo key được ghi thêm một dòng vào `<file>.log` (O(record)).
+    Với key có giá trị là list (vd. lịch sử chat của một thành viên), push/patch
+    chỉ ghi phần tử mới/các trường thay đổi thay vì cả list. Khi tải, snapshot
+    được đọc rồi replay log. Khi log vượt ngưỡng, một thread nền gộp snapshot +
+    log thành snapshot mới (compaction).
+    """
+    def __init__(self, compact_threshold_bytes=DATA_LOG_COMPACT_BYTES):
+        self.compact_threshold_bytes = compact_threshold_bytes
+        self._locks = {}
+        self._generations = {}
+        self._compacting = set()
+        self._guard = threading.Lock()
+
+    @staticmethod
+    def _log_path(file_path):
+        return file_path + ".log"
+
+    @staticmethod
+    def _compacting_path(file_path):
+        return file_path + ".log.compacting"
+
+    def _lock_for(self, file_path):
+        with self._guard:
+            if file_path not in self._locks:
+                self._locks[file_path] = threading.Lock()
+            return self._locks[file_path]
+
+    @staticmethod
+    def _read_snapshot(file_path, strict=False):
+        """Đọc snapshot. strict=True sẽ raise thay vì trả về dict rỗng khi file hỏng."""
+        if not os.path.exists(file_path):
+            return {}
         try:
             with open(file_path, "r", encoding="utf-8") as f:
                 data = json.load(f)
-                if not isinstance(data, dict):
-                     logger.warning(f"Dữ liệu trong {file_path} không phải từ điển. Khởi tạo lại.")
-                     return {}
-                return data
         except json.JSONDecodeError as e:
+            if strict:
+                raise
             logger.error(f"Lỗi JSON khi đọc {file_path}: {e}. Trả về dữ liệu trống.")
             return {}
-        except Exception as e:
-            logger.error(f"Lỗi không xác định khi đọc {file_path}: {e}", exc_info=True)
+        if not isinstance(data, dict):
+            if strict:
+                raise ValueError(f"Dữ liệu trong {file_path} không phải từ điển.")
+            logger.warning(f"Dữ liệu trong {file_path} không phải từ điển. Khởi tạo lại.")
             return {}
-    return {}
+        return data
+
+    @staticmethod
+    def _replay(log_path, data):
+        """Áp dụng các bản ghi trong log lên data. Cắt bỏ dòng cuối bị ghi dở (crash)."""
+        if not os.path.exists(log_path):
+            return 0
+        applied = 0
+        good_end = 0
+        with open(log_path, "rb") as f:
+            for line_no, raw in enumerate(f, 1):
+                if not raw.endswith(b"\n"):
+                    logger.warning(f"Dòng cuối của {log_path} bị ghi dở, bỏ qua.")
+                    break
+                good_end += len(raw)
+                line = raw.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    logger.warning(f"Bỏ qua bản ghi log hỏng tại {log_path}:{line_no}")
+                    continue
+                op, key = entry.get("op"), entry.get("key")
+                if op == "set":
+                    data[key] = entry.get("value")
+                elif op == "del":
+                    data.pop(key, None)
+                elif op == "push":
+                    items = data.get(key)
+                    if not isinstance(items, list):
+                        items = data[key] = []
+                    items.insert(0, entry.get("value"))
+                    if entry.get("limit"):
+                        del items[entry["limit"]:]
+                elif op == "patch":
+                    items = data.get(key)
+                    session_id = entry.get("session_id")
+                    if isinstance(items, list):
+                        target = next((item for item in items
+                                       if isinstance(item, dict) and item.get("session_id") == session_id), None)
+                        if target is not None:
+                            target.update(entry.get("value") or {})
+                else:
+                    logger.warning(f"Thao tác log không xác định '{op}' tại {log_path}:{line_no}")
+                    continue
+                applied += 1
+        if os.path.getsize(log_path) > good_end:
+            with open(log_path, "r+b") as f:
+                f.truncate(good_end)
+        return applied
+
+    def load(self, file_path):
+        """Tải snapshot và replay log (kể cả log đang compaction dở)."""
+        with self._lock_for(file_path):
+            data = self._read_snapshot(file_path)
+            replayed = self._replay(self._compacting_path(file_path), data)
+            replayed += self._replay(self._log_path(file_path), data)
+        if replayed:
+            logger.info(f"Đã replay {replayed} bản ghi log cho {file_path}")
+        return data
+
+    @staticmethod
+    def _write_json_atomic(file_path, data, temp_suffix):
+        temp_file_path = file_path + temp_suffix
+        try:
+            with open(temp_file_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+            os.replace(temp_file_path, file_path)
+        except Exception:
+            if os.path.exists(temp_file_path):
+                try: os.remove(temp_file_path)
+                except OSError as rm_err: logger.error(f"Không thể xóa file tạm {temp_file_path}: {rm_err}")
+            raise
+
+    def write_snapshot(self, file_path, data):
+        """Ghi lại toàn bộ dict (O(dataset)) và xóa log vì snapshot đã bao hàm."""
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        with self._lock_for(file_path):
+            self._write_json_atomic(file_path, data, ".tmp")
+            self._generations[file_path] = self._generations.get(file_path, 0) + 1
+            for path in (self._log_path(file_path), self._compacting_path(file_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def append(self, file_path, data, changed_keys):
+        """Ghi thêm thay đổi của các key vào log. Key không còn trong data được ghi là xóa."""
+        entries = []
+        for key in changed_keys:
+            if key in data:
+                entries.append({"op": "set", "key": key, "value": data[key]})
+            else:
+                entries.append({"op": "del", "key": key})
+        self._append_entries(file_path, entries)
 
-def save_data(file_path, data):
-    try:
+    def push(self, file_path, key, value, limit=None):
+        """Ghi log thêm value vào đầu list của key (giữ tối đa limit phần tử) mà không ghi lại cả list."""
+        self._append_entries(file_path, [{"op": "push", "key": key, "value": value, "limit": limit}])
+
+    def patch(self, file_path, key, session_id, fields):
+        """Ghi log cập nhật các trường của phần tử mới nhất có session_id trong list của key."""
+        self._append_entries(file_path, [{"op": "patch", "key": key, "session_id": session_id, "value": fields}])
+
+    def _append_entries(self, file_path, entries):
+        lines = [json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries]
+        if not lines:
+            return
         os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
-        temp_file_path = file_path + ".tmp"
-        with open(temp_file_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        shutil.move(temp_file_path, file_path)
+        log_path = self._log_path(file_path)
+        with self._lock_for(file_path):
+            with open(log_path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+                log_size = f.tell()
+        if log_size >= self.compact_threshold_bytes:
+            self._schedule_compaction(file_path)
+
+    def _schedule_compaction(self, file_path):
+        with self._guard:
+            if file_path in self._compacting:
+                return
+            self._compacting.add(file_path)
+        threading.Thread(target=self._compact, args=(file_path,),
+                         name=f"compact-{os.path.basename(file_path)}", daemon=True).start()
+
+    def _compact(self, file_path):
+        """Gộp snapshot + log thành snapshot mới. Chạy trong thread nền."""
+        log_path = self._log_path(file_path)
+        compacting_path = self._compacting_path(file_path)
+        lock = self._lock_for(file_path)
+        try:
+            with lock:
+                generation = self._generations.get(file_path, 0)
+                # Nếu còn file compacting từ lần trước (crash), gộp nó trước, giữ nguyên log hiện tại
+                if not os.path.exists(compacting_path):
+                    if not os.path.exists(log_path):
+                        return
+                    os.replace(log_path, compacting_path)
+
+            data = self._read_snapshot(file_path, strict=True)
+            replayed = self._replay(compacting_path, data)
+            temp_file_path = file_path + ".compact.tmp"
+            with open(temp_file_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+
+            with lock:
+                if self._generations.get(file_path, 0) != generation:
+                    # Snapshot đầy đủ đã được ghi trong lúc compaction, kết quả này đã cũ
+                    logger.info(f"Bỏ kết quả compaction cũ cho {file_path}.")
+                    os.remove(temp_file_path)
+                    return
+                os.replace(temp_file_path, file_path)
+                if os.path.exists(compacting_path):
+                    os.remove(compacting_path)
+            logger.info(f"Đã compaction {replayed} bản ghi log vào {file_path}")
+        except Exception as e:
+            logger.error(f"Lỗi khi compaction {file_path}: {e}", exc_info=True)
+        finally:
+            with self._guard:
+                self._compacting.discard(file_path)
+
+class SqliteDataStore:
+    """
+    Lưu family/events/notes/chat history trong SQLite (WAL mode) để nhiều worker
+    dùng chung một bộ dữ liệu và lọc bằng index thay vì quét toàn bộ bản ghi.
+    """
+    RECORD_TABLES = ("family_members", "events", "notes")
+
+    def __init__(self, db_path=SQLITE_DB_FILE):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=30000")
+        self._create_schema()
+        self._data_version = self._current_data_version()
+        self._table_versions = self._read_table_versions()
+
+    def _create_schema(self):
+        with self._lock, self._conn:
+            for table in self.RECORD_TABLES:
+                self._conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        id TEXT PRIMARY KEY,
+                        data TEXT NOT NULL,
+                        created_by TEXT,
+                        date TEXT,
+                        category TEXT
+                    )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_events_created_by ON events(created_by)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_events_date ON events(date)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_events_category ON events(category)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_notes_created_by ON notes(created_by)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_history (
+                    member_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    session_id TEXT,
+                    timestamp TEXT,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (member_id, position)
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_session_id ON chat_history(session_id)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # Bộ đếm phiên bản theo bảng: worker khác chỉ tải lại bảng thực sự thay đổi
+            self._conn.execute("CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def _current_data_version(self):
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _read_table_versions(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT name, version FROM table_versions").fetchall())
+
+    def changed_tables(self):
+        """
+        Các bảng mà kết nối khác (worker khác) đã ghi kể từ lần kiểm tra trước.
+        PRAGMA data_version (rất rẻ) được kiểm tra trước; chỉ khi nó đổi mới đọc bảng table_versions.
+        """
+        version = self._current_data_version()
+        if version == self._data_version:
+            return set()
+        self._data_version = version
+        versions = self._read_table_versions()
+        with self._lock:
+            changed = {name for name, table_version in versions.items() if self._table_versions.get(name) != table_version}
+            self._table_versions.update(versions)
+        return changed
+
+    # --- Đọc/ghi theo collection ---
+    def load(self, table):
+        with self._lock:
+            if table == "chat_history":
+                rows = self._conn.execute(
+                    "SELECT member_id, data FROM chat_history ORDER BY member_id, position"
+                ).fetchall()
+                data = {}
+                for member_id, entry in rows:
+                    data.setdefault(member_id, []).append(json.loads(entry))
+                return data
+            rows = self._conn.execute(f"SELECT id, data FROM {table}").fetchall()
+            return {record_id: json.loads(record) for record_id, record in rows}
+
+    def _write_record(self, table, key, value):
+        if table == "chat_history":
+            self._conn.execute("DELETE FROM chat_history WHERE member_id = ?", (key,))
+            self._conn.executemany(
+                "INSERT INTO chat_history (member_id, position, session_id, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                [(key, position, entry.get("session_id"), entry.get("timestamp"), json.dumps(entry, ensure_ascii=False))
+                 for position, entry in enumerate(value or []) if isinstance(entry, dict)]
+            )
+            return
+        record = value if isinstance(value, dict) else {}
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO {table} (id, data, created_by, date, category) VALUES (?, ?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), record.get("created_by"), record.get("date"), record.get("category"))
+        )
+
+    def _delete_record(self, table, key):
+        if table == "chat_history":
+            self._conn.execute("DELETE FROM chat_history WHERE member_id = ?", (key,))
+        else:
+            self._conn.execute(f"DELETE FROM {table} WHERE id = ?", (key,))
+
+    def _bump_table_version(self, table):
+        """Tăng phiên bản của bảng (gọi trong transaction ghi)."""
+        self._conn.execute(
+            "INSERT INTO table_versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1", (table,)
+        )
+        new_version = self._conn.execute("SELECT version FROM table_versions WHERE name = ?", (table,)).fetchone()[0]
+        # Chỉ coi là "đã thấy" khi không có ghi nào của worker khác xen giữa; nếu có, lần kiểm tra sau sẽ tải lại bảng
+        if new_version == self._table_versions.get(table, 0) + 1:
+            self._table_versions[table] = new_version
+
+    def save(self, table, data, changed_keys=None):
+        """Ghi các key thay đổi trong một transaction; changed_keys=None thay thế toàn bộ bảng."""
+        with self._lock, self._conn:
+            if changed_keys is None:
+                self._conn.execute(f"DELETE FROM {table}")
+                changed_keys = list(data.keys())
+            for key in changed_keys:
+                if key in data:
+                    self._write_record(table, key, data[key])
+                else:
+                    self._delete_record(table, key)
+            self._bump_table_version(table)
+
+    def push(self, table, key, value, limit=None):
+        """
+        Thêm một bản lịch sử chat vào đầu danh sách của member (chỉ hỗ trợ bảng chat_history).
+        position nhỏ hơn = mới hơn, nên bản mới nhận position nhỏ nhất hiện có - 1 thay vì đánh số lại cả danh sách.
+        """
+        if table != "chat_history":
+            raise ValueError(f"push không hỗ trợ bảng {table}")
+        with self._lock, self._conn:
+            (first_position,) = self._conn.execute(
+                "SELECT MIN(position) FROM chat_history WHERE member_id = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT INTO chat_history (member_id, position, session_id, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                (key, (first_position if first_position is not None else 1) - 1, value.get("session_id"),
+                 value.get("timestamp"), json.dumps(value, ensure_ascii=False))
+            )
+            if limit:
+                self._conn.execute(
+                    """DELETE FROM chat_history WHERE member_id = ? AND position NOT IN (
+                           SELECT position FROM chat_history WHERE member_id = ? ORDER BY position LIMIT ?)""",
+                    (key, key, limit)
+                )
+            self._bump_table_version(table)
+
+    def patch(self, table, key, session_id, fields):
+        """
+        Cập nhật các trường của bản lịch sử chat mới nhất của session thuộc member. Khớp theo session_id
+        thay vì vị trí trong list, vì worker khác có thể đã thêm bản lịch sử mới cho cùng member.
+        """
+        if table != "chat_history":
+            raise ValueError(f"patch không hỗ trợ bảng {table}")
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT position, data FROM chat_history WHERE member_id = ? AND session_id = ? ORDER BY position LIMIT 1",
+                (key, session_id)
+            ).fetchone()
+            if row is None:
+                return
+            position, entry = row
+            entry = json.loads(entry)
+            entry.update(fields)
+            self._conn.execute(
+                "UPDATE chat_history SET data = ? WHERE member_id = ? AND position = ?",
+                (json.dumps(entry, ensure_ascii=False), key, position)
+            )
+            self._bump_table_version(table)
+
+    # --- Truy vấn có lọc (dùng index) ---
+    def query_events_by_member(self, member_id, member_name=None):
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT id, data FROM events
+                   WHERE created_by = ?
+                      OR (? IS NOT NULL AND EXISTS (
+                          SELECT 1 FROM json_each(events.data, '$.participants') WHERE value = ?))""",
+                (member_id, member_name, member_name)
+            ).fetchall()
+        return {record_id: json.loads(record) for record_id, record in rows}
+
+    def query_notes_by_member(self, member_id):
+        with self._lock:
+            rows = self._conn.execute("SELECT id, data FROM notes WHERE created_by = ?", (member_id,)).fetchall()
+        return {record_id: json.loads(record) for record_id, record in rows}
+
+    def query_chat_history_by_member(self, member_id, limit=10):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM chat_history WHERE member_id = ? ORDER BY position LIMIT ?", (member_id, limit)
+            ).fetchall()
+        return [json.loads(entry) for (entry,) in rows]
+
+    def query_chat_history_by_session(self, session_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT member_id, data FROM chat_history WHERE session_id = ? ORDER BY timestamp DESC", (session_id,)
+            ).fetchall()
+        return [(member_id, json.loads(entry)) for member_id, entry in rows]
+
+    # --- Migration ---
+    def get_meta(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def migrate_from_json(self, json_store, file_tables, force=False):
+        """Nhập dữ liệu từ các file JSON (kèm log) vào SQLite. Chỉ chạy một lần trừ khi force=True."""
+        if self.get_meta("migrated_from_json") and not force:
+            logger.info("SQLite đã được migrate từ JSON trước đó, bỏ qua.")
+            return False
+        for file_path, table in file_tables.items():
+            data = json_store.load(file_path)
+            self.save(table, data)
+            logger.info(f"Đã migrate {len(data)} bản ghi từ {file_path} vào bảng {table}")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("migrated_from_json", datetime.datetime.now().isoformat())
+            )
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+data_store = JsonLogStore()
+
+# Các file dữ liệu được lưu trong SQLite khi STORAGE_BACKEND=sqlite
+SQLITE_FILE_TABLES = {
+    FAMILY_DATA_FILE: "family_members",
+    EVENTS_DATA_FILE: "events",
+    NOTES_DATA_FILE: "notes",
+    CHAT_HISTORY_FILE: "chat_history",
+}
+
+sqlite_store = None
+if STORAGE_BACKEND == "sqlite":
+    sqlite_store = SqliteDataStore(SQLITE_DB_FILE)
+    sqlite_store.migrate_from_json(data_store, SQLITE_FILE_TABLES)
+elif STORAGE_BACKEND != "json":
+    logger.warning(f"STORAGE_BACKEND '{STORAGE_BACKEND}' không hợp lệ, sử dụng 'json'.")
+
+def load_data(file_path):
+    try:
+        if sqlite_store and file_path in SQLITE_FILE_TABLES:
+            return sqlite_store.load(SQLITE_FILE_TABLES[file_path])
+        return data_store.load(file_path)
+    except Exception as e:
+        logger.error(f"Lỗi không xác định khi đọc {file_path}: {e}", exc_info=True)
+        return {}
+
+def save_data(file_path, data, changed_keys=None):
+    """
+    Lưu dữ liệu. Nếu có changed_keys, chỉ ghi thêm các bản ghi đó vào log (O(record));
+    nếu không, ghi lại toàn bộ snapshot.
+    """
+    try:
+        if sqlite_store and file_path in SQLITE_FILE_TABLES:
+            sqlite_store.save(SQLITE_FILE_TABLES[file_path], data, changed_keys)
+        elif changed_keys is None:
+            data_store.write_snapshot(file_path, data)
+        else:
+            data_store.append(file_path, data, changed_keys)
+        return True
+    except Exception as e:
+        logger.error(f"Lỗi khi lưu dữ liệu vào {file_path}: {e}", exc_info=True)
+        return False
+
+def push_data(file_path, key, value, limit=None):
+    """Thêm value vào đầu list data[key] trên đĩa (giữ tối đa limit phần tử), chỉ ghi phần tử mới."""
+    try:
+        if sqlite_store and file_path in SQLITE_FILE_TABLES:
+            sqlite_store.push(SQLITE_FILE_TABLES[file_path], key, value, limit)
+        else:
+            data_store.push(file_path, key, value, limit)
+        return True
+    except Exception as e:
+        logger.error(f"Lỗi khi lưu dữ liệu vào {file_path}: {e}", exc_info=True)
+        return False
+
+def patch_data(file_path, key, session_id, fields):
+    """Cập nhật các trường của phần tử mới nhất có session_id trong list data[key] trên đĩa."""
+    try:
+        if sqlite_store and file_path in SQLITE_FILE_TABLES:
+            sqlite_store.patch(SQLITE_FILE_TABLES[file_path], key, session_id, fields)
+        else:
+            data_store.patch(file_path, key, session_id, fields)
         return True
     except Exception as e:
         logger.error(f"Lỗi khi lưu dữ liệu vào {file_path}: {e}", exc_info=True)
-        if os.path.exists(temp_file_path):
-             try: os.remove(temp_file_path)
-             except OSError as rm_err: logger.error(f"Không thể xóa file tạm {temp_file_path}: {rm_err}")
         return False
 
 def verify_data_structure():
@@ -637,7 +1856,7 @@ def add_family_member(details):
             "preferences": details.get("preferences", {}),
             "added_on": datetime.datetime.now().isoformat()
         }
-        if save_data(FAMILY_DATA_FILE, family_data):
+        if save_data(FAMILY_DATA_FILE, family_data, [member_id]):
              logger.info(f"Đã thêm thành viên ID {member_id}: {details.get('name')}")
              return True
         else:
@@ -668,7 +1887,7 @@ def update_preference(details):
             family_data[member_id]["preferences"][preference_key] = preference_value
             family_data[member_id]["last_updated"] = datetime.datetime.now().isoformat()
 
-            if save_data(FAMILY_DATA_FILE, family_data):
+            if save_data(FAMILY_DATA_FILE, family_data, [member_id]):
                 logger.info(f"Đã cập nhật sở thích '{preference_key}' cho thành viên {member_id}")
                 return True
             else:
@@ -767,7 +1986,7 @@ def add_event(details):
             "created_by": details.get("created_by"),
             "created_on": datetime.datetime.now().isoformat()
         }
-        if save_data(EVENTS_DATA_FILE, events_data):
+        if save_data(EVENTS_DATA_FILE, events_data, [event_id]):
              logger.info(f"Đã thêm sự kiện ID {event_id}: {details.get('title')} (Category: {category})")
              return True
         else:
@@ -819,7 +2038,7 @@ def update_event(details):
 
             event_to_update["last_updated"] = datetime.datetime.now().isoformat()
             logger.info(f"Attempting to save updated event ID={event_id_str}")
-            if save_data(EVENTS_DATA_FILE, events_data):
+            if save_data(EVENTS_DATA_FILE, events_data, [event_id_str]):
                 logger.info(f"Đã cập nhật và lưu thành công sự kiện ID={event_id_str}")
                 return True
             else:
@@ -849,7 +2068,7 @@ def delete_event(details):
     try:
         if event_id_to_delete in events_data:
             deleted_event_copy = events_data.pop(event_id_to_delete)
-            if save_data(EVENTS_DATA_FILE, events_data):
+            if save_data(EVENTS_DATA_FILE, events_data, [event_id_to_delete]):
                  logger.info(f"Đã xóa sự kiện ID {event_id_to_delete}")
                  return True
             else:
@@ -882,7 +2101,7 @@ def add_note(details):
             "created_by": details.get("created_by"),
             "created_on": datetime.datetime.now().isoformat()
         }
-        if save_data(NOTES_DATA_FILE, notes_data):
+        if save_data(NOTES_DATA_FILE, notes_data, [note_id]):
             logger.info(f"Đã thêm ghi chú ID {note_id}: {details.get('title')}")
             return True
         else:
@@ -910,8 +2129,27 @@ notes_data = load_data(NOTES_DATA_FILE)
 chat_history = load_data(CHAT_HISTORY_FILE)
 verify_data_structure() # Verify after loading
 
+async def reload_shared_data_if_stale():
+    """
+    Với backend SQLite: tải lại các bảng mà worker khác đã ghi. Việc đọc + parse chạy trong thread;
+    dict toàn cục chỉ được cập nhật tại chỗ trên event loop.
+    """
+    if not sqlite_store:
+        return
+    changed = sqlite_store.changed_tables()
+    targets = [(file_path, target) for file_path, target in (
+        (FAMILY_DATA_FILE, family_data), (EVENTS_DATA_FILE, events_data),
+        (NOTES_DATA_FILE, notes_data), (CHAT_HISTORY_FILE, chat_history)) if SQLITE_FILE_TABLES[file_path] in changed]
+    if not targets:
+        return
+    fresh_data = await asyncio.to_thread(lambda: [sqlite_store.load(SQLITE_FILE_TABLES[file_path]) for file_path, _ in targets])
+    for (file_path, target), fresh in zip(targets, fresh_data):
+        target.clear()
+        target.update(fresh)
+    logger.info(f"Đã tải lại từ SQLite các bảng do worker khác ghi: {', '.join(sorted(changed))}")
+
 # Initialize Session Manager
-session_manager = SessionManager(SESSIONS_DATA_FILE)
+session_manager = SessionManager()
 
 # -------Date -----------
 
@@ -1442,16 +2680,74 @@ class DateTimeHandler:
 # ------- Weather -----------
 
 class WeatherService:
-    """Dịch vụ lấy dữ liệu thời tiết từ OpenWeatherMap API."""
+    """
+    Dịch vụ lấy dữ liệu thời tiết từ OpenWeatherMap API.
+
+    Kết quả được cache dùng chung giữa mọi instance (hiện tại WEATHER_CURRENT_TTL, dự báo
+    WEATHER_FORECAST_TTL); các cache miss đồng thời cho cùng key chỉ gọi API một lần.
+    Dữ liệu trả về được dùng chung, không sửa trực tiếp.
+    """
+    _cache = TTLCache("weather", max_size=WEATHER_CACHE_SIZE, ttl_seconds=WEATHER_CURRENT_TTL)
+    _single_flight = SingleFlight("weather")
+
     def __init__(self, api_key):
         self.api_key = api_key
         self.base_url = "https://api.openweathermap.org/data/2.5"
-        
+
+    @staticmethod
+    def _cache_key(kind, lat, lon, location, lang, days=None):
+        """Key theo tọa độ làm tròn (~1km) hoặc tên địa điểm chuẩn hóa, kèm ngôn ngữ và số ngày."""
+        if lat is not None and lon is not None:
+            place = f"{round(float(lat), 2)},{round(float(lon), 2)}"
+        else:
+            place = " ".join((location or "Hanoi,vn").lower().split())
+        return f"{kind}|{place}|{lang}|{days}"
+
+    async def _cached(self, key, ttl_seconds, fetch):
+        result = self._cache.get(key)
+        if result is not None:
+            return result
+
+        async def fetch_and_store():
+            fetched = await fetch()
+            if fetched is not None:
+                self._cache.set(key, fetched, ttl_seconds=ttl_seconds)
+            return fetched
+
+        return await self._single_flight.do(key, fetch_and_store)
+
     async def get_current_weather(self, lat=None, lon=None, location=None, lang="vi"):
         """
         Lấy thông tin thời tiết hiện tại. Ưu tiên sử dụng tọa độ (lat/lon) nếu có,
         nếu không thì dùng location để tìm kiếm.
         """
+        key = self._cache_key("current", lat, lon, location, lang)
+        return await self._cached(key, WEATHER_CURRENT_TTL,
+                                  lambda: self._fetch_current_weather(lat, lon, location, lang))
+
+    async def get_forecast(self, lat=None, lon=None, location=None, lang="vi", days=5):
+        """
+        Lấy dự báo thời tiết cho nhiều ngày. Ưu tiên sử dụng tọa độ (lat/lon) nếu có,
+        nếu không thì dùng location để tìm kiếm.
+        """
+        key = self._cache_key("forecast", lat, lon, location, lang, days)
+        return await self._cached(key, WEATHER_FORECAST_TTL,
+                                  lambda: self._fetch_forecast(lat, lon, location, lang, days))
+
+    async def get_bundle(self, lat=None, lon=None, location=None, lang="vi", days=5):
+        """
+        Lấy đồng thời thời tiết hiện tại và dự báo (hai request chạy song song).
+
+        Returns:
+            Tuple (current_weather, forecast); phần nào lỗi sẽ là None
+        """
+        return await asyncio.gather(
+            self.get_current_weather(lat=lat, lon=lon, location=location, lang=lang),
+            self.get_forecast(lat=lat, lon=lon, location=location, lang=lang, days=days),
+        )
+
+    async def _fetch_current_weather(self, lat, lon, location, lang):
+        """Gọi API thời tiết hiện tại (không qua cache)."""
         try:
             if lat is not None and lon is not None:
                 # Sử dụng tọa độ
@@ -1482,9 +2778,7 @@ class WeatherService:
                     "lang": lang
                 }
                 
-            response = await asyncio.to_thread(
-                requests.get, url, params=params, timeout=10
-            )
+            response = await http_client.request("GET", url, params=params, timeout=10)
             
             if response.status_code != 200:
                 logger.error(f"OpenWeatherMap API error: {response.status_code} - {response.text}")
@@ -1497,11 +2791,8 @@ class WeatherService:
             logger.error(f"Error fetching weather data: {e}", exc_info=True)
             return None
             
-    async def get_forecast(self, lat=None, lon=None, location=None, lang="vi", days=5):
-        """
-        Lấy dự báo thời tiết cho nhiều ngày. Ưu tiên sử dụng tọa độ (lat/lon) nếu có,
-        nếu không thì dùng location để tìm kiếm.
-        """
+    async def _fetch_forecast(self, lat, lon, location, lang, days):
+        """Gọi API dự báo thời tiết (không qua cache)."""
         try:
             if lat is not None and lon is not None:
                 # Sử dụng tọa độ
@@ -1535,9 +2826,7 @@ class WeatherService:
                     "cnt": days * 8
                 }
                 
-            response = await asyncio.to_thread(
-                requests.get, url, params=params, timeout=10
-            )
+            response = await http_client.request("GET", url, params=params, timeout=10)
             
             if response.status_code != 200:
                 logger.error(f"OpenWeatherMap API error: {response.status_code} - {response.text}")
@@ -1796,11 +3085,13 @@ class WeatherQueryParser:
         """
         if not query or not openai_api_key:
             return False, None, None
+
+        cache_key = intent_cache_key("parse_weather_query", query)
+        cached = intent_cache.get(cache_key)
+        if cached is not None:
+            return tuple(cached)
             
         try:
-            from openai import OpenAI
-            client = OpenAI(api_key=openai_api_key)
-            
             system_prompt = """
 Bạn là một hệ thống phân loại truy vấn thời tiết thông minh. Nhiệm vụ của bạn là:
 1. Xác định xem câu hỏi có phải là về thời tiết hoặc liên quan đến thời tiết không (`is_weather_query`).
@@ -1822,8 +3113,8 @@ Ví dụ:
 
 Trả lời DƯỚI DẠNG JSON HỢP LỆ với 3 trường: is_weather_query (boolean), location (string hoặc null), date_description (string hoặc null).
 """
-            response = await asyncio.to_thread(
-                 client.chat.completions.create,
+            response = await create_chat_completion(
+                 openai_api_key,
                  model="gpt-4o-mini",
                  messages=[
                      {"role": "system", "content": system_prompt},
@@ -1847,6 +3138,7 @@ Trả lời DƯỚI DẠNG JSON HỢP LỆ với 3 trường: is_weather_query (
                     location = "Hanoi"  # Mặc định là Hà Nội
                     
                 logger.info(f"Phân tích truy vấn '{query}': is_weather_query={is_weather_query}, location='{location}', date_description='{date_description}'")
+                intent_cache.set(cache_key, [is_weather_query, location, date_description])
                 return is_weather_query, location, date_description
 
             except (json.JSONDecodeError, TypeError) as e:
@@ -1892,11 +3184,9 @@ Trả lời DƯỚI DẠNG JSON HỢP LỆ với 3 trường: is_weather_query (
                 
             # Lấy dữ liệu thời tiết hiện tại
             if lat is not None and lon is not None:
-                current_weather = await weather_service.get_current_weather(lat=lat, lon=lon, lang=lang)
-                forecast = await weather_service.get_forecast(lat=lat, lon=lon, lang=lang, days=forecast_days)
+                current_weather, forecast = await weather_service.get_bundle(lat=lat, lon=lon, lang=lang, days=forecast_days)
             else:
-                current_weather = await weather_service.get_current_weather(location=location, lang=lang)
-                forecast = await weather_service.get_forecast(location=location, lang=lang, days=forecast_days)
+                current_weather, forecast = await weather_service.get_bundle(location=location, lang=lang, days=forecast_days)
                 
             return current_weather, forecast, target_date, date_text
                 
@@ -2837,11 +4127,13 @@ class WeatherAdvisor:
         """
         if not query or not openai_api_key:
             return False, "general", None, None
+
+        cache_key = intent_cache_key("detect_weather_advice_need", query)
+        cached = intent_cache.get(cache_key)
+        if cached is not None:
+            return tuple(cached)
             
         try:
-            from openai import OpenAI
-            client = OpenAI(api_key=openai_api_key)
-            
             system_prompt = """
 Bạn là một hệ thống phân loại truy vấn tư vấn thời tiết thông minh. Nhiệm vụ của bạn là:
 1. Xác định xem câu hỏi có phải là yêu cầu tư vấn liên quan đến thời tiết không (`is_advice_query`).
@@ -2864,8 +4156,8 @@ Ví dụ:
 
 Trả lời DƯỚI DẠNG JSON HỢP LỆ với 4 trường: is_advice_query (boolean), advice_type (string hoặc null), location (string hoặc null), date_description (string hoặc null).
 """
-            response = await asyncio.to_thread(
-                 client.chat.completions.create,
+            response = await create_chat_completion(
+                 openai_api_key,
                  model="gpt-4o-mini",
                  messages=[
                      {"role": "system", "content": system_prompt},
@@ -2893,6 +4185,7 @@ Trả lời DƯỚI DẠNG JSON HỢP LỆ với 4 trường: is_advice_query (b
                     location = "Hanoi"  # Mặc định là Hà Nội
                     
                 logger.info(f"Phân tích truy vấn tư vấn '{query}': is_advice_query={is_advice_query}, advice_type='{advice_type}', location='{location}', date_description='{date_description}'")
+                intent_cache.set(cache_key, [is_advice_query, advice_type, location, date_description])
                 return is_advice_query, advice_type, location, date_description
 
             except (json.JSONDecodeError, TypeError) as e:
@@ -2903,66 +4196,6 @@ Trả lời DƯỚI DẠNG JSON HỢP LỆ với 4 trường: is_advice_query (b
             logger.error(f"Lỗi khi gọi OpenAI trong detect_weather_advice_need: {e}", exc_info=True)
             return False, "general", None, None
 
-async def detect_weather_query(query, api_key):
-    """Phát hiện nếu query là về thời tiết và trích xuất địa điểm."""
-    if not api_key or not query: 
-        return False, None
-
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
-        system_prompt = """
-Bạn là một hệ thống phân loại truy vấn thời tiết thông minh. Nhiệm vụ của bạn là:
-1. Xác định xem câu hỏi có phải là về thời tiết hoặc liên quan đến thời tiết không (`is_weather_query`).
-   - Câu hỏi về thời tiết: "thời tiết ở Hà Nội", "trời có mưa không", "nhiệt độ hôm nay", "có nắng không", etc.
-   - Câu hỏi liên quan đến thời tiết: "nên mặc gì hôm nay", "có nên mang ô không", "có nên đi biển cuối tuần", etc.
-2. Nếu là truy vấn thời tiết, xác định địa điểm đề cập trong câu hỏi (`location`).
-   - Trích xuất TÊN ĐỊA ĐIỂM CHÍNH XÁC từ câu hỏi, ví dụ: "Hà Nội", "Đà Nẵng", "Sài Gòn", "Ho Chi Minh City"
-   - Chỉ trả về "Hanoi" khi câu hỏi KHÔNG đề cập đến bất kỳ địa điểm nào cụ thể.
-   - Đối với "Sài Gòn", hãy trả về "Ho Chi Minh City" để API tìm kiếm chính xác.
-
-Ví dụ:
-- User: "thời tiết ở Đà Nẵng hôm nay" -> { "is_weather_query": true, "location": "Da Nang" }
-- User: "trời có mưa không" -> { "is_weather_query": true, "location": "Hanoi" }
-- User: "thời tiết Sài Gòn hôm nay" -> { "is_weather_query": true, "location": "Ho Chi Minh City" }
-- User: "nên mặc áo gì ở Sài Gòn hôm nay" -> { "is_weather_query": true, "location": "Ho Chi Minh City" }
-- User: "kết quả trận MU tối qua" -> { "is_weather_query": false, "location": null }
-
-Trả lời DƯỚI DẠNG JSON HỢP LỆ với 2 trường: is_weather_query (boolean), location (string hoặc null).
-"""
-        response = await asyncio.to_thread(
-             client.chat.completions.create,
-             model="gpt-4o-mini",
-             messages=[
-                 {"role": "system", "content": system_prompt},
-                 {"role": "user", "content": f"Câu hỏi của người dùng: \"{query}\""}
-             ],
-             temperature=0.1,
-             max_tokens=150,
-             response_format={"type": "json_object"}
-        )
-
-        result_str = response.choices[0].message.content
-        logger.info(f"Kết quả detect_weather_query (raw): {result_str}")
-
-        try:
-            result = json.loads(result_str)
-            is_weather_query = result.get("is_weather_query", False)
-            location = result.get("location")
-            
-            if is_weather_query and not location:
-                location = "Hanoi"  # Mặc định là Hà Nội
-                
-            logger.info(f"Phân tích truy vấn '{query}': is_weather_query={is_weather_query}, location='{location}'")
-            return is_weather_query, location
-
-        except (json.JSONDecodeError, TypeError) as e:
-            logger.error(f"Lỗi giải mã JSON từ detect_weather_query: {e}. Raw: {result_str}")
-            return False, None
-    except Exception as e:
-        logger.error(f"Lỗi khi gọi OpenAI trong detect_weather_query: {e}", exc_info=True)
-        return False, None
-
 # ------- Request & Response Models --------
 class MessageContent(BaseModel):
     type: str
@@ -2987,12 +4220,15 @@ class ChatRequest(BaseModel):
     latitude: Optional[float] = None
     longitude: Optional[float] = None
     messages: Optional[List[Message]] = None  # Optional full history from client
+    audio_by_reference: bool = False  # True: chỉ trả audio_id, client tải audio qua GET /audio/{audio_id}
+    stream_audio: Optional[bool] = None  # /chat/stream: True để nhận audio theo từng câu (frame audio_chunk)
 
 
 class ChatResponse(BaseModel):
     session_id: str
     messages: List[Message] # Return only the *last* assistant message(s)
     audio_response: Optional[str] = None
+    audio_id: Optional[str] = None # Lấy audio qua GET /audio/{audio_id}
     response_format: Optional[str] = "html"
     content_type: Optional[str] = "text" # Reflect back the input type
     event_data: Optional[Dict[str, Any]] = None # Include event data if generated
@@ -3029,6 +4265,22 @@ class SuggestedQuestionsResponse(BaseModel):
 
 # ------- API Endpoints -------------
 
+@app.middleware("http")
+async def shared_data_sync_middleware(request: Request, call_next):
+    """Đồng bộ dữ liệu dùng chung giữa các worker trước mỗi request (chỉ với backend SQLite)."""
+    await reload_shared_data_if_stale()
+    return await call_next(request)
+
+@app.middleware("http")
+async def upload_size_limit_middleware(request: Request, call_next):
+    """Từ chối sớm (413) upload có Content-Length vượt giới hạn, trước khi body được đọc và spool."""
+    max_bytes = UPLOAD_SIZE_LIMITS.get(request.url.path)
+    content_length = request.headers.get("content-length")
+    if max_bytes and content_length and content_length.isdigit() and int(content_length) > max_bytes + UPLOAD_FORM_OVERHEAD_BYTES:
+        runtime_metrics.incr("upload.rejected_too_large")
+        return JSONResponse(status_code=413, content={"detail": f"File tải lên vượt quá {max_bytes // (1024 * 1024)} MB."})
+    return await call_next(request)
+
 # Helper function to execute a tool call
 def execute_tool_call(tool_call: ChatCompletionMessageToolCall, current_member_id: Optional[str]) -> Tuple[Optional[Dict[str, Any]], str]:
     """
@@ -3197,6 +4449,14 @@ async def chat_endpoint(chat_request: ChatRequest):
     Endpoint chính cho trò chuyện (sử dụng Tool Calling).
     Includes event_data in the response.
     """
+    session_manager.pin(chat_request.session_id)
+    try:
+        return await _chat_turn(chat_request)
+    finally:
+        session_manager.unpin(chat_request.session_id)
+
+async def _chat_turn(chat_request: ChatRequest):
+    """Xử lý một lượt /chat; session được pin trong suốt lượt (xem chat_endpoint)."""
     openai_api_key = chat_request.openai_api_key or os.getenv("OPENAI_API_KEY", "")
     tavily_api_key = chat_request.tavily_api_key or os.getenv("TAVILY_API_KEY", "")
     if not openai_api_key or "sk-" not in openai_api_key:
@@ -3209,7 +4469,7 @@ async def chat_endpoint(chat_request: ChatRequest):
     # --- Message Handling ---
     if chat_request.messages is not None and not session.get("messages"):
          logger.info(f"Loading message history from client for session {chat_request.session_id}")
-         session["messages"] = [msg.dict(exclude_none=True) for msg in chat_request.messages]
+         session["messages"] = offload_message_blobs([msg.dict(exclude_none=True) for msg in chat_request.messages])
 
     message_content_model = chat_request.message
     message_dict = message_content_model.dict(exclude_none=True)
@@ -3217,7 +4477,7 @@ async def chat_endpoint(chat_request: ChatRequest):
     processed_content_list = []
 
     if chat_request.content_type == "audio" and message_dict.get("type") == "audio" and message_dict.get("audio_data"):
-        processed_audio = process_audio(message_dict, openai_api_key)
+        processed_audio = await process_audio(message_dict, openai_api_key)
         if processed_audio and processed_audio.get("text"):
              processed_content_list.append({"type": "text", "text": processed_audio["text"]})
              logger.info(f"Đã xử lý audio thành text: {processed_audio['text'][:50]}...")
@@ -3228,7 +4488,8 @@ async def chat_endpoint(chat_request: ChatRequest):
     elif chat_request.content_type == "image" and message_dict.get("type") == "image_url":
         logger.info(f"Đã nhận hình ảnh: {message_dict.get('image_url', {}).get('url', '')[:60]}...")
         if message_dict.get("image_url"):
-            processed_content_list.append({"type": "image_url", "image_url": message_dict["image_url"]})
+            image_url = await image_preprocessor.process_image_url(message_dict["image_url"])
+            processed_content_list.append({"type": "image_url", "image_url": image_url})
         else:
             logger.error("Content type là image nhưng thiếu image_url.")
             processed_content_list.append({"type": "text", "text": "[Lỗi xử lý ảnh: thiếu URL]"})
@@ -3261,7 +4522,7 @@ async def chat_endpoint(chat_request: ChatRequest):
     if processed_content_list:
          session["messages"].append({
              "role": "user",
-             "content": processed_content_list
+             "content": offload_content_blobs(processed_content_list)
          })
     else:
          logger.error("Không thể xử lý nội dung tin nhắn người dùng.")
@@ -3272,27 +4533,9 @@ async def chat_endpoint(chat_request: ChatRequest):
     final_event_data_to_return: Optional[Dict[str, Any]] = None
 
     try:
-        client = OpenAI(api_key=openai_api_key)
         system_prompt_content = build_system_prompt(current_member_id)
 
-        openai_messages = [{"role": "system", "content": system_prompt_content}]
-        for msg in session["messages"]:
-             message_for_api = {
-                 "role": msg["role"],
-                 **({ "tool_calls": msg["tool_calls"] } if msg.get("tool_calls") else {}),
-                 **({ "tool_call_id": msg.get("tool_call_id") } if msg.get("tool_call_id") else {}),
-             }
-             msg_content = msg.get("content")
-             if isinstance(msg_content, list):
-                  message_for_api["content"] = msg_content
-             elif isinstance(msg_content, str):
-                  message_for_api["content"] = msg_content
-             elif msg.get("role") == "tool":
-                  message_for_api["content"] = str(msg_content) if msg_content is not None else ""
-             else:
-                  logger.warning(f"Định dạng content không mong đợi cho role {msg['role']}: {type(msg_content)}. Sử dụng chuỗi rỗng.")
-                  message_for_api["content"] = ""
-             openai_messages.append(message_for_api)
+        openai_messages = build_context_messages(system_prompt_content, chat_request.session_id, session["messages"], openai_api_key)
 
 
         # --- Check Search Need ---
@@ -3309,9 +4552,11 @@ async def chat_endpoint(chat_request: ChatRequest):
 
 
         logger.info("--- Calling OpenAI API (Potential First Pass) ---")
-        logger.debug(f"Messages sent (last 3): {json.dumps(openai_messages[-3:], indent=2, ensure_ascii=False)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Messages sent (last 3): {json.dumps(openai_messages[-3:], indent=2, ensure_ascii=False)}")
 
-        first_response = client.chat.completions.create(
+        first_response = await create_chat_completion(
+            openai_api_key,
             model=openai_model,
             messages=openai_messages,
             tools=available_tools,
@@ -3347,9 +4592,11 @@ async def chat_endpoint(chat_request: ChatRequest):
                 session["messages"].append(tool_result_message)
 
             logger.info("--- Calling OpenAI API (Second Pass - Summarizing Tool Results) ---")
-            logger.debug(f"Messages for second call (last 4): {json.dumps(messages_for_second_call[-4:], indent=2, ensure_ascii=False)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Messages for second call (last 4): {json.dumps(messages_for_second_call[-4:], indent=2, ensure_ascii=False)}")
 
-            second_response = client.chat.completions.create(
+            second_response = await create_chat_completion(
+                openai_api_key,
                 model=openai_model,
                 messages=messages_for_second_call,
                 temperature=0.7,
@@ -3368,11 +4615,11 @@ async def chat_endpoint(chat_request: ChatRequest):
         # --- Final Processing & Response ---
         final_html_content = final_response_content if final_response_content else "Tôi đã thực hiện xong yêu cầu của bạn."
 
-        audio_response_b64 = text_to_speech_google(final_html_content)
+        audio_id, audio_response_b64 = await tts_service.respond(final_html_content, chat_request.audio_by_reference)
 
         if current_member_id:
-             summary = await generate_chat_summary(session["messages"], openai_api_key)
-             save_chat_history(current_member_id, session["messages"], summary, chat_request.session_id)
+             save_chat_history(current_member_id, session["messages"], session_id=chat_request.session_id)
+             chat_summary_queue.submit(current_member_id, chat_request.session_id, session["messages"], openai_api_key)
 
         session_manager.update_session(chat_request.session_id, {"messages": session["messages"]})
 
@@ -3410,6 +4657,7 @@ async def chat_endpoint(chat_request: ChatRequest):
             session_id=chat_request.session_id,
             messages=[last_assistant_msg_obj],
             audio_response=audio_response_b64,
+            audio_id=audio_id,
             response_format="html",
             content_type=chat_request.content_type,
             event_data=final_event_data_to_return
@@ -3422,12 +4670,54 @@ async def chat_endpoint(chat_request: ChatRequest):
 
 
 # --- Endpoint /chat/stream ---
-@app.post("/chat/stream")
+class StreamTimer:
+    """Đo thời gian tới chunk đầu tiên và khoảng cách giữa các chunk nội dung của một stream."""
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_chunk_at = None
+        self.last_chunk_at = None
+        self.max_interval = 0.0
+        self.total_interval = 0.0
+        self.chunk_count = 0
+
+    def mark_chunk(self):
+        now = time.perf_counter()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+        else:
+            interval = now - self.last_chunk_at
+            self.total_interval += interval
+            self.max_interval = max(self.max_interval, interval)
+        self.last_chunk_at = now
+        self.chunk_count += 1
+
+    def summary(self):
+        """Kết quả tính bằng mili giây, dùng cho frame `complete`."""
+        intervals = self.chunk_count - 1
+        return {
+            "time_to_first_chunk_ms": round((self.first_chunk_at - self.started_at) * 1000, 1) if self.first_chunk_at else None,
+            "avg_chunk_interval_ms": round(self.total_interval / intervals * 1000, 1) if intervals > 0 else None,
+            "max_chunk_interval_ms": round(self.max_interval * 1000, 1) if intervals > 0 else None,
+            "chunk_count": self.chunk_count,
+            "total_ms": round((time.perf_counter() - self.started_at) * 1000, 1),
+        }
+
+@app.post("/chat/stream")
 async def chat_stream_endpoint(chat_request: ChatRequest):
     """
     Endpoint streaming cho trò chuyện (sử dụng Tool Calling).
     Includes event_data in the final completion message.
     """
+    # Pin kéo dài tới khi generator của StreamingResponse kết thúc (unpin trong finally của generator)
+    session_manager.pin(chat_request.session_id)
+    try:
+        return await _chat_stream_turn(chat_request)
+    except BaseException:
+        session_manager.unpin(chat_request.session_id)
+        raise
+
+async def _chat_stream_turn(chat_request: ChatRequest):
+    """Chuẩn bị lượt /chat/stream và trả về StreamingResponse; session đã được pin bởi chat_stream_endpoint."""
     openai_api_key = chat_request.openai_api_key or os.getenv("OPENAI_API_KEY", "")
     tavily_api_key = chat_request.tavily_api_key or os.getenv("TAVILY_API_KEY", "")
     if not openai_api_key or "sk-" not in openai_api_key:
@@ -3440,7 +4730,7 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
     # --- Message Handling ---
     if chat_request.messages is not None and not session.get("messages"):
          logger.info(f"Stream: Loading message history from client for session {chat_request.session_id}")
-         session["messages"] = [msg.dict(exclude_none=True) for msg in chat_request.messages]
+         session["messages"] = offload_message_blobs([msg.dict(exclude_none=True) for msg in chat_request.messages])
 
     message_content_model = chat_request.message
     message_dict = message_content_model.dict(exclude_none=True)
@@ -3449,7 +4739,7 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
 
     # --- Process incoming message based on content_type ---
     if chat_request.content_type == "audio" and message_dict.get("type") == "audio" and message_dict.get("audio_data"):
-        processed_audio = process_audio(message_dict, openai_api_key)
+        processed_audio = await process_audio(message_dict, openai_api_key)
         if processed_audio and processed_audio.get("text"):
              processed_content_list.append({"type": "text", "text": processed_audio["text"]})
              logger.info(f"Stream: Đã xử lý audio thành text: {processed_audio['text'][:50]}...")
@@ -3460,7 +4750,8 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
     elif chat_request.content_type == "image" and message_dict.get("type") == "image_url":
         logger.info(f"Stream: Đã nhận hình ảnh: {message_dict.get('image_url', {}).get('url', '')[:60]}...")
         if message_dict.get("image_url"):
-            processed_content_list.append({"type": "image_url", "image_url": message_dict["image_url"]})
+            image_url = await image_preprocessor.process_image_url(message_dict["image_url"])
+            processed_content_list.append({"type": "image_url", "image_url": image_url})
         else:
             logger.error("Stream: Content type là image nhưng thiếu image_url.")
             processed_content_list.append({"type": "text", "text": "[Lỗi xử lý ảnh: thiếu URL]"})
@@ -3493,44 +4784,51 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
     if processed_content_list:
          session["messages"].append({
              "role": "user",
-             "content": processed_content_list
+             "content": offload_content_blobs(processed_content_list)
          })
     else:
          logger.error("Stream: Không thể xử lý nội dung tin nhắn đến. Không thêm vào lịch sử.")
 
     # --- Streaming Generator ---
     async def response_stream_generator():
+        stream_timer = StreamTimer()
+        # Opt-in: client cũ không gửi stream_audio vẫn nhận toàn bộ audio trong frame complete
+        speech = StreamingSpeech(chat_request.audio_by_reference) if bool(chat_request.stream_audio) else None
         final_event_data_to_return: Optional[Dict[str, Any]] = None
-        client = OpenAI(api_key=openai_api_key)
         system_prompt_content = build_system_prompt(current_member_id)
 
-        openai_messages = [{"role": "system", "content": system_prompt_content}]
-        for msg in session["messages"]:
-             message_for_api = {
-                 "role": msg["role"],
-                 **({ "tool_calls": msg["tool_calls"] } if msg.get("tool_calls") else {}),
-                 **({ "tool_call_id": msg.get("tool_call_id") } if msg.get("tool_call_id") else {}),
-             }
-             msg_content = msg.get("content")
-             if isinstance(msg_content, list): message_for_api["content"] = msg_content
-             elif isinstance(msg_content, str): message_for_api["content"] = msg_content
-             elif msg.get("role") == "tool": message_for_api["content"] = str(msg_content) if msg_content is not None else ""
-             else: message_for_api["content"] = ""
-             openai_messages.append(message_for_api)
+        openai_messages = build_context_messages(system_prompt_content, chat_request.session_id, session["messages"], openai_api_key)
 
-        # --- Check Search Need ---
+        # --- Check Search Need (stream các frame tiến trình tìm kiếm trong lúc chờ) ---
+        progress_queue = asyncio.Queue()
+        search_task = asyncio.create_task(check_search_need(
+            openai_messages,
+            openai_api_key,
+            tavily_api_key,
+            lat=chat_request.latitude,
+            lon=chat_request.longitude,
+            progress=progress_queue.put
+        ))
         try:
-             search_result_for_prompt = await check_search_need(
-                 openai_messages, 
-                 openai_api_key, 
-                 tavily_api_key,
-                 lat=chat_request.latitude,
-                 lon=chat_request.longitude
-             )
+             while not search_task.done() or not progress_queue.empty():
+                  if progress_queue.empty():
+                       next_event = asyncio.ensure_future(progress_queue.get())
+                       await asyncio.wait({next_event, search_task}, return_when=asyncio.FIRST_COMPLETED)
+                       if not next_event.done():
+                            next_event.cancel()
+                            continue
+                       event = next_event.result()
+                  else:
+                       event = progress_queue.get_nowait()
+                  yield json.dumps(event, ensure_ascii=False) + "\n"
+             search_result_for_prompt = search_task.result()
              if search_result_for_prompt:
                   openai_messages[0] = {"role": "system", "content": system_prompt_content + search_result_for_prompt}
         except Exception as search_err:
              logger.error(f"Error during search need check: {search_err}", exc_info=True)
+        finally:
+             if not search_task.done():
+                  search_task.cancel()
 
         accumulated_tool_calls = []
         accumulated_assistant_content = ""
@@ -3538,9 +4836,11 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
         tool_call_chunks = {}
 
         # --- Main Streaming Logic ---
+        stream = summary_stream = None
         try:
             logger.info("--- Calling OpenAI API (Streaming - Potential First Pass) ---")
-            stream = client.chat.completions.create(
+            stream = await create_chat_completion(
+                openai_api_key,
                 model=openai_model,
                 messages=openai_messages,
                 tools=available_tools,
@@ -3557,9 +4857,13 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
                 finish_reason = chunk.choices[0].finish_reason
 
                 if delta.content:
+                    stream_timer.mark_chunk()
                     accumulated_assistant_content += delta.content
                     yield json.dumps({"chunk": delta.content, "type": "html", "content_type": chat_request.content_type}) + "\n"
-                    await asyncio.sleep(0)
+                    if speech:
+                        speech.feed(delta.content)
+                        for audio_frame in speech.ready_frames():
+                            yield json.dumps(audio_frame) + "\n"
 
                 if delta.tool_calls:
                     for tc_chunk in delta.tool_calls:
@@ -3606,6 +4910,14 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
                          assistant_message_dict_for_session["content"] = accumulated_assistant_content
                     break
 
+            # Thoát vòng lặp tại finish_reason: đóng stream để trả slot giới hạn đồng thời của OpenAI
+            await stream.close()
+
+            if speech:
+                # Hết text của lượt stream này: gửi nốt audio đang chờ thay vì giữ lại tới khi có text mới
+                async for audio_frame in speech.finish():
+                    yield json.dumps(audio_frame) + "\n"
+
             # --- Execute Tools and Second Stream (if needed) ---
             if accumulated_tool_calls:
                 logger.info(f"--- Executing {len(accumulated_tool_calls)} Tool Calls (Non-Streamed) ---")
@@ -3617,7 +4929,7 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
                 messages_for_second_call = openai_messages + [assistant_message_dict_for_session]
 
                 for tool_call in accumulated_tool_calls:
-                    yield json.dumps({"tool_start": tool_call.function.name}) + "\n"; await asyncio.sleep(0.05)
+                    yield json.dumps({"tool_start": tool_call.function.name}) + "\n"
                     event_data_from_tool, tool_result_content = execute_tool_call(tool_call, current_member_id)
 
                     if event_data_from_tool and final_event_data_to_return is None:
@@ -3625,7 +4937,7 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
                               final_event_data_to_return = event_data_from_tool
                               logger.info(f"Captured event_data for stream response: {final_event_data_to_return}")
 
-                    yield json.dumps({"tool_end": tool_call.function.name, "result_preview": tool_result_content[:50]+"..."}) + "\n"; await asyncio.sleep(0.05)
+                    yield json.dumps({"tool_end": tool_call.function.name, "result_preview": tool_result_content[:50]+"..."}) + "\n"
 
                     tool_result_message = {
                         "tool_call_id": tool_call.id, "role": "tool",
@@ -3635,8 +4947,10 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
                     session["messages"].append(tool_result_message)
 
                 logger.info("--- Calling OpenAI API (Streaming - Second Pass - Summary) ---")
-                logger.debug(f"Messages for second stream call (last 4): {json.dumps(messages_for_second_call[-4:], indent=2, ensure_ascii=False)}")
-                summary_stream = client.chat.completions.create(
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Messages for second stream call (last 4): {json.dumps(messages_for_second_call[-4:], indent=2, ensure_ascii=False)}")
+                summary_stream = await create_chat_completion(
+                    openai_api_key,
                     model=openai_model, messages=messages_for_second_call,
                     temperature=0.7, max_tokens=1024, stream=True
                 )
@@ -3645,9 +4959,17 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
                 async for summary_chunk in summary_stream:
                      delta_summary = summary_chunk.choices[0].delta.content if summary_chunk.choices else None
                      if delta_summary:
+                          stream_timer.mark_chunk()
                           final_summary_content += delta_summary
                           yield json.dumps({"chunk": delta_summary, "type": "html", "content_type": chat_request.content_type}) + "\n"
-                          await asyncio.sleep(0)
+                          if speech:
+                               speech.feed(delta_summary)
+                               for audio_frame in speech.ready_frames():
+                                    yield json.dumps(audio_frame) + "\n"
+
+                if speech:
+                    async for audio_frame in speech.finish():
+                        yield json.dumps(audio_frame) + "\n"
 
                 # Add final summary message to history
                 session["messages"].append({"role": "assistant", "content": final_summary_content})
@@ -3661,23 +4983,35 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
                 final_response_for_tts = accumulated_assistant_content if accumulated_assistant_content else "Vâng."
 
             # --- Post-Streaming Processing ---
-            logger.info("Generating final audio response...")
-            audio_response_b64 = text_to_speech_google(final_response_for_tts)
+            if speech:
+                # Audio đã gửi theo từng câu; chỉ còn phần cuối (hoặc câu trả lời mặc định nếu không có text)
+                if not speech.received_text:
+                    speech.feed(final_response_for_tts)
+                async for audio_frame in speech.finish():
+                    yield json.dumps(audio_frame) + "\n"
+                audio_id, audio_response_b64 = None, None
+            else:
+                logger.info("Generating final audio response...")
+                audio_id, audio_response_b64 = await tts_service.respond(final_response_for_tts, chat_request.audio_by_reference)
 
             if current_member_id:
-                 summary = await generate_chat_summary(session["messages"], openai_api_key)
-                 save_chat_history(current_member_id, session["messages"], summary, chat_request.session_id)
+                 save_chat_history(current_member_id, session["messages"], session_id=chat_request.session_id)
+                 chat_summary_queue.submit(current_member_id, chat_request.session_id, session["messages"], openai_api_key)
 
             session_manager.update_session(chat_request.session_id, {"messages": session["messages"]})
 
+            timings = stream_timer.summary()
             complete_response = {
                 "complete": True,
                 "audio_response": audio_response_b64,
+                "audio_id": audio_id,
+                "audio_chunks": speech.emitted if speech else 0,
                 "content_type": chat_request.content_type,
-                "event_data": final_event_data_to_return
+                "event_data": final_event_data_to_return,
+                "timings": timings
             }
             yield json.dumps(complete_response) + "\n"
-            logger.info("--- Streaming finished successfully ---")
+            logger.info(f"--- Streaming finished successfully --- timings: {timings}")
 
         except Exception as e:
             logger.error(f"Lỗi nghiêm trọng trong quá trình stream: {str(e)}", exc_info=True)
@@ -3687,8 +5021,14 @@ async def chat_stream_endpoint(chat_request: ChatRequest):
             except Exception as yield_err:
                  logger.error(f"Lỗi khi gửi thông báo lỗi stream cuối cùng: {yield_err}")
         finally:
+            if speech:
+                speech.cancel()
+            for open_stream in (stream, summary_stream):
+                if open_stream is not None:
+                    await open_stream.close()
             logger.info("Đảm bảo lưu session sau khi stream kết thúc hoặc gặp lỗi.")
             session_manager.update_session(chat_request.session_id, {"messages": session.get("messages", [])})
+            session_manager.unpin(chat_request.session_id)
 
     # Return the StreamingResponse object
     return StreamingResponse(
@@ -3701,7 +5041,7 @@ async def get_weather(
     location: Optional[str] = None,
     lat: Optional[float] = None,
     lon: Optional[float] = None,
-    type: str = "current",  # "current" hoặc "forecast"
+    type: str = "current",  # "current", "forecast" hoặc "all" (cả hai)
     lang: str = "vi"
 ):
     """Lấy thông tin thời tiết từ OpenWeatherMap."""
@@ -3714,22 +5054,22 @@ async def get_weather(
     # Ưu tiên địa điểm, sau đó đến tọa độ
     if location:
         logger.info(f"API call: Sử dụng địa điểm: {location}")
-        if type == "current":
-            result = await weather_service.get_current_weather(location=location, lang=lang)
-        else:
-            result = await weather_service.get_forecast(location=location, lang=lang)
+        place = {"location": location}
     elif lat is not None and lon is not None:
         logger.info(f"API call: Sử dụng tọa độ: lat={lat}, lon={lon}")
-        if type == "current":
-            result = await weather_service.get_current_weather(lat=lat, lon=lon, lang=lang)
-        else:
-            result = await weather_service.get_forecast(lat=lat, lon=lon, lang=lang)
+        place = {"lat": lat, "lon": lon}
     else:
         logger.info("API call: Không có địa điểm/tọa độ, sử dụng mặc định Hà Nội")
-        if type == "current":
-            result = await weather_service.get_current_weather(location="Hanoi", lang=lang)
-        else:
-            result = await weather_service.get_forecast(location="Hanoi", lang=lang)
+        place = {"location": "Hanoi"}
+
+    if type == "current":
+        result = await weather_service.get_current_weather(**place, lang=lang)
+    elif type == "all":
+        # Hiện tại + dự báo trong một lần gọi, hai request chạy song song
+        current_weather, forecast = await weather_service.get_bundle(**place, lang=lang)
+        result = {**current_weather, "forecast": forecast["forecast"]} if current_weather and forecast else None
+    else:
+        result = await weather_service.get_forecast(**place, lang=lang)
         
     if not result:
         raise HTTPException(status_code=500, detail="Không thể lấy dữ liệu thời tiết")
@@ -3738,39 +5078,133 @@ async def get_weather(
 
 # ------- Other Helper Functions --------
 
+# --- Upload Handling ---
+# Phần multipart ngoài nội dung file (boundary, header, các field form khác)
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_SIZE_LIMITS = {
+    "/transcribe_audio": AUDIO_UPLOAD_MAX_BYTES,
+    "/analyze_image": IMAGE_UPLOAD_MAX_BYTES,
+}
+upload_semaphore = asyncio.Semaphore(UPLOAD_MAX_CONCURRENCY)
+
+def check_upload_size(file: UploadFile, max_bytes):
+    """Kiểm tra kích thước file đã được Starlette spool (bộ nhớ/đĩa) mà không đọc nội dung vào RAM."""
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    if size > max_bytes:
+        runtime_metrics.incr("upload.rejected_too_large")
+        raise HTTPException(status_code=413, detail=f"File tải lên vượt quá {max_bytes // (1024 * 1024)} MB.")
+    runtime_metrics.incr("upload.bytes", size)
+    return size
+
+def cleanup_temp_dir(max_age=TEMP_FILE_MAX_AGE):
+    """
+    Xóa file/thư mục trong TEMP_DIR cũ hơn max_age giây. Trả về số mục đã xóa.
+    Upload không còn ghi file có tên vào TEMP_DIR (spool tràn xuống đĩa là file ẩn danh, tự mất khi đóng),
+    nên chỉ cần dọn một lần khi khởi động: file sót lại từ phiên bản cũ hoặc từ process bị kill.
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    try:
+        entries = list(os.scandir(TEMP_DIR))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError as e:
+            logger.warning(f"Không thể xóa file tạm {entry.path}: {e}")
+    if removed:
+        logger.info(f"Đã dọn {removed} file tạm cũ trong {TEMP_DIR}")
+    return removed
+
 # --- Audio Processing ---
-def process_audio(message_dict, api_key):
-    """Chuyển đổi audio base64 sang text dùng Whisper."""
+TRANSCRIPTION_MODEL = "whisper-1"
+transcription_cache = TTLCache("transcription", max_size=TRANSCRIPTION_CACHE_SIZE, ttl_seconds=TRANSCRIPTION_CACHE_TTL)
+transcription_flight = SingleFlight("transcription")
+
+def spool_audio_copy(audio_file):
+    """
+    Sao chép file audio đã spool vào một spool riêng (tràn xuống TEMP_DIR khi lớn) và tính SHA-256
+    trong cùng một lượt đọc theo khối. Chạy trong thread.
+    """
+    digest = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, dir=TEMP_DIR)
+    audio_file.seek(0)
+    for chunk in iter(lambda: audio_file.read(1024 * 1024), b""):
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return digest.hexdigest(), spool
+
+async def transcribe_audio_cached(api_key, filename, audio):
+    """Chuyển audio (bytes hoặc file) thành text qua Whisper; audio trùng nội dung dùng lại transcript đã có.
+
+    Các upload giống hệt nhau (cùng API key) đang chạy đồng thời chỉ gọi Whisper một lần. Tác vụ
+    dùng chung đọc bản sao riêng của audio, không đọc UploadFile của request dẫn đầu (Starlette
+    đóng file đó khi client ngắt kết nối). Chỉ transcript thành công được cache.
+    """
+    if isinstance(audio, (bytes, bytearray)):
+        digest, spool = await asyncio.to_thread(lambda: hashlib.sha256(audio).hexdigest()), None
+    else:
+        digest, spool = await asyncio.to_thread(spool_audio_copy, audio)
+    owned_by_flight = False
+    try:
+        cache_key = f"{TRANSCRIPTION_MODEL}|{digest}"
+        cached_text = transcription_cache.get(cache_key)
+        if cached_text is not None:
+            return cached_text
+
+        async def transcribe():
+            try:
+                async with upload_semaphore:
+                    transcript = await create_transcription(api_key, model=TRANSCRIPTION_MODEL,
+                                                            file=(filename, spool if spool is not None else bytes(audio)))
+            finally:
+                if spool is not None:
+                    spool.close()
+            transcription_cache.set(cache_key, transcript.text)
+            return transcript.text
+
+        def start_transcribe():
+            # Chỉ được gọi cho request dẫn đầu: từ đây tác vụ dùng chung sở hữu (và đóng) spool
+            nonlocal owned_by_flight
+            owned_by_flight = True
+            return transcribe()
+
+        return await transcription_flight.do(f"{cache_key}|{api_key_scope(api_key)}", start_transcribe)
+    finally:
+        if spool is not None and not owned_by_flight:
+            spool.close()
+
+async def process_audio(message_dict, api_key):
+    """Chuyển đổi audio base64 sang text dùng Whisper (gửi thẳng bytes, không ghi file tạm)."""
     try:
         if not message_dict.get("audio_data"):
             logger.error("process_audio: Thiếu audio_data.")
             return None
+        if len(message_dict["audio_data"]) * 3 // 4 > AUDIO_UPLOAD_MAX_BYTES:
+            logger.error(f"process_audio: Audio vượt quá {AUDIO_UPLOAD_MAX_BYTES} bytes.")
+            runtime_metrics.incr("upload.rejected_too_large")
+            return None
         audio_data = base64.b64decode(message_dict["audio_data"])
 
-        temp_audio_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}.wav") # Assume wav for simplicity
+        text = await transcribe_audio_cached(api_key, "audio.wav", audio_data) # Assume wav for simplicity
 
-        with open(temp_audio_path, "wb") as f:
-            f.write(audio_data)
-
-        client = OpenAI(api_key=api_key)
-        with open(temp_audio_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-            )
-
-        os.remove(temp_audio_path)
-
-        return {"type": "text", "text": transcript.text}
+        return {"type": "text", "text": text}
 
     except base64.binascii.Error as b64_err:
         logger.error(f"Lỗi giải mã Base64 audio: {b64_err}")
         return None
     except Exception as e:
         logger.error(f"Lỗi khi xử lý audio: {e}", exc_info=True)
-        if 'temp_audio_path' in locals() and os.path.exists(temp_audio_path):
-             try: os.remove(temp_audio_path)
-             except OSError: pass
         return None
 
 # --- System Prompt Builder ---
@@ -3847,9 +5281,394 @@ def build_system_prompt(current_member_id=None):
     return "\n".join(system_prompt_parts)
 
 
+# --- Context Window Builder ---
+# Ước lượng offline (không cần tokenizer): ~4 ký tự ASCII/token, ký tự có dấu/Unicode tốn nhiều token hơn
+CONTEXT_MESSAGE_OVERHEAD_TOKENS = 4
+CONTEXT_IMAGE_TOKENS = 765 # Ảnh detail=auto cỡ trung bình
+STRIPPED_IMAGE_PLACEHOLDER = "[Hình ảnh đã gửi ở lượt trước]"
+
+context_summary_cache = TTLCache("context_summary", max_size=CONTEXT_SUMMARY_CACHE_SIZE, ttl_seconds=24 * 3600)
+context_summary_flight = SingleFlight("context_summary")
+_context_summary_tasks = set()
+
+
+def estimate_text_tokens(text):
+    """Ước lượng số token của một chuỗi mà không cần tokenizer."""
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return int((len(text) - non_ascii) / 4 + non_ascii / 2) + 1
+
+
+def estimate_message_tokens(message):
+    """Ước lượng token của một message dạng API (content chuỗi/list, tool_calls)."""
+    tokens = CONTEXT_MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_text_tokens(content)
+    elif isinstance(content, list):
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            if item.get("type") == "image_url":
+                tokens += CONTEXT_IMAGE_TOKENS
+            else:
+                tokens += estimate_text_tokens(item.get("text", ""))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {}) if isinstance(tool_call, dict) else {}
+        tokens += estimate_text_tokens(function.get("name", "")) + estimate_text_tokens(function.get("arguments", ""))
+    return tokens
+
+
+def session_message_for_api(msg):
+    """Chuyển một tin nhắn trong session thành message gửi OpenAI."""
+    message_for_api = {
+        "role": msg["role"],
+        **({ "tool_calls": msg["tool_calls"] } if msg.get("tool_calls") else {}),
+        **({ "tool_call_id": msg.get("tool_call_id") } if msg.get("tool_call_id") else {}),
+    }
+    msg_content = msg.get("content")
+    if isinstance(msg_content, (list, str)):
+        message_for_api["content"] = msg_content
+    elif msg.get("role") == "tool":
+        message_for_api["content"] = str(msg_content) if msg_content is not None else ""
+    else:
+        if msg_content is not None:
+            logger.warning(f"Định dạng content không mong đợi cho role {msg['role']}: {type(msg_content)}. Sử dụng chuỗi rỗng.")
+        message_for_api["content"] = ""
+    return message_for_api
+
+
+def strip_image_content(message):
+    """Thay ảnh (base64 image_url) trong message bằng placeholder text."""
+    content = message.get("content")
+    if not isinstance(content, list) or not any(isinstance(item, dict) and item.get("type") == "image_url" for item in content):
+        return message
+    stripped = dict(message)
+    stripped["content"] = [
+        {"type": "text", "text": STRIPPED_IMAGE_PLACEHOLDER} if isinstance(item, dict) and item.get("type") == "image_url" else item
+        for item in content
+    ]
+    return stripped
+
+
+def split_into_turns(messages):
+    """Chia danh sách tin nhắn thành các lượt, mỗi lượt bắt đầu bằng một tin nhắn user.
+
+    Tin nhắn assistant (kèm tool_calls) và tool luôn nằm cùng lượt nên cắt theo lượt
+    không bao giờ tách tool khỏi tool_calls tương ứng.
+    """
+    turns = []
+    for index, msg in enumerate(messages):
+        if msg.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append((index, msg))
+    return turns
+
+
+def drop_orphan_tool_messages(messages):
+    """Bỏ tool message không có tool_call tương ứng phía trước (OpenAI sẽ từ chối request)."""
+    known_call_ids = set()
+    result = []
+    for message in messages:
+        for tool_call in message.get("tool_calls") or []:
+            if isinstance(tool_call, dict) and tool_call.get("id"):
+                known_call_ids.add(tool_call["id"])
+        if message.get("role") == "tool" and message.get("tool_call_id") not in known_call_ids:
+            continue
+        result.append(message)
+    return result
+
+
+def context_summary_fingerprint(messages, covered):
+    """Dấu vân tay phần lịch sử đã được tóm tắt, để phát hiện session bị ghi đè lịch sử."""
+    if covered <= 0:
+        return ""
+    return hashlib.sha256(json.dumps(messages[covered - 1], sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+async def generate_context_summary(previous_summary, messages, api_key):
+    """Gộp các tin nhắn cũ vào bản tóm tắt ngữ cảnh hiện có."""
+    conversation_text = conversation_text_for_summary(messages)
+    if not conversation_text:
+        return previous_summary or ""
+    response = await create_chat_completion(
+        api_key,
+        model=openai_model,
+        messages=[
+            {"role": "system", "content": "Bạn duy trì bản tóm tắt ngữ cảnh của một cuộc trò chuyện giữa gia đình và trợ lý. Cập nhật bản tóm tắt hiện có với các tin nhắn mới: giữ lại tên người, ngày giờ, sự kiện/ghi chú đã tạo hoặc sửa, yêu cầu còn dang dở. Viết ngắn gọn bằng tiếng Việt."},
+            {"role": "user", "content": f"Tóm tắt hiện có:\n{previous_summary or '(chưa có)'}\n\nTin nhắn mới:\n{conversation_text}"}
+        ],
+        temperature=0.2,
+        max_tokens=CONTEXT_SUMMARY_MAX_TOKENS
+    )
+    return response.choices[0].message.content.strip()
+
+
+def schedule_context_summary(session_id, messages, covered_until, api_key):
+    """Cập nhật tóm tắt cuốn chiếu ở nền cho phần lịch sử [0, covered_until) — không chặn request."""
+    async def refresh():
+        cached = context_summary_cache.get(session_id)
+        previous_summary, covered = "", 0
+        if cached and cached["fingerprint"] == context_summary_fingerprint(messages, cached["covered"]):
+            previous_summary, covered = cached["summary"], cached["covered"]
+        if covered >= covered_until:
+            return
+        try:
+            summary = await generate_context_summary(previous_summary, messages[covered:covered_until], api_key)
+        except Exception as e:
+            logger.error(f"Lỗi khi tóm tắt ngữ cảnh cho session {session_id}: {e}", exc_info=True)
+            return
+        runtime_metrics.incr("context.summary_refreshed")
+        context_summary_cache.set(session_id, {
+            "summary": summary,
+            "covered": covered_until,
+            "fingerprint": context_summary_fingerprint(messages, covered_until),
+        })
+
+    task = asyncio.ensure_future(context_summary_flight.do(session_id, refresh))
+    _context_summary_tasks.add(task)
+    task.add_done_callback(_context_summary_tasks.discard)
+
+
+def build_context_messages(system_prompt, session_id, session_messages, api_key, token_budget=CONTEXT_TOKEN_BUDGET,
+                           recent_turns=CONTEXT_RECENT_TURNS):
+    """Dựng danh sách messages gửi OpenAI trong giới hạn token.
+
+    - Giữ nguyên văn các lượt gần nhất (ít nhất lượt hiện tại), thêm dần lượt cũ hơn khi còn ngân sách.
+    - Ảnh chỉ giữ ở lượt hiện tại; các lượt trước thay bằng placeholder.
+    - Các lượt bị cắt được thay bằng tóm tắt cuốn chiếu lấy từ cache; việc cập nhật tóm tắt chạy ở nền.
+    """
+    messages = [session_message_for_api(msg) for msg in session_messages]
+    turns = split_into_turns(messages)
+    if not turns:
+        return [{"role": "system", "content": system_prompt}]
+
+    budget = token_budget - estimate_text_tokens(system_prompt) - CONTEXT_MESSAGE_OVERHEAD_TOKENS
+    kept_turns = []
+    used_tokens = 0
+    for position, turn in enumerate(reversed(turns)):
+        if position > 0:
+            turn = [(index, strip_image_content(msg)) for index, msg in turn]
+        turn_tokens = sum(estimate_message_tokens(msg) for _, msg in turn)
+        if position > 0 and used_tokens + turn_tokens > budget:
+            # Lượt gần đây vẫn được giữ nếu chưa đủ recent_turns, trừ khi lượt đó một mình đã vượt ngân sách
+            if position >= recent_turns or turn_tokens > budget:
+                break
+        kept_turns.insert(0, turn)
+        used_tokens += turn_tokens
+
+    first_kept_index = kept_turns[0][0][0]
+    context_messages = [{"role": "system", "content": system_prompt}]
+    if first_kept_index > 0:
+        runtime_metrics.incr("context.trimmed")
+        cached = context_summary_cache.get(session_id)
+        if cached and cached["covered"] <= first_kept_index and cached["fingerprint"] == context_summary_fingerprint(messages, cached["covered"]):
+            context_messages.append({"role": "system", "content": f"Tóm tắt các lượt trò chuyện trước đó:\n{cached['summary']}"})
+        if api_key and (not cached or cached["covered"] < first_kept_index):
+            schedule_context_summary(session_id, messages, first_kept_index, api_key)
+
+    context_messages.extend(resolve_message_blobs(drop_orphan_tool_messages([msg for turn in kept_turns for _, msg in turn])))
+    logger.info(f"Ngữ cảnh: {len(context_messages)}/{len(messages) + 1} messages, ~{used_tokens} tokens lịch sử (ngân sách {token_budget})")
+    return context_messages
+
+
 # --- Search & Summarize Helpers ---
-async def check_search_need(messages: List[Dict], openai_api_key: str, tavily_api_key: str, lat: Optional[float] = None, lon: Optional[float] = None) -> str:
-    """Kiểm tra nhu cầu tìm kiếm từ tin nhắn cuối của người dùng."""
+# --- Rule-based intent fast path ---
+# Tên địa điểm thường gặp -> tên dùng cho OpenWeatherMap
+KNOWN_CITY_MAP = {
+    "hà nội": "Hanoi", "ha noi": "Hanoi", "hanoi": "Hanoi",
+    "sài gòn": "Ho Chi Minh City", "saigon": "Ho Chi Minh City", "hồ chí minh": "Ho Chi Minh City",
+    "tp hcm": "Ho Chi Minh City", "tphcm": "Ho Chi Minh City", "hcm": "Ho Chi Minh City",
+    "đà nẵng": "Da Nang", "da nang": "Da Nang", "hải phòng": "Hai Phong", "cần thơ": "Can Tho",
+    "huế": "Hue", "nha trang": "Nha Trang", "đà lạt": "Da Lat", "vũng tàu": "Vung Tau",
+    "hạ long": "Ha Long", "sa pa": "Sa Pa", "sapa": "Sa Pa", "phú quốc": "Phu Quoc",
+    "quy nhơn": "Quy Nhon", "hội an": "Hoi An", "buôn ma thuột": "Buon Ma Thuot",
+}
+
+def _keyword_pattern(keywords):
+    """Regex khớp bất kỳ từ khóa nào như một cụm từ riêng lẻ (ưu tiên cụm dài hơn)."""
+    alternatives = sorted({kw.lower() for kw in keywords if kw}, key=len, reverse=True)
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(kw) for kw in alternatives) + r")(?!\w)")
+
+KNOWN_CITY_PATTERN = _keyword_pattern(KNOWN_CITY_MAP)
+WEATHER_QUERY_PATTERN = re.compile(r"(?<!\w)(?:thời tiết|nhiệt độ|mấy độ|bao nhiêu độ|độ ẩm|trời (?:có )?(?:mưa|nắng|lạnh|nóng|rét))(?!\w)")
+WEATHER_ADVICE_PATTERN = re.compile(r"(?<!\w)(?:nên|có nên|mặc gì|mặc áo|mang theo|mang gì|mang ô|chuẩn bị|đi chơi|đi đâu|làm gì|tư vấn)(?!\w)")
+WEATHER_DATE_PATTERN = re.compile(
+    r"(?<!\w)(hôm nay|ngày mai|ngày kia|cuối tuần(?: này| sau| tới)?|tuần (?:này|sau|tới)"
+    r"|(?:thứ\s*(?:[2-7]|hai|ba|tư|năm|sáu|bảy)|chủ nhật)(?: tuần (?:này|sau|tới))?|\d{1,2}/\d{1,2}(?:/\d{2,4})?)(?!\w)"
+)
+AMBIGUOUS_DATE_PATTERN = re.compile(r"(?<!\w)(?:mai|mốt|tối nay|sáng nay|chiều nay|đêm nay|tháng)(?!\w)")
+SEARCH_HINT_PATTERN = re.compile(
+    r"(?<!\w)(?:tin tức|thời sự|tin mới|mới nhất|giá|tỷ giá|kết quả|là ai|là gì|ở đâu|bao nhiêu|xổ số|chứng khoán"
+    r"|bóng đá|trận|phong thủy|ngày tốt|ngày đẹp|thuận lợi|tìm|tra cứu|review|so sánh)(?!\w)"
+)
+SMALL_TALK_PATTERN = re.compile(
+    r"^(?:xin chào|chào(?: bạn| trợ lý)?|hi|hello|hey|alo|cảm ơn(?: bạn)?|cám ơn|thanks|thank you|ok|oke|okay|"
+    r"tạm biệt|bye|tốt lắm|hay quá|được rồi|vâng|dạ|ừ)[\s!.?~]*$"
+)
+EVENT_ACTION_PATTERN = re.compile(r"^(?:thêm|tạo|đặt|lên lịch|xóa|xoá|sửa|cập nhật|đổi|dời|hủy|huỷ|ghi chú|ghi lại|lưu|nhắc)(?!\w)")
+EVENT_SUBJECT_PATTERN = _keyword_pattern(
+    ["lịch", "sự kiện", "cuộc hẹn", "ghi chú", "công việc"]
+    + [kw for keywords in EVENT_CATEGORIES.values() for kw in keywords]
+    + RECURRING_KEYWORDS
+)
+
+def classify_query_locally(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Phân loại bằng luật cho các trường hợp rõ ràng, không cần gọi LLM:
+    - Chào hỏi hoặc lệnh quản lý lịch/ghi chú -> không cần thời tiết/tìm kiếm
+    - Hỏi thời tiết (không phải tư vấn) có địa điểm đã biết -> thời tiết
+
+    Returns:
+        Dict {"intent", "result"} cùng định dạng với route_search_intent, hoặc None nếu chưa rõ ràng
+    """
+    normalized = " ".join(text.lower().split())
+    if not normalized:
+        return None
+
+    has_weather_keyword = any(keyword in normalized for keyword in WEATHER_KEYWORDS_FOR_DETECTION)
+    has_search_hint = SEARCH_HINT_PATTERN.search(normalized) is not None
+
+    if not has_weather_keyword and not has_search_hint:
+        if SMALL_TALK_PATTERN.match(normalized):
+            return {"intent": None, "result": None}
+        if EVENT_ACTION_PATTERN.match(normalized) and EVENT_SUBJECT_PATTERN.search(normalized):
+            return {"intent": None, "result": None}
+        return None
+
+    if (WEATHER_QUERY_PATTERN.search(normalized) and not has_search_hint
+            and not WEATHER_ADVICE_PATTERN.search(normalized)):
+        cities = {KNOWN_CITY_MAP[match] for match in KNOWN_CITY_PATTERN.findall(normalized)}
+        dates = WEATHER_DATE_PATTERN.findall(normalized)
+        remainder = WEATHER_DATE_PATTERN.sub(" ", normalized)
+        if len(cities) == 1 and len(dates) <= 1 and not AMBIGUOUS_DATE_PATTERN.search(remainder):
+            return {"intent": "weather", "result": (True, cities.pop(), dates[0] if dates else None)}
+    return None
+
+# Thứ tự ưu tiên khi nhiều bộ phân loại cùng trả về dương tính
+INTENT_PRIORITY = ("advice", "weather", "search")
+
+async def route_search_intent(last_user_text: str, openai_api_key: str, tavily_api_key: str):
+    """
+    Async generator trả về lần lượt các ý định dương tính theo INTENT_PRIORITY (tư vấn thời tiết,
+    thời tiết, tìm kiếm). Mọi bộ phân loại được chạy song song ngay từ đầu; bộ ưu tiên thấp hơn vẫn
+    tiếp tục chạy sau khi một ý định được trả về (người gọi có thể xin ý định kế tiếp nếu ý định trước
+    không lấy được dữ liệu) và chỉ bị huỷ khi người gọi đóng generator.
+
+    Yields:
+        Dict {"intent": tên, "result": tuple kết quả của bộ phân loại, "timings": ms theo tên}
+    """
+    if INTENT_FAST_PATH:
+        decision = classify_query_locally(last_user_text)
+        if decision is not None:
+            if decision["intent"] == "weather" and not OPENWEATHERMAP_API_KEY:
+                # Không có API thời tiết: câu hỏi thời tiết cũng không cần tìm kiếm web
+                decision = {"intent": None, "result": None}
+            runtime_metrics.incr("intent_fast_path.hit")
+            runtime_metrics.incr(f"intent_router.selected.{decision['intent'] or 'none'}")
+            if decision["intent"]:
+                decision["timings"] = {"fast_path": 0.0}
+                yield decision
+            return
+        runtime_metrics.incr("intent_fast_path.miss")
+
+    if INTENT_ROUTER_MODE == "unified":
+        async for decision in route_search_intent_unified(last_user_text, openai_api_key, tavily_api_key):
+            yield decision
+        return
+
+    classifiers = {}
+    if OPENWEATHERMAP_API_KEY:
+        classifiers["advice"] = WeatherAdvisor.detect_weather_advice_need(last_user_text, openai_api_key)
+        classifiers["weather"] = WeatherQueryParser.parse_weather_query(last_user_text, openai_api_key)
+    if tavily_api_key:
+        classifiers["search"] = detect_search_intent(last_user_text, openai_api_key)
+    names = [name for name in INTENT_PRIORITY if name in classifiers]
+
+    timings = {}
+
+    async def timed(name, coro):
+        started = time.perf_counter()
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            timings[name] = None
+            runtime_metrics.incr(f"intent_router.{name}.cancelled")
+            raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        timings[name] = round(elapsed_ms, 1)
+        runtime_metrics.observe(f"intent_router.{name}", elapsed_ms)
+        return result
+
+    started = time.perf_counter()
+    # Chạy mọi bộ phân loại cùng lúc; kết quả được xét theo thứ tự ưu tiên
+    tasks = {name: asyncio.create_task(timed(name, classifiers[name])) for name in names}
+    selected = False
+    try:
+        for name in names:
+            try:
+                result = await tasks[name]
+            except Exception as e:
+                logger.error(f"Bộ phân loại '{name}' lỗi: {e}", exc_info=True)
+                continue
+            if result and result[0]:
+                if not selected:
+                    runtime_metrics.observe("intent_router.total", (time.perf_counter() - started) * 1000)
+                selected = True
+                runtime_metrics.incr(f"intent_router.selected.{name}")
+                # Các bộ phân loại ưu tiên thấp hơn vẫn chạy tiếp, phòng khi ý định này không lấy được dữ liệu
+                yield {"intent": name, "result": result, "timings": dict(timings)}
+    finally:
+        # Người gọi đã có dữ liệu (đóng generator) hoặc đã xét hết: huỷ các bộ phân loại còn chạy
+        pending = [task for task in tasks.values() if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if not selected:
+        runtime_metrics.observe("intent_router.total", (time.perf_counter() - started) * 1000)
+        runtime_metrics.incr("intent_router.selected.none")
+
+async def route_search_intent_unified(last_user_text: str, openai_api_key: str, tavily_api_key: str):
+    """Như route_search_intent nhưng dùng một lời gọi detect_query_intent; trả về cùng định dạng."""
+    started = time.perf_counter()
+    intent = await detect_query_intent(last_user_text, openai_api_key)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    runtime_metrics.observe("intent_router.unified", elapsed_ms)
+    runtime_metrics.observe("intent_router.total", elapsed_ms)
+
+    candidates = {}
+    if intent:
+        if OPENWEATHERMAP_API_KEY:
+            if intent["is_advice_query"]:
+                candidates["advice"] = (True, intent["advice_type"], intent["location"], intent["date_description"])
+            if intent["is_weather_query"]:
+                candidates["weather"] = (True, intent["location"], intent["date_description"])
+        if tavily_api_key and intent["need_search"]:
+            candidates["search"] = (True, intent["search_query"], intent["is_news_query"], intent["is_feng_shui_query"])
+    if not candidates:
+        runtime_metrics.incr("intent_router.selected.none")
+    for name in INTENT_PRIORITY:
+        if name in candidates:
+            runtime_metrics.incr(f"intent_router.selected.{name}")
+            yield {"intent": name, "result": candidates[name], "timings": {"unified": round(elapsed_ms, 1)}}
+
+async def emit_progress(progress, event: Dict[str, Any]):
+    """Gửi một frame tiến trình qua callback (nếu có); lỗi của callback không làm hỏng luồng chính."""
+    if progress is None:
+        return
+    try:
+        await progress(event)
+    except Exception as e:
+        logger.warning(f"Lỗi khi gửi tiến trình {list(event)}: {e}")
+
+async def check_search_need(messages: List[Dict], openai_api_key: str, tavily_api_key: str, lat: Optional[float] = None, lon: Optional[float] = None, progress=None) -> str:
+    """
+    Kiểm tra nhu cầu tìm kiếm từ tin nhắn cuối của người dùng.
+    progress: callback async nhận các frame tiến trình tìm kiếm (dùng cho /chat/stream).
+    """
     if not tavily_api_key and not OPENWEATHERMAP_API_KEY: 
         return ""  # Need Tavily for web search or OpenWeatherMap for weather
 
@@ -3876,184 +5695,182 @@ async def check_search_need(messages: List[Dict], openai_api_key: str, tavily_ap
 
     logger.info(f"Checking search need for: '{last_user_text[:100]}...'")
 
-    # Check for Weather Advice Query (new)
-    if OPENWEATHERMAP_API_KEY:
-        is_advice_query, advice_type, location, date_description = await WeatherAdvisor.detect_weather_advice_need(
-            last_user_text, openai_api_key
-        )
+    decisions = route_search_intent(last_user_text, openai_api_key, tavily_api_key)
+    try:
+        async for decision in decisions:
+            logger.info(f"Intent router chọn: {decision['intent']} (thời gian phân loại ms: {decision['timings']})")
+
+            # Check for Weather Advice Query (new)
+            if decision["intent"] == "advice":
+                _, advice_type, location, date_description = decision["result"]
+                # Đảm bảo luôn có location (mặc định là Hà Nội)
+                if not location:
+                    location = "Hanoi"
+            
+                logger.info(f"Phát hiện truy vấn tư vấn thời tiết: type={advice_type}, location={location}, date={date_description}")
+                weather_service = WeatherService(OPENWEATHERMAP_API_KEY)
         
-        if is_advice_query:
-            # Đảm bảo luôn có location (mặc định là Hà Nội)
-            if not location:
-                location = "Hanoi"
-                
-            logger.info(f"Phát hiện truy vấn tư vấn thời tiết: type={advice_type}, location={location}, date={date_description}")
-            weather_service = WeatherService(OPENWEATHERMAP_API_KEY)
+                # Lấy dữ liệu thời tiết
+                if date_description:
+                    # Sử dụng DateTimeHandler để phân tích ngày
+                    target_date = DateTimeHandler.parse_date(date_description)
             
-            # Lấy dữ liệu thời tiết
-            if date_description:
-                # Sử dụng DateTimeHandler để phân tích ngày
-                target_date = DateTimeHandler.parse_date(date_description)
+                    current_weather, forecast, target_date, date_text = await WeatherQueryParser.get_forecast_for_specific_date(
+                        weather_service, location, date_description, lat, lon
+                    )
+            
+                    if current_weather and forecast:
+                        # Kết hợp lời khuyên dựa trên loại truy vấn và dữ liệu thời tiết
+                        advice_data = WeatherAdvisor.combine_advice(
+                            {"current": current_weather.get("current"), "forecast": forecast.get("forecast")}, 
+                            target_date,
+                            advice_type
+                        )
+                        # Định dạng lời khuyên để đưa vào prompt - truyền thêm location
+                        advice_text = WeatherAdvisor.format_advice_for_prompt(advice_data, advice_type, location)
                 
-                current_weather, forecast, target_date, date_text = await WeatherQueryParser.get_forecast_for_specific_date(
-                    weather_service, location, date_description, lat, lon
-                )
+                        advice_prompt_addition = f"""
+                        \n\n--- TƯ VẤN THỜI TIẾT (DÙNG ĐỂ TRẢ LỜI) ---
+                        Người dùng hỏi: "{last_user_text}"
                 
-                if current_weather and forecast:
-                    # Kết hợp lời khuyên dựa trên loại truy vấn và dữ liệu thời tiết
-                    advice_data = WeatherAdvisor.combine_advice(
-                        {"current": current_weather.get("current"), "forecast": forecast.get("forecast")}, 
-                        target_date,
-                        advice_type
-                    )
-                    # Định dạng lời khuyên để đưa vào prompt - truyền thêm location
-                    advice_text = WeatherAdvisor.format_advice_for_prompt(advice_data, advice_type, location)
-                    
-                    advice_prompt_addition = f"""
-                    \n\n--- TƯ VẤN THỜI TIẾT (DÙNG ĐỂ TRẢ LỜI) ---
-                    Người dùng hỏi: "{last_user_text}"
-                    
-                    {advice_text}
-                    --- KẾT THÚC TƯ VẤN THỜI TIẾT ---
-                    
-                    Hãy sử dụng thông tin tư vấn trên để trả lời câu hỏi của người dùng một cách tự nhiên và hữu ích.
-                    Đưa ra lời khuyên chi tiết, cụ thể và phù hợp với tình hình thời tiết hiện tại/dự báo tại {location}.
-                    """
-                    return advice_prompt_addition
-            else:
-                # Sử dụng thời tiết hiện tại
-                # Đảm bảo luôn có location
-                if not location or location.lower() in ["hanoi", "hà nội"]:
-                    if lat is not None and lon is not None:
-                        weather_data = await weather_service.get_current_weather(lat=lat, lon=lon)
-                        forecast_data = await weather_service.get_forecast(lat=lat, lon=lon, days=3)
-                    else:
-                        location = "Hanoi"
-                        weather_data = await weather_service.get_current_weather(location=location)
-                        forecast_data = await weather_service.get_forecast(location=location, days=3)
+                        {advice_text}
+                        --- KẾT THÚC TƯ VẤN THỜI TIẾT ---
+                
+                        Hãy sử dụng thông tin tư vấn trên để trả lời câu hỏi của người dùng một cách tự nhiên và hữu ích.
+                        Đưa ra lời khuyên chi tiết, cụ thể và phù hợp với tình hình thời tiết hiện tại/dự báo tại {location}.
+                        """
+                        return advice_prompt_addition
                 else:
-                    weather_data = await weather_service.get_current_weather(location=location)
-                    forecast_data = await weather_service.get_forecast(location=location, days=3)
+                    # Sử dụng thời tiết hiện tại
+                    # Đảm bảo luôn có location
+                    if not location or location.lower() in ["hanoi", "hà nội"]:
+                        if lat is not None and lon is not None:
+                            weather_data, forecast_data = await weather_service.get_bundle(lat=lat, lon=lon, days=3)
+                        else:
+                            location = "Hanoi"
+                            weather_data, forecast_data = await weather_service.get_bundle(location=location, days=3)
+                    else:
+                        weather_data, forecast_data = await weather_service.get_bundle(location=location, days=3)
+            
+                    if weather_data:
+                        # Kết hợp lời khuyên dựa trên loại truy vấn và dữ liệu thời tiết
+                        advice_data = WeatherAdvisor.combine_advice(
+                            {"current": weather_data.get("current"), "forecast": forecast_data.get("forecast")}, 
+                            None,
+                            advice_type
+                        )
+                        # Định dạng lời khuyên để đưa vào prompt - truyền thêm location
+                        advice_text = WeatherAdvisor.format_advice_for_prompt(advice_data, advice_type, location)
                 
-                if weather_data:
-                    # Kết hợp lời khuyên dựa trên loại truy vấn và dữ liệu thời tiết
-                    advice_data = WeatherAdvisor.combine_advice(
-                        {"current": weather_data.get("current"), "forecast": forecast_data.get("forecast")}, 
-                        None,
-                        advice_type
-                    )
-                    # Định dạng lời khuyên để đưa vào prompt - truyền thêm location
-                    advice_text = WeatherAdvisor.format_advice_for_prompt(advice_data, advice_type, location)
-                    
-                    advice_prompt_addition = f"""
-                    \n\n--- TƯ VẤN THỜI TIẾT (DÙNG ĐỂ TRẢ LỜI) ---
-                    Người dùng hỏi: "{last_user_text}"
-                    
-                    {advice_text}
-                    --- KẾT THÚC TƯ VẤN THỜI TIẾT ---
-                    
-                    Hãy sử dụng thông tin tư vấn trên để trả lời câu hỏi của người dùng một cách tự nhiên và hữu ích.
-                    Đưa ra lời khuyên chi tiết, cụ thể và phù hợp với tình hình thời tiết hiện tại/dự báo tại {location}.
-                    """
-                    return advice_prompt_addition
-    
-    # Check for Weather Query
-    is_weather_query, location, date_description = await WeatherQueryParser.parse_weather_query(last_user_text, openai_api_key)
-    
-    if is_weather_query and OPENWEATHERMAP_API_KEY:
-        # Đảm bảo luôn có location (mặc định là Hà Nội)
-        if not location:
-            location = "Hanoi"
+                        advice_prompt_addition = f"""
+                        \n\n--- TƯ VẤN THỜI TIẾT (DÙNG ĐỂ TRẢ LỜI) ---
+                        Người dùng hỏi: "{last_user_text}"
+                
+                        {advice_text}
+                        --- KẾT THÚC TƯ VẤN THỜI TIẾT ---
+                
+                        Hãy sử dụng thông tin tư vấn trên để trả lời câu hỏi của người dùng một cách tự nhiên và hữu ích.
+                        Đưa ra lời khuyên chi tiết, cụ thể và phù hợp với tình hình thời tiết hiện tại/dự báo tại {location}.
+                        """
+                        return advice_prompt_addition
+
+            # Check for Weather Query
+            if decision["intent"] == "weather":
+                _, location, date_description = decision["result"]
+                # Đảm bảo luôn có location (mặc định là Hà Nội)
+                if not location:
+                    location = "Hanoi"
             
-        logger.info(f"Phát hiện truy vấn thời tiết cho địa điểm: '{location}', thời gian: '{date_description}'")
-        weather_service = WeatherService(OPENWEATHERMAP_API_KEY)
+                logger.info(f"Phát hiện truy vấn thời tiết cho địa điểm: '{location}', thời gian: '{date_description}'")
+                weather_service = WeatherService(OPENWEATHERMAP_API_KEY)
         
-        # Xử lý truy vấn có cả địa điểm và thời gian (dùng DateTimeHandler)
-        if date_description:
-            current_weather, forecast, target_date, date_text = await WeatherQueryParser.get_forecast_for_specific_date(
-                weather_service, location, date_description, lat, lon
-            )
+                # Xử lý truy vấn có cả địa điểm và thời gian (dùng DateTimeHandler)
+                if date_description:
+                    current_weather, forecast, target_date, date_text = await WeatherQueryParser.get_forecast_for_specific_date(
+                        weather_service, location, date_description, lat, lon
+                    )
             
-            if current_weather and forecast and target_date:
-                weather_info = WeatherQueryParser.format_weather_for_date(
-                    current_weather, forecast, target_date, date_text
-                )
-                logger.info(f"Đã lấy thông tin thời tiết cho '{location}' vào ngày {date_text}")
-            else:
-                logger.warning(f"Không thể lấy thông tin thời tiết cho '{location}' vào '{date_description}'")
-                weather_info = format_weather_for_prompt(current_weather, forecast)
-        else:
-            # Xử lý truy vấn chỉ có địa điểm (không có thời gian cụ thể - trả về thời tiết hiện tại)
-            if location and location.lower() not in ["hanoi", "hà nội"]:
-                logger.info(f"Sử dụng địa điểm từ câu hỏi: {location}")
-                weather_data = await weather_service.get_current_weather(location=location)
-                forecast_data = await weather_service.get_forecast(location=location, days=3)
-            elif lat is not None and lon is not None:
-                logger.info(f"Sử dụng tọa độ: lat={lat}, lon={lon}")
-                weather_data = await weather_service.get_current_weather(lat=lat, lon=lon)
-                forecast_data = await weather_service.get_forecast(lat=lat, lon=lon, days=3)
-            else:
-                logger.info("Không có địa điểm và tọa độ, sử dụng mặc định Hà Nội")
-                location = "Hanoi"
-                weather_data = await weather_service.get_current_weather(location=location)
-                forecast_data = await weather_service.get_forecast(location=location, days=3)
+                    if current_weather and forecast and target_date:
+                        weather_info = WeatherQueryParser.format_weather_for_date(
+                            current_weather, forecast, target_date, date_text
+                        )
+                        logger.info(f"Đã lấy thông tin thời tiết cho '{location}' vào ngày {date_text}")
+                    else:
+                        logger.warning(f"Không thể lấy thông tin thời tiết cho '{location}' vào '{date_description}'")
+                        weather_info = format_weather_for_prompt(current_weather, forecast)
+                else:
+                    # Xử lý truy vấn chỉ có địa điểm (không có thời gian cụ thể - trả về thời tiết hiện tại)
+                    if location and location.lower() not in ["hanoi", "hà nội"]:
+                        logger.info(f"Sử dụng địa điểm từ câu hỏi: {location}")
+                        weather_data, forecast_data = await weather_service.get_bundle(location=location, days=3)
+                    elif lat is not None and lon is not None:
+                        logger.info(f"Sử dụng tọa độ: lat={lat}, lon={lon}")
+                        weather_data, forecast_data = await weather_service.get_bundle(lat=lat, lon=lon, days=3)
+                    else:
+                        logger.info("Không có địa điểm và tọa độ, sử dụng mặc định Hà Nội")
+                        location = "Hanoi"
+                        weather_data, forecast_data = await weather_service.get_bundle(location=location, days=3)
                 
-            if not weather_data:
-                return f"\n\n--- LỖI THỜI TIẾT: Không thể lấy thông tin thời tiết cho {location}. Hãy báo lại cho người dùng. ---"
+                    if not weather_data:
+                        return f"\n\n--- LỖI THỜI TIẾT: Không thể lấy thông tin thời tiết cho {location}. Hãy báo lại cho người dùng. ---"
                 
-            weather_info = format_weather_for_prompt(weather_data, forecast_data)
+                    weather_info = format_weather_for_prompt(weather_data, forecast_data)
             
-        weather_prompt_addition = f"""
-        \n\n--- THÔNG TIN THỜI TIẾT (DÙNG ĐỂ TRẢ LỜI) ---
-        Người dùng hỏi: "{last_user_text}"
-        {weather_info}
-        --- KẾT THÚC THÔNG TIN THỜI TIẾT ---
-        Hãy sử dụng thông tin thời tiết này để trả lời câu hỏi của người dùng một cách tự nhiên.
-        Luôn đề cập rõ khu vực địa lý ({location}) trong câu trả lời.
-        Đưa ra lời khuyên phù hợp với điều kiện thời tiết nếu người dùng hỏi về việc nên mặc gì, nên đi đâu, nên làm gì, v.v.
-        """
-        return weather_prompt_addition
-
-    # Check for General Search Intent - Phần còn lại giữ nguyên
-    if tavily_api_key:
-         need_search, search_query, is_news_query, is_feng_shui_query = await detect_search_intent(last_user_text, openai_api_key)
-         if need_search:
-             logger.info(f"Phát hiện nhu cầu tìm kiếm: query='{search_query}', is_news={is_news_query}, is_feng_shui={is_feng_shui_query}")
-             domains_to_include = VIETNAMESE_NEWS_DOMAINS if is_news_query else None
-             try:
-                search_summary = await search_and_summarize(
-                    tavily_api_key, search_query, openai_api_key, 
-                    include_domains=domains_to_include,
-                    is_feng_shui_query=is_feng_shui_query
-                )
-                search_prompt_addition = f"""
-                \n\n--- THÔNG TIN TÌM KIẾM (DÙNG ĐỂ TRẢ LỜI) ---
+                weather_prompt_addition = f"""
+                \n\n--- THÔNG TIN THỜI TIẾT (DÙNG ĐỂ TRẢ LỜI) ---
                 Người dùng hỏi: "{last_user_text}"
-                Kết quả tìm kiếm và tóm tắt cho truy vấn '{search_query}':
-                {search_summary}
-                --- KẾT THÚC THÔNG TIN TÌM KIẾM ---
-                Hãy sử dụng kết quả tóm tắt này để trả lời câu hỏi của người dùng một cách tự nhiên, trích dẫn nguồn nếu có.
+                {weather_info}
+                --- KẾT THÚC THÔNG TIN THỜI TIẾT ---
+                Hãy sử dụng thông tin thời tiết này để trả lời câu hỏi của người dùng một cách tự nhiên.
+                Luôn đề cập rõ khu vực địa lý ({location}) trong câu trả lời.
+                Đưa ra lời khuyên phù hợp với điều kiện thời tiết nếu người dùng hỏi về việc nên mặc gì, nên đi đâu, nên làm gì, v.v.
                 """
-                return search_prompt_addition
-             except Exception as search_err:
-                  logger.error(f"Lỗi khi tìm kiếm/tóm tắt cho '{search_query}': {search_err}", exc_info=True)
-                  return "\n\n--- LỖI TÌM KIẾM: Không thể lấy thông tin. Hãy báo lại cho người dùng. ---"
+                return weather_prompt_addition
+
+            # Check for General Search Intent
+            if decision["intent"] == "search":
+                 _, search_query, is_news_query, is_feng_shui_query = decision["result"]
+                 logger.info(f"Phát hiện nhu cầu tìm kiếm: query='{search_query}', is_news={is_news_query}, is_feng_shui={is_feng_shui_query}")
+                 domains_to_include = VIETNAMESE_NEWS_DOMAINS if is_news_query else None
+                 try:
+                    search_summary = await search_and_summarize(
+                        tavily_api_key, search_query, openai_api_key, 
+                        include_domains=domains_to_include,
+                        is_feng_shui_query=is_feng_shui_query,
+                        is_news_query=is_news_query,
+                        progress=progress
+                    )
+                    search_prompt_addition = f"""
+                    \n\n--- THÔNG TIN TÌM KIẾM (DÙNG ĐỂ TRẢ LỜI) ---
+                    Người dùng hỏi: "{last_user_text}"
+                    Kết quả tìm kiếm và tóm tắt cho truy vấn '{search_query}':
+                    {search_summary}
+                    --- KẾT THÚC THÔNG TIN TÌM KIẾM ---
+                    Hãy sử dụng kết quả tóm tắt này để trả lời câu hỏi của người dùng một cách tự nhiên, trích dẫn nguồn nếu có.
+                    """
+                    return search_prompt_addition
+                 except Exception as search_err:
+                      logger.error(f"Lỗi khi tìm kiếm/tóm tắt cho '{search_query}': {search_err}", exc_info=True)
+                      return "\n\n--- LỖI TÌM KIẾM: Không thể lấy thông tin. Hãy báo lại cho người dùng. ---"
+
+            # Ý định này không lấy được dữ liệu: thử ý định kế tiếp theo thứ tự ưu tiên
+            logger.info(f"Không lấy được dữ liệu cho ý định '{decision['intent']}', thử ý định kế tiếp")
+    finally:
+        await decisions.aclose()
 
     # No search need detected
     logger.info("Không phát hiện nhu cầu tìm kiếm đặc biệt.")
     return ""
 
-async def tavily_extract(api_key, urls, include_images=False, extract_depth="advanced"):
-    """Trích xuất nội dung từ URL (Wrap sync call)."""
+async def tavily_extract(api_key, urls, include_images=False, extract_depth="advanced", timeout=30):
+    """Trích xuất nội dung từ URL."""
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     data = {"urls": urls, "include_images": include_images, "extract_depth": extract_depth}
     try:
-        response = await asyncio.to_thread(
-             requests.post, "https://api.tavily.com/extract", headers=headers, json=data, timeout=30
-        )
+        response = await http_client.request("POST", "https://api.tavily.com/extract", headers=headers, json=data, timeout=timeout)
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Lỗi Tavily Extract API ({e.__class__.__name__}): {e}")
         return None
     except Exception as e:
@@ -4062,18 +5879,16 @@ async def tavily_extract(api_key, urls, include_images=False, extract_depth="adv
 
 
 async def tavily_search(api_key, query, search_depth="advanced", max_results=5, include_domains=None, exclude_domains=None):
-    """Tìm kiếm Tavily (Wrap sync call)."""
+    """Tìm kiếm Tavily."""
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     data = {"query": query, "search_depth": search_depth, "max_results": max_results}
     if include_domains: data["include_domains"] = include_domains
     if exclude_domains: data["exclude_domains"] = exclude_domains
     try:
-        response = await asyncio.to_thread(
-            requests.post, "https://api.tavily.com/search", headers=headers, json=data, timeout=15
-        )
+        response = await http_client.request("POST", "https://api.tavily.com/search", headers=headers, json=data, timeout=15)
         response.raise_for_status()
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Lỗi Tavily Search API ({e.__class__.__name__}): {e}")
         return None
     except Exception as e:
@@ -4081,22 +5896,111 @@ async def tavily_search(api_key, query, search_depth="advanced", max_results=5,
          return None
 
 
-async def search_and_summarize(tavily_api_key, query, openai_api_key, include_domains=None, is_feng_shui_query=False):
-    """Tìm kiếm và tổng hợp."""
-    if not tavily_api_key or not openai_api_key or not query:
-        return "Thiếu thông tin API key hoặc câu truy vấn."
+search_results_cache = TTLCache("search_results", max_size=SEARCH_CACHE_SIZE, ttl_seconds=SEARCH_CACHE_TTL)
+extract_cache = TTLCache("extract", max_size=SEARCH_CACHE_SIZE * 3, ttl_seconds=EXTRACT_CACHE_TTL)
+search_summary_cache = TTLCache("search_summary", max_size=SEARCH_CACHE_SIZE, ttl_seconds=SEARCH_CACHE_TTL)
+search_flight = SingleFlight("search")
+# Mỗi khoảng ngày chỉ có một bản phân tích; giữ thêm vài ngày gần nhất
+feng_shui_cache = TTLCache("feng_shui", max_size=8, ttl_seconds=2 * 24 * 3600, persist_file=FENG_SHUI_CACHE_FILE)
+feng_shui_flight = SingleFlight("feng_shui")
+feng_shui_precompute_task = None
 
-    try:
-        logger.info(f"Bắt đầu tìm kiếm Tavily cho: '{query}'" + (f" (Domains: {include_domains})" if include_domains else ""))
-        
-        # Xử lý đặc biệt cho truy vấn phong thủy
-        if is_feng_shui_query:
-            # Tạo prompt mẫu cho phong thủy thay vì tìm kiếm web
-            current_date = datetime.datetime.now()
-            end_date = current_date + datetime.timedelta(days=7)
-            date_range = f"từ {current_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}"
-            
-            feng_shui_prompt = f"""
+def search_cache_window(is_news_query):
+    """
+    Cửa sổ thời gian cố định cho cache tìm kiếm: (mã cửa sổ, số giây còn lại).
+    Mọi truy vấn trong cùng cửa sổ dùng chung kết quả và cùng hết hạn khi sang cửa sổ mới.
+    """
+    ttl = SEARCH_NEWS_CACHE_TTL if is_news_query else SEARCH_CACHE_TTL
+    now = time.time()
+    bucket = int(now // ttl)
+    return f"{ttl}:{bucket}", max(1, int((bucket + 1) * ttl - now))
+
+async def tavily_extract_cached(api_key, urls, deadline=EXTRACT_DEADLINE, max_total_len=SEARCH_CONTEXT_MAX_CHARS):
+    """
+    Trích xuất nội dung các URL, dùng extract_cache theo URL đã gửi đi. URL chưa có trong cache
+    được trích xuất song song, mỗi URL một request (tối đa EXTRACT_MAX_CONCURRENCY request cùng lúc),
+    trong hạn chót chung `deadline`: nguồn nào xong trước hạn đều được giữ và cache, chỉ các request
+    còn chạy bị huỷ khi hết hạn hoặc khi đã đủ max_total_len ký tự. Kết quả giữ nguyên thứ tự xếp hạng của urls.
+    """
+    by_url = {}
+    total_len = 0
+    missing_urls = []
+    for url in urls:
+        cached = extract_cache.get(url)
+        if cached is not None:
+            by_url[url] = cached
+            total_len += min(len(cached["raw_content"]), EXTRACT_MAX_CHARS_PER_SOURCE)
+        else:
+            missing_urls.append(url)
+
+    if missing_urls and total_len < max_total_len:
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        expires_at = loop.time() + deadline
+        queued = list(missing_urls)
+        limit = EXTRACT_MAX_CONCURRENCY if EXTRACT_MAX_CONCURRENCY > 0 else len(queued)
+        pending = {}
+        try:
+            while queued or pending:
+                while queued and len(pending) < limit:
+                    url = queued.pop(0)
+                    pending[asyncio.create_task(tavily_extract(api_key, [url], timeout=deadline))] = url
+                remaining = expires_at - loop.time()
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    url = pending.pop(task)
+                    extract_result = task.result()
+                    for res in (extract_result or {}).get("results", [])[:1]:
+                        if res.get("raw_content"):
+                            # Cache theo URL đã gửi (Tavily có thể trả về URL đã chuẩn hóa/chuyển hướng)
+                            item = {"url": res.get("url") or url, "raw_content": res["raw_content"]}
+                            extract_cache.set(url, item)
+                            by_url[url] = item
+                            total_len += min(len(item["raw_content"]), EXTRACT_MAX_CHARS_PER_SOURCE)
+                if total_len >= max_total_len:
+                    logger.info(f"Đã đủ {total_len} ký tự nội dung, dừng trích xuất sớm.")
+                    runtime_metrics.incr("extract.early_stop")
+                    break
+            if queued or pending:
+                if total_len < max_total_len:
+                    logger.warning(f"Hết hạn trích xuất sau {deadline}s, giữ {len(by_url)}/{len(urls)} nguồn đã xong.")
+                    runtime_metrics.incr("extract.deadline_exceeded")
+        finally:
+            # Chỉ huỷ các request chưa xong; chờ chúng kết thúc để không để lại task treo
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            runtime_metrics.observe("extract.total", (time.perf_counter() - started) * 1000)
+
+    results = [by_url[url] for url in urls if url in by_url]
+    return {"results": results} if results else None
+
+def feng_shui_date_range(start_date=None):
+    """Chuỗi khoảng ngày 7 ngày tới, dùng trong prompt và làm key cache phong thủy."""
+    current_date = start_date or datetime.datetime.now()
+    end_date = current_date + datetime.timedelta(days=7)
+    return f"từ {current_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}"
+
+async def get_feng_shui_analysis(openai_api_key, date_range=None):
+    """
+    Phân tích phong thủy các ngày trong tuần. Prompt chỉ phụ thuộc vào date_range nên kết quả
+    được cache theo date_range (có lưu xuống đĩa) và dùng chung cho mọi người dùng.
+    """
+    date_range = date_range or feng_shui_date_range()
+    cached = feng_shui_cache.get(date_range)
+    if cached is not None:
+        return cached
+    return await feng_shui_flight.do(f"{date_range}|{api_key_scope(openai_api_key)}",
+                                     lambda: _generate_feng_shui_analysis(openai_api_key, date_range))
+
+async def _generate_feng_shui_analysis(openai_api_key, date_range):
+    """Gọi OpenAI tạo phân tích phong thủy cho date_range (không qua cache)."""
+    feng_shui_prompt = f"""
 Hãy phân tích chi tiết về các ngày tốt xấu trong tuần này ({date_range}) dựa trên phong thủy và tử vi. Phân tích cần bao gồm:
 
 1. Đánh giá từng ngày trong tuần:
@@ -4117,31 +6021,85 @@ Hãy phân tích chi tiết về các ngày tốt xấu trong tuần này ({date
 Trình bày thông tin sử dụng HTML đơn giản và định dạng dễ đọc. Thông tin cần chi tiết, chính xác theo học thuyết phong thủy và tử vi.
 """
 
-            try:
-                client = OpenAI(api_key=openai_api_key)
-                
-                response = await asyncio.to_thread(
-                     client.chat.completions.create,
-                     model="gpt-4o-mini",
-                     messages=[
-                         {"role": "system", "content": "Bạn là chuyên gia phong thủy và tử vi hàng đầu. Bạn có kiến thức sâu rộng về Ngũ hành, Bát quái, Can Chi, và các học thuyết phong thủy phương Đông. Bạn cung cấp phân tích chi tiết, chính xác và có tính ứng dụng cao về các ngày tốt xấu trong phong thủy."},
-                         {"role": "user", "content": feng_shui_prompt}
-                     ],
-                     temperature=0.7,
-                     max_tokens=2000
-                )
-                
-                feng_shui_analysis = response.choices[0].message.content
-                logger.info(f"Đã tạo phân tích phong thủy (độ dài: {len(feng_shui_analysis)})")
-                return feng_shui_analysis
-            except Exception as feng_shui_err:
-                logger.error(f"Lỗi khi tạo phân tích phong thủy: {feng_shui_err}", exc_info=True)
-                return "Xin lỗi, tôi không thể tạo phân tích phong thủy chi tiết lúc này. Vui lòng thử lại sau."
+    try:
+        response = await create_chat_completion(
+             openai_api_key,
+             model="gpt-4o-mini",
+             messages=[
+                 {"role": "system", "content": "Bạn là chuyên gia phong thủy và tử vi hàng đầu. Bạn có kiến thức sâu rộng về Ngũ hành, Bát quái, Can Chi, và các học thuyết phong thủy phương Đông. Bạn cung cấp phân tích chi tiết, chính xác và có tính ứng dụng cao về các ngày tốt xấu trong phong thủy."},
+                 {"role": "user", "content": feng_shui_prompt}
+             ],
+             temperature=0.7,
+             max_tokens=2000
+        )
+        
+        feng_shui_analysis = response.choices[0].message.content
+        logger.info(f"Đã tạo phân tích phong thủy (độ dài: {len(feng_shui_analysis)})")
+        feng_shui_cache.set(date_range, feng_shui_analysis)
+        return feng_shui_analysis
+    except Exception as feng_shui_err:
+        logger.error(f"Lỗi khi tạo phân tích phong thủy: {feng_shui_err}", exc_info=True)
+        return "Xin lỗi, tôi không thể tạo phân tích phong thủy chi tiết lúc này. Vui lòng thử lại sau."
+
+async def feng_shui_precompute_loop(openai_api_key):
+    """Tạo sẵn phân tích phong thủy khi khởi động và ngay sau mỗi nửa đêm."""
+    while True:
+        try:
+            date_range = feng_shui_date_range()
+            if feng_shui_cache.get(date_range) is None:
+                logger.info(f"Tạo sẵn phân tích phong thủy cho {date_range}")
+                await get_feng_shui_analysis(openai_api_key, date_range)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Lỗi khi tạo sẵn phân tích phong thủy: {e}", exc_info=True)
+        now = datetime.datetime.now()
+        next_midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+        await asyncio.sleep((next_midnight - now).total_seconds() + 5)
+
+async def search_and_summarize(tavily_api_key, query, openai_api_key, include_domains=None, is_feng_shui_query=False, is_news_query=False, progress=None):
+    """
+    Tìm kiếm và tổng hợp. Các truy vấn giống nhau đang chạy đồng thời được gộp làm một;
+    kết quả từng bước được cache (TTL ngắn hơn cho tin tức).
+
+    Nếu có progress, các frame `search_start`, `extract_done` và từng token tóm tắt
+    (`search_chunk`) được gửi qua callback trong lúc xử lý. Với truy vấn đã có lời gọi
+    đang chạy, chỉ lời gọi đầu tiên nhận được frame.
+    """
+    if not tavily_api_key or not openai_api_key or not query:
+        return "Thiếu thông tin API key hoặc câu truy vấn."
+
+    normalized_query = " ".join(query.lower().split())
+    domains_key = ",".join(sorted(include_domains)) if include_domains else ""
+    # Gộp theo từng cặp API key: lỗi do key của một người dùng không được trả cho người khác.
+    # Các cache chỉ giữ kết quả thành công nên vẫn dùng chung giữa mọi người dùng.
+    flight_key = (f"{normalized_query}|{domains_key}|{is_feng_shui_query}|{is_news_query}|"
+                  f"{api_key_scope(tavily_api_key)}|{api_key_scope(openai_api_key)}")
+    return await search_flight.do(flight_key, lambda: _search_and_summarize(
+        tavily_api_key, query, openai_api_key, include_domains, is_feng_shui_query, is_news_query, progress
+    ))
+
+async def _search_and_summarize(tavily_api_key, query, openai_api_key, include_domains, is_feng_shui_query, is_news_query, progress):
+    try:
+        logger.info(f"Bắt đầu tìm kiếm Tavily cho: '{query}'" + (f" (Domains: {include_domains})" if include_domains else ""))
+        await emit_progress(progress, {"search_start": query, "is_news_query": is_news_query})
+        
+        # Xử lý đặc biệt cho truy vấn phong thủy: phân tích theo tuần, không cần tìm kiếm web
+        if is_feng_shui_query:
+            return await get_feng_shui_analysis(openai_api_key)
             
         # Tiếp tục với xử lý tìm kiếm bình thường
-        search_results = await tavily_search(
-            tavily_api_key, query, include_domains=include_domains, max_results=5
-        )
+        window, window_ttl = search_cache_window(is_news_query)
+        normalized_query = " ".join(query.lower().split())
+        domains_key = ",".join(sorted(include_domains)) if include_domains else ""
+        results_key = f"{window}|{domains_key}|{normalized_query}"
+        search_results = search_results_cache.get(results_key)
+        if search_results is None:
+            search_results = await tavily_search(
+                tavily_api_key, query, include_domains=include_domains, max_results=5
+            )
+            if search_results and search_results.get("results"):
+                search_results_cache.set(results_key, search_results, ttl_seconds=window_ttl)
 
         if not search_results or not search_results.get("results"):
             logger.warning(f"Không tìm thấy kết quả Tavily cho '{query}'")
@@ -4152,15 +6110,21 @@ Trình bày thông tin sử dụng HTML đơn giản và định dạng dễ đ
             logger.warning(f"Không có URL nào để trích xuất từ kết quả Tavily cho '{query}'.")
             return f"Đã tìm thấy một số tiêu đề liên quan đến '{query}' nhưng không thể trích xuất nội dung."
 
+        summary_key = f"{window}|{normalized_query}|" + hashlib.sha256("\n".join(sorted(urls_to_extract)).encode()).hexdigest()
+        cached_summary = search_summary_cache.get(summary_key)
+        if cached_summary is not None:
+            logger.info(f"Dùng bản tóm tắt đã cache cho '{query}'")
+            return cached_summary
+
         logger.info(f"Trích xuất nội dung từ URLs: {urls_to_extract}")
-        extract_result = await tavily_extract(tavily_api_key, urls_to_extract)
+        extract_result = await tavily_extract_cached(tavily_api_key, urls_to_extract)
 
         extracted_contents = []
         if extract_result and extract_result.get("results"):
              for res in extract_result["results"]:
                   content = res.get("raw_content", "")
                   if content:
-                       max_len_per_source = 4000
+                       max_len_per_source = EXTRACT_MAX_CHARS_PER_SOURCE
                        content = content[:max_len_per_source] + "..." if len(content) > max_len_per_source else content
                        extracted_contents.append({"url": res.get("url"), "content": content})
                   else:
@@ -4180,11 +6144,11 @@ Trình bày thông tin sử dụng HTML đơn giản và định dạng dễ đ
              return f"Không thể trích xuất nội dung chi tiết cho '{query}'."
 
         logger.info(f"Tổng hợp {len(extracted_contents)} nguồn trích xuất cho '{query}'.")
-        client = OpenAI(api_key=openai_api_key)
+        await emit_progress(progress, {"extract_done": len(extracted_contents), "sources": [item["url"] for item in extracted_contents]})
 
         content_for_prompt = ""
         total_len = 0
-        max_total_len = 15000
+        max_total_len = SEARCH_CONTEXT_MAX_CHARS
         for item in extracted_contents:
              source_text = f"\n--- Nguồn: {item['url']} ---\n{item['content']}\n--- Hết nguồn ---\n"
              if total_len + len(source_text) > max_total_len:
@@ -4211,18 +6175,42 @@ Trình bày thông tin sử dụng HTML đơn giản và định dạng dễ đ
         """
 
         try:
-            response = await asyncio.to_thread(
-                 client.chat.completions.create,
-                 model=openai_model,
-                 messages=[
-                     {"role": "system", "content": "Bạn là một trợ lý tổng hợp thông tin chuyên nghiệp. Nhiệm vụ của bạn là tổng hợp nội dung từ các nguồn được cung cấp để tạo ra một bản tóm tắt chính xác, tập trung vào yêu cầu của người dùng và trích dẫn nguồn nếu có thể."},
-                     {"role": "user", "content": prompt}
-                 ],
-                 temperature=0.3,
-                 max_tokens=1500
-            )
-            summarized_info = response.choices[0].message.content
-            return summarized_info.strip()
+            summary_messages = [
+                {"role": "system", "content": "Bạn là một trợ lý tổng hợp thông tin chuyên nghiệp. Nhiệm vụ của bạn là tổng hợp nội dung từ các nguồn được cung cấp để tạo ra một bản tóm tắt chính xác, tập trung vào yêu cầu của người dùng và trích dẫn nguồn nếu có thể."},
+                {"role": "user", "content": prompt}
+            ]
+            if progress is not None:
+                # Stream từng token tóm tắt tới client trong khi vẫn gom lại toàn bộ bản tóm tắt
+                stream = await create_chat_completion(
+                     openai_api_key,
+                     model=openai_model,
+                     messages=summary_messages,
+                     temperature=0.3,
+                     max_tokens=1500,
+                     stream=True
+                )
+                summary_parts = []
+                async with stream:
+                    async for chunk in stream:
+                        delta_content = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta_content:
+                            summary_parts.append(delta_content)
+                            await emit_progress(progress, {"search_chunk": delta_content})
+                summarized_info = "".join(summary_parts).strip()
+            else:
+                response = await create_chat_completion(
+                     openai_api_key,
+                     model=openai_model,
+                     messages=summary_messages,
+                     temperature=0.3,
+                     max_tokens=1500
+                )
+                summarized_info = (response.choices[0].message.content or "").strip()
+            if not summarized_info:
+                logger.warning(f"OpenAI trả về bản tóm tắt rỗng cho '{query}'.")
+                return f"Không thể tóm tắt kết quả tìm kiếm cho '{query}'."
+            search_summary_cache.set(summary_key, summarized_info, ttl_seconds=window_ttl)
+            return summarized_info
 
         except Exception as summary_err:
              logger.error(f"Lỗi khi gọi OpenAI để tổng hợp: {summary_err}", exc_info=True)
@@ -4233,12 +6221,19 @@ Trình bày thông tin sử dụng HTML đơn giản và định dạng dễ đ
         return f"Có lỗi xảy ra trong quá trình tìm kiếm và tổng hợp thông tin: {str(e)}"
 
 
+# Câu hỏi chứa các từ khóa này được coi là về thời tiết, không cần tìm kiếm web
+WEATHER_KEYWORDS_FOR_DETECTION = ["thời tiết", "dự báo", "nhiệt độ", "nắng", "mưa", "gió", "mấy độ", "bao nhiêu độ", "mặc gì", "nên đi"]
+
 async def detect_search_intent(query, api_key):
     """Phát hiện ý định tìm kiếm (async wrapper)."""
     if not api_key or not query: return False, query, False, False
 
+    cache_key = intent_cache_key("detect_search_intent", query)
+    cached = intent_cache.get(cache_key)
+    if cached is not None:
+        return tuple(cached)
+
     try:
-        client = OpenAI(api_key=api_key)
         current_date_str = datetime.datetime.now().strftime("%Y-%m-%d")
         system_prompt = f"""
 Bạn là một hệ thống phân loại và tinh chỉnh câu hỏi thông minh. Nhiệm vụ của bạn là:
@@ -4261,8 +6256,8 @@ Ví dụ:
 
 Trả lời DƯỚI DẠNG JSON HỢP LỆ với 4 trường: need_search (boolean), search_query (string), is_news_query (boolean), is_feng_shui_query (boolean).
 """
-        response = await asyncio.to_thread(
-             client.chat.completions.create,
+        response = await create_chat_completion(
+             api_key,
              model=openai_model,
              messages=[
                  {"role": "system", "content": system_prompt},
@@ -4284,8 +6279,7 @@ Trả lời DƯỚI DẠNG JSON HỢP LỆ với 4 trường: need_search (boole
             is_feng_shui_query = result.get("is_feng_shui_query", False)
 
             # Ensure weather-related queries are explicitly marked as need_search=false
-            weather_keywords_for_detection = ["thời tiết", "dự báo", "nhiệt độ", "nắng", "mưa", "gió", "mấy độ", "bao nhiêu độ", "mặc gì", "nên đi"]
-            if any(keyword in query.lower() for keyword in weather_keywords_for_detection):
+            if any(keyword in query.lower() for keyword in WEATHER_KEYWORDS_FOR_DETECTION):
                  need_search = False
                  logger.info(f"Detected potential weather query '{query}', overriding need_search to False.")
 
@@ -4295,6 +6289,7 @@ Trả lời DƯỚI DẠNG JSON HỢP LỆ với 4 trường: need_search (boole
                 is_news_query = result.get("is_news_query", False)
 
             logger.info(f"Phân tích truy vấn '{query}': need_search={need_search}, search_query='{search_query}', is_news_query={is_news_query}, is_feng_shui_query={is_feng_shui_query}")
+            intent_cache.set(cache_key, [need_search, search_query, is_news_query, is_feng_shui_query])
             return need_search, search_query, is_news_query, is_feng_shui_query
 
         except (json.JSONDecodeError, TypeError) as e:
@@ -4304,6 +6299,90 @@ Trả lời DƯỚI DẠNG JSON HỢP LỆ với 4 trường: need_search (boole
         logger.error(f"Lỗi khi gọi OpenAI trong detect_search_intent: {e}", exc_info=True)
         return False, query, False, False
 
+async def detect_query_intent(query, api_key):
+    """
+    Phân loại gộp trong một lời gọi: thời tiết, tư vấn thời tiết, tìm kiếm, tin tức, phong thủy.
+    Dùng khi INTENT_ROUTER_MODE="unified", thay cho ba bộ phân loại riêng lẻ.
+
+    Returns:
+        Dict các trường đã chuẩn hóa, hoặc None nếu lỗi
+    """
+    if not api_key or not query: return None
+
+    cache_key = intent_cache_key("detect_query_intent", query)
+    cached = intent_cache.get(cache_key)
+    if cached is not None:
+        return dict(cached) # Bản sao: caller sửa kết quả không làm hỏng cache
+
+    try:
+        current_date_str = datetime.datetime.now().strftime("%Y-%m-%d")
+        system_prompt = f"""
+Bạn là bộ định tuyến truy vấn cho trợ lý gia đình. Phân tích câu hỏi và trả về các trường:
+1. `is_weather_query`: câu hỏi về thời tiết hoặc liên quan đến thời tiết ("thời tiết Hà Nội", "trời có mưa không").
+2. `is_advice_query`: yêu cầu tư vấn dựa trên thời tiết ("nên mặc gì", "mang theo gì", "nên đi đâu", "nên làm gì").
+3. `advice_type`: "clothing", "items", "places", "activities" hoặc "general" nếu là tư vấn, ngược lại null.
+4. `location`: tên địa điểm được nhắc tới (ví dụ "Hanoi", "Da Nang", "Ho Chi Minh City" cho Sài Gòn), null nếu không có.
+5. `date_description`: mô tả thời gian NGUYÊN BẢN trong câu hỏi ("ngày mai", "thứ 2 tuần sau", "cuối tuần"), null nếu không có. Không diễn giải.
+6. `need_search`: cần tìm kiếm thông tin thực tế, tin tức hoặc dữ liệu cập nhật. Câu hỏi thời tiết hoặc tư vấn thời tiết luôn là false.
+7. `search_query`: truy vấn tìm kiếm đã tinh chỉnh (kèm yếu tố thời gian nếu có) khi need_search là true.
+8. `is_news_query`: câu hỏi chủ yếu về tin tức, thời sự, thể thao, sự kiện hiện tại.
+9. `is_feng_shui_query`: câu hỏi về phong thủy, ngày tốt xấu, ngày thuận lợi (khi đó need_search là true).
+
+Hôm nay là ngày: {current_date_str}.
+
+Ví dụ:
+- User: "hôm nay nên mặc gì" -> {{ "is_weather_query": true, "is_advice_query": true, "advice_type": "clothing", "location": null, "date_description": "hôm nay", "need_search": false, "search_query": null, "is_news_query": false, "is_feng_shui_query": false }}
+- User: "thời tiết Hà Nội thứ 2 tuần sau" -> {{ "is_weather_query": true, "is_advice_query": false, "advice_type": null, "location": "Hanoi", "date_description": "thứ 2 tuần sau", "need_search": false, "search_query": null, "is_news_query": false, "is_feng_shui_query": false }}
+- User: "tin tức covid hôm nay" -> {{ "is_weather_query": false, "is_advice_query": false, "advice_type": null, "location": null, "date_description": "hôm nay", "need_search": true, "search_query": "tin tức covid mới nhất ngày {current_date_str}", "is_news_query": true, "is_feng_shui_query": false }}
+- User: "những ngày nào thuận lợi trong tuần này" -> {{ "is_weather_query": false, "is_advice_query": false, "advice_type": null, "location": null, "date_description": "tuần này", "need_search": true, "search_query": "ngày tốt xấu phong thủy tuần này từ {current_date_str}", "is_news_query": false, "is_feng_shui_query": true }}
+- User: "thủ đô nước Pháp là gì?" -> {{ "is_weather_query": false, "is_advice_query": false, "advice_type": null, "location": null, "date_description": null, "need_search": false, "search_query": null, "is_news_query": false, "is_feng_shui_query": false }}
+
+Trả lời DƯỚI DẠNG JSON HỢP LỆ với đúng 9 trường trên.
+"""
+        response = await create_chat_completion(
+             api_key,
+             model=openai_model,
+             messages=[
+                 {"role": "system", "content": system_prompt},
+                 {"role": "user", "content": f"Câu hỏi của người dùng: \"{query}\""}
+             ],
+             temperature=0.1,
+             max_tokens=200,
+             response_format={"type": "json_object"}
+        )
+
+        result_str = response.choices[0].message.content
+        logger.info(f"Kết quả detect_query_intent (raw): {result_str}")
+
+        try:
+            result = json.loads(result_str)
+            is_advice_query = bool(result.get("is_advice_query", False))
+            is_weather_query = bool(result.get("is_weather_query", False)) or is_advice_query
+            need_search = bool(result.get("need_search", False))
+            if any(keyword in query.lower() for keyword in WEATHER_KEYWORDS_FOR_DETECTION):
+                 need_search = False
+            intent = {
+                "is_weather_query": is_weather_query,
+                "is_advice_query": is_advice_query,
+                "advice_type": (result.get("advice_type") or "general") if is_advice_query else None,
+                "location": result.get("location") or ("Hanoi" if is_weather_query else None),
+                "date_description": result.get("date_description"),
+                "need_search": need_search,
+                "search_query": (result.get("search_query") or query) if need_search else query,
+                "is_news_query": bool(result.get("is_news_query", False)) if need_search else False,
+                "is_feng_shui_query": bool(result.get("is_feng_shui_query", False)),
+            }
+            logger.info(f"Phân tích truy vấn gộp '{query}': {intent}")
+            intent_cache.set(cache_key, dict(intent))
+            return intent
+
+        except (json.JSONDecodeError, TypeError, AttributeError) as e:
+            logger.error(f"Lỗi giải mã JSON từ detect_query_intent: {e}. Raw: {result_str}")
+            return None
+    except Exception as e:
+        logger.error(f"Lỗi khi gọi OpenAI trong detect_query_intent: {e}", exc_info=True)
+        return None
+
 # --- Suggested Questions ---
 def generate_dynamic_suggested_questions(api_key, member_id=None, max_questions=5):
     """Tạo câu hỏi gợi ý động (sử dụng mẫu câu)."""
@@ -4374,13 +6453,10 @@ def generate_dynamic_suggested_questions(api_key, member_id=None, max_questions=
 
 
 # --- Chat History ---
-async def generate_chat_summary(messages, api_key):
-    """Tạo tóm tắt từ lịch sử trò chuyện (async wrapper)."""
-    if not api_key or not messages or len(messages) < 2:
-        return "Chưa đủ nội dung để tóm tắt."
-
+def conversation_text_for_summary(messages):
+    """Ghép phần text của các tin nhắn thành đoạn hội thoại "Role: nội dung" để đưa vào prompt tóm tắt."""
     conversation_text = ""
-    for msg in messages[-10:]:
+    for msg in messages:
         role = msg.get("role")
         content = msg.get("content")
         text_content = ""
@@ -4395,14 +6471,21 @@ async def generate_chat_summary(messages, api_key):
 
         if role and text_content:
              conversation_text += f"{role.capitalize()}: {text_content.strip()}\n"
+    return conversation_text
+
+
+async def generate_chat_summary(messages, api_key):
+    """Tạo tóm tắt từ lịch sử trò chuyện (async wrapper). Trả về None nếu gọi LLM lỗi."""
+    if not api_key or not messages or len(messages) < 2:
+        return "Chưa đủ nội dung để tóm tắt."
 
+    conversation_text = conversation_text_for_summary(messages[-10:])
     if not conversation_text: return "Không có nội dung text để tóm tắt."
 
 
     try:
-        client = OpenAI(api_key=api_key)
-        response = await asyncio.to_thread(
-             client.chat.completions.create,
+        response = await create_chat_completion(
+             api_key,
              model=openai_model,
              messages=[
                  {"role": "system", "content": "Tóm tắt cuộc trò chuyện sau thành 1 câu ngắn gọn bằng tiếng Việt, nêu bật yêu cầu chính hoặc kết quả cuối cùng."},
@@ -4414,23 +6497,31 @@ async def generate_chat_summary(messages, api_key):
         return response.choices[0].message.content.strip()
     except Exception as e:
         logger.error(f"Lỗi khi tạo tóm tắt chat: {e}", exc_info=True)
-        return "[Lỗi tóm tắt]"
+        return None
 
 
 def save_chat_history(member_id, messages, summary=None, session_id=None):
-    """Lưu lịch sử chat cho member_id."""
+    """Lưu lịch sử chat cho member_id (summary=None: giữ tóm tắt gần nhất của session)."""
     global chat_history
     if not member_id: return
 
     if member_id not in chat_history or not isinstance(chat_history[member_id], list):
         chat_history[member_id] = []
 
+    summarized_count = None
+    if summary is None and session_id:
+        previous = next((h for h in chat_history[member_id] if h.get("session_id") == session_id), None)
+        summary = previous.get("summary") if previous else None
+        summarized_count = previous.get("summarized_count") if previous else None
+
     history_entry = {
         "timestamp": datetime.datetime.now().isoformat(),
         "messages": messages,
         "summary": summary or "",
         "session_id": session_id
     }
+    if summarized_count:
+        history_entry["summarized_count"] = summarized_count
 
     chat_history[member_id].insert(0, history_entry)
 
@@ -4438,62 +6529,508 @@ def save_chat_history(member_id, messages, summary=None, session_id=None):
     if len(chat_history[member_id]) > max_history_per_member:
         chat_history[member_id] = chat_history[member_id][:max_history_per_member]
 
-    if not save_data(CHAT_HISTORY_FILE, chat_history):
+    # Chỉ ghi bản lịch sử mới (kèm giới hạn), không ghi lại toàn bộ lịch sử của member
+    if not push_data(CHAT_HISTORY_FILE, member_id, history_entry, max_history_per_member):
         logger.error(f"Lưu lịch sử chat cho member {member_id} thất bại.")
 
 
+def update_chat_history_summary(member_id, session_id, summary, summarized_count=None):
+    """
+    Ghi tóm tắt vào bản lịch sử mới nhất của session (dùng bởi hàng đợi tóm tắt nền).
+    summarized_count: số tin nhắn đã được tóm tắt, để hàng đợi không phải giữ trạng thái của session.
+    """
+    histories = chat_history.get(member_id)
+    if not isinstance(histories, list):
+        return False
+    for history in histories:
+        if history.get("session_id") == session_id:
+            fields = {"summary": summary}
+            if summarized_count is not None:
+                fields["summarized_count"] = summarized_count
+            history.update(fields)
+            if not patch_data(CHAT_HISTORY_FILE, member_id, session_id, fields):
+                logger.error(f"Lưu tóm tắt chat cho member {member_id} thất bại.")
+                return False
+            return True
+    return False
+
+def chat_history_summarized_count(member_id, session_id):
+    """Số tin nhắn đã được tóm tắt trong bản lịch sử mới nhất của session (0 nếu chưa có)."""
+    for history in chat_history.get(member_id) or []:
+        if history.get("session_id") == session_id:
+            return history.get("summarized_count") or 0
+    return 0
+
+
+class ChatSummaryQueue:
+    """Hàng đợi tóm tắt lịch sử chat chạy nền, debounce theo (member, session).
+
+    Request chỉ gọi submit() rồi trả lời ngay; một session được tóm tắt lại khi có ít nhất
+    every_n tin nhắn mới kể từ lần tóm tắt trước, hoặc sau idle_seconds không có tin nhắn mới.
+    Worker chạy tuần tự trên event loop và ghi kết quả vào chat_history. Trạng thái debounce
+    của một session bị bỏ khi không còn gì chờ; bộ đếm đã tóm tắt được lưu trong chat_history.
+    """
+
+    def __init__(self, every_n=CHAT_SUMMARY_EVERY_N, idle_seconds=CHAT_SUMMARY_IDLE_SECONDS,
+                 shutdown_timeout=CHAT_SUMMARY_SHUTDOWN_TIMEOUT):
+        self.every_n = max(1, every_n)
+        self.idle_seconds = idle_seconds
+        self.shutdown_timeout = shutdown_timeout
+        self._states = {}   # (member_id, session_id) -> trạng thái debounce
+        self._queue = None
+        self._queued = set()
+        self._worker_task = None
+        self._tasks = set()  # task tóm tắt chạy ngoài worker; giữ tham chiếu để không bị thu hồi giữa chừng
+
+    def start(self):
+        """Khởi động worker trên event loop hiện tại."""
+        if self._worker_task and not self._worker_task.done():
+            return
+        self._queue = asyncio.Queue()
+        self._worker_task = asyncio.get_running_loop().create_task(self._worker())
+        logger.info(f"Đã bật tóm tắt chat nền (mỗi {self.every_n} tin nhắn hoặc sau {self.idle_seconds}s)")
+
+    def submit(self, member_id, session_id, messages, api_key):
+        """Ghi nhận lượt chat mới; lên lịch tóm tắt thay vì chờ LLM trong request."""
+        if not member_id or not api_key:
+            return
+        key = (member_id, session_id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = {
+                "summarized_count": chat_history_summarized_count(member_id, session_id),
+                "timer": None,
+            }
+        state["messages"] = messages
+        state["api_key"] = api_key
+        if state["timer"]:
+            state["timer"].cancel()
+            state["timer"] = None
+
+        if self._worker_task is None:
+            # Chưa có worker (vd. chạy ngoài server): bỏ qua debounce, tóm tắt ngay ở nền
+            task = asyncio.get_running_loop().create_task(self._summarize(key))
+            self._tasks.add(task)
+            task.add_done_callback(lambda done, key=key: self._on_task_done(key, done))
+            return
+        if len(messages) - state["summarized_count"] >= self.every_n:
+            self._enqueue(key)
+        else:
+            state["timer"] = asyncio.get_running_loop().call_later(self.idle_seconds, self._enqueue, key)
+
+    def _on_task_done(self, key, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Lỗi tóm tắt chat nền cho {key}: {task.exception()}", exc_info=task.exception())
+
+    def _enqueue(self, key):
+        state = self._states.get(key)
+        if state is None:
+            return
+        if state["timer"]:
+            state["timer"].cancel()
+            state["timer"] = None
+        if key not in self._queued:
+            self._queued.add(key)
+            self._queue.put_nowait(key)
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            self._queued.discard(key)
+            try:
+                await self._summarize(key)
+            except Exception as e:
+                logger.error(f"Lỗi tóm tắt chat nền cho {key}: {e}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    async def _summarize(self, key):
+        state = self._states.get(key)
+        if state is None:
+            return
+        source = state["messages"]
+        messages = list(source)
+        if len(messages) > state["summarized_count"]:
+            started = time.perf_counter()
+            summary = await generate_chat_summary(messages, state["api_key"])
+            runtime_metrics.observe("chat_summary", (time.perf_counter() - started) * 1000)
+            if summary is None:
+                # Giữ tóm tắt cũ; session được thử lại ở lượt chat sau
+                runtime_metrics.incr("chat_summary.failed")
+            else:
+                runtime_metrics.incr("chat_summary.generated")
+                state["summarized_count"] = len(messages)
+                member_id, session_id = key
+                update_chat_history_summary(member_id, session_id, summary, len(messages))
+        if (self._states.get(key) is state and state["messages"] is source
+                and not state["timer"] and key not in self._queued):
+            # Không có lượt chat mới trong lúc tóm tắt: bỏ trạng thái để _states không phình theo số session
+            del self._states[key]
+
+    async def stop(self):
+        """Tóm tắt nốt các session còn chờ (có giới hạn thời gian) rồi dừng worker."""
+        if self._worker_task is None:
+            return
+        for key, state in list(self._states.items()):
+            if state["timer"]:
+                self._enqueue(key)
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Hết thời gian chờ tóm tắt chat nền, bỏ qua {self._queue.qsize()} session.")
+        self._worker_task.cancel()
+        await asyncio.gather(self._worker_task, return_exceptions=True)
+        self._worker_task = None
+
+
+chat_summary_queue = ChatSummaryQueue()
+
+
 # --- Text to Speech ---
-def text_to_speech_google(text, lang='vi', slow=False, max_length=5000):
-    """Chuyển text thành audio base64 dùng gTTS."""
-    try:
-        clean_text = re.sub(r'<[^>]*>', ' ', text)
-        clean_text = unescape(clean_text)
-        clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+AUDIO_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+def clean_tts_text(text, max_length=5000):
+    """Bỏ thẻ HTML, gộp khoảng trắng và cắt văn bản quá dài tại cuối câu gần nhất."""
+    clean_text = re.sub(r'<[^>]*>', ' ', text or "")
+    clean_text = unescape(clean_text)
+    clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+
+    if len(clean_text) > max_length:
+        logger.warning(f"TTS: Văn bản quá dài ({len(clean_text)}), cắt ngắn còn {max_length}.")
+        cut_pos = clean_text.rfind('.', 0, max_length)
+        if cut_pos == -1: cut_pos = clean_text.rfind('?', 0, max_length)
+        if cut_pos == -1: cut_pos = clean_text.rfind('!', 0, max_length)
+        if cut_pos == -1 or cut_pos < max_length // 2: cut_pos = max_length
+        clean_text = clean_text[:cut_pos+1]
+    return clean_text
+
+def synthesize_speech_mp3(clean_text, lang='vi', slow=False):
+    """Gọi gTTS (đồng bộ, có I/O mạng) và trả về dữ liệu MP3."""
+    audio_buffer = BytesIO()
+    tts = gTTS(text=clean_text, lang=lang, slow=slow)
+    tts.write_to_fp(audio_buffer)
+    return audio_buffer.getvalue()
+
+class TTSService:
+    """
+    Dịch vụ text-to-speech: tổng hợp trong pool thread giới hạn (không chặn event loop),
+    cache audio theo hash(văn bản đã làm sạch, ngôn ngữ, tốc độ). Audio được ghi xuống
+    TTS_AUDIO_DIR trước khi audio_id được trả ra, nên GET /audio/{audio_id} dùng được sau khi
+    khởi động lại và từ mọi worker; bộ nhớ chỉ là LRU theo dung lượng phía trước đĩa.
+    Thư mục được dọn định kỳ (giữ tối đa disk_files file) bởi task nền.
+    """
+    def __init__(self, audio_dir=TTS_AUDIO_DIR, max_workers=TTS_MAX_WORKERS,
+                 memory_bytes=TTS_MEMORY_CACHE_BYTES, disk_files=TTS_DISK_CACHE_FILES):
+        self.audio_dir = audio_dir
+        self.memory_bytes = memory_bytes
+        self.disk_files = disk_files
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+        self._memory = OrderedDict()  # audio_id -> bytes
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._single_flight = SingleFlight("tts")
+        self._prune_task = None
+        os.makedirs(audio_dir, exist_ok=True)
+
+    @staticmethod
+    def audio_id_for(clean_text, lang, slow):
+        return hashlib.sha256(f"{lang}|{int(bool(slow))}|{clean_text}".encode("utf-8")).hexdigest()[:32]
+
+    def _disk_path(self, audio_id):
+        return os.path.join(self.audio_dir, f"{audio_id}.mp3")
+
+    def _remember(self, audio_id, audio_data):
+        with self._lock:
+            if audio_id in self._memory:
+                self._memory.move_to_end(audio_id)
+                return
+            self._memory[audio_id] = audio_data
+            self._memory_size += len(audio_data)
+            # Mọi audio đã có trên đĩa (ghi khi tổng hợp), bỏ khỏi bộ nhớ là đủ
+            while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+                _, old_data = self._memory.popitem(last=False)
+                self._memory_size -= len(old_data)
+
+    def _write_disk(self, audio_id, audio_data):
+        path = self._disk_path(audio_id)
+        if os.path.exists(path):
+            return
+        try:
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio_data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"TTS: Không thể ghi audio {audio_id} xuống đĩa: {e}")
+
+    async def _prune_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self._prune_disk)
+            except Exception as e:
+                logger.error(f"TTS: Lỗi khi dọn thư mục audio: {e}", exc_info=True)
+
+    def start_pruning(self, interval=TTS_DISK_PRUNE_INTERVAL):
+        """Khởi động task dọn TTS_AUDIO_DIR định kỳ trên event loop hiện tại."""
+        if self._prune_task is None or self._prune_task.done():
+            self._prune_task = asyncio.get_running_loop().create_task(self._prune_loop(interval))
+
+    def _prune_disk(self):
+        """Giữ tối đa disk_files file, xóa các file cũ nhất (theo thời gian truy cập/sửa)."""
+        try:
+            entries = [entry for entry in os.scandir(self.audio_dir) if entry.name.endswith(".mp3")]
+        except OSError:
+            return
+        if len(entries) <= self.disk_files:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.disk_files]:
+            try: os.remove(entry.path)
+            except OSError: pass
+
+    def _read_disk(self, audio_id):
+        path = self._disk_path(audio_id)
+        try:
+            with open(path, "rb") as f:
+                audio_data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return audio_data
 
+    async def get_audio(self, audio_id):
+        """Lấy audio MP3 theo ID từ bộ nhớ hoặc đĩa (đọc trong thread, không chặn event loop); None nếu không có."""
+        if not AUDIO_ID_PATTERN.match(audio_id or ""):
+            return None
+        with self._lock:
+            audio_data = self._memory.get(audio_id)
+            if audio_data is not None:
+                self._memory.move_to_end(audio_id)
+        if audio_data is not None:
+            runtime_metrics.incr("cache.tts.hit")
+            return audio_data
+        audio_data = await asyncio.to_thread(self._read_disk, audio_id)
+        if audio_data is None:
+            runtime_metrics.incr("cache.tts.miss")
+            return None
+        runtime_metrics.incr("cache.tts.hit")
+        self._remember(audio_id, audio_data)
+        return audio_data
+
+    async def synthesize(self, text, lang='vi', slow=False, max_length=5000):
+        """Tổng hợp (hoặc lấy từ cache) audio cho text; trả về audio_id hoặc None nếu lỗi/rỗng."""
+        clean_text = clean_tts_text(text, max_length)
         if not clean_text:
-             logger.warning("TTS: Văn bản rỗng sau khi làm sạch.")
-             return None
-
-        if len(clean_text) > max_length:
-            logger.warning(f"TTS: Văn bản quá dài ({len(clean_text)}), cắt ngắn còn {max_length}.")
-            cut_pos = clean_text.rfind('.', 0, max_length)
-            if cut_pos == -1: cut_pos = clean_text.rfind('?', 0, max_length)
-            if cut_pos == -1: cut_pos = clean_text.rfind('!', 0, max_length)
-            if cut_pos == -1 or cut_pos < max_length // 2: cut_pos = max_length
-            clean_text = clean_text[:cut_pos+1]
-
-        audio_buffer = BytesIO()
-        tts = gTTS(text=clean_text, lang=lang, slow=slow)
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
-        audio_data = audio_buffer.read()
-        audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-        return audio_base64
+            logger.warning("TTS: Văn bản rỗng sau khi làm sạch.")
+            return None
+        audio_id = self.audio_id_for(clean_text, lang, slow)
+        if await self.get_audio(audio_id) is not None:
+            return audio_id
+
+        async def run():
+            started = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            audio_data = await loop.run_in_executor(self._executor, synthesize_speech_mp3, clean_text, lang, slow)
+            runtime_metrics.observe("tts.synthesize", (time.perf_counter() - started) * 1000)
+            await asyncio.to_thread(self._write_disk, audio_id, audio_data)
+            self._remember(audio_id, audio_data)
+            return audio_id
 
-    except Exception as e:
-        logger.error(f"Lỗi khi sử dụng Google TTS: {e}", exc_info=True)
+        try:
+            return await self._single_flight.do(audio_id, run)
+        except Exception as e:
+            logger.error(f"Lỗi khi sử dụng Google TTS: {e}", exc_info=True)
+            return None
+
+    async def synthesize_base64(self, text, lang='vi', slow=False, max_length=5000):
+        """Như synthesize nhưng trả về (audio_id, audio base64) cho các client nhận audio trực tiếp."""
+        audio_id = await self.synthesize(text, lang, slow, max_length)
+        audio_data = await self.get_audio(audio_id) if audio_id else None
+        if not audio_data:
+            return audio_id, None
+        return audio_id, base64.b64encode(audio_data).decode('utf-8')
+
+    async def respond(self, text, by_reference=False, lang='vi', slow=False):
+        """(audio_id, base64 hoặc None nếu client chọn lấy audio qua /audio/{audio_id})."""
+        if by_reference:
+            return await self.synthesize(text, lang, slow), None
+        return await self.synthesize_base64(text, lang, slow)
+
+    def shutdown(self):
+        if self._prune_task is not None:
+            self._prune_task.cancel()
+            self._prune_task = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+tts_service = TTSService()
+
+# Ranh giới câu trong HTML đang stream: dấu kết câu theo sau bởi khoảng trắng/thẻ, hoặc thẻ kết thúc khối
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"[.!?…]+(?=[\s<])|</p>|</li>|</h[1-6]>|<br\s*/?>|\n", re.IGNORECASE)
+
+class StreamingSpeech:
+    """
+    TTS tăng dần cho /chat/stream: gom text đang stream, cắt tại ranh giới câu (đoạn ít nhất
+    min_chars ký tự) và tổng hợp từng đoạn ngay lập tức qua tts_service. Frame `audio_chunk`
+    được trả theo đúng thứ tự câu.
+    """
+    def __init__(self, by_reference=False, lang="vi", min_chars=TTS_STREAM_MIN_CHARS):
+        self.by_reference = by_reference
+        self.lang = lang
+        self.min_chars = min_chars
+        self.received_text = False
+        self.emitted = 0
+        self._buffer = ""
+        self._pending = []  # (index, text, task) theo thứ tự
+        self._next_index = 0
+
+    def _find_boundary(self):
+        for match in SENTENCE_BOUNDARY_PATTERN.finditer(self._buffer):
+            head = self._buffer[:match.end()]
+            if head.rfind("<") > head.rfind(">"):
+                continue  # Đang ở giữa một thẻ HTML
+            if len(clean_tts_text(head)) >= self.min_chars:
+                return match.end()
         return None
 
+    def _start(self, text):
+        clean_text = clean_tts_text(text)
+        if not clean_text:
+            return
+        task = asyncio.create_task(tts_service.respond(clean_text, self.by_reference, self.lang))
+        self._pending.append((self._next_index, clean_text, task))
+        self._next_index += 1
+
+    def feed(self, text):
+        """Thêm text mới; mỗi câu hoàn chỉnh được đưa đi tổng hợp ngay."""
+        if not text:
+            return
+        self.received_text = True
+        self._buffer += text
+        cut = self._find_boundary()
+        while cut is not None:
+            self._start(self._buffer[:cut])
+            self._buffer = self._buffer[cut:]
+            cut = self._find_boundary()
+
+    def _frame(self, index, text, task):
+        audio_id, audio_b64 = task.result() if not task.cancelled() else (None, None)
+        self.emitted += 1
+        return {"audio_chunk": audio_b64, "audio_id": audio_id, "index": index, "text": text}
+
+    def ready_frames(self):
+        """Các frame đã tổng hợp xong ở đầu hàng đợi (không chờ)."""
+        frames = []
+        while self._pending and self._pending[0][2].done():
+            frames.append(self._frame(*self._pending.pop(0)))
+        return frames
+
+    async def finish(self):
+        """Tổng hợp phần text còn lại và trả lần lượt mọi frame chưa gửi (gọi lại nhiều lần được)."""
+        if self._buffer.strip():
+            self._start(self._buffer)
+        self._buffer = ""
+        while self._pending:
+            index, text, task = self._pending.pop(0)
+            await asyncio.wait({task})
+            yield self._frame(index, text, task)
+
+    def cancel(self):
+        for _, _, task in self._pending:
+            task.cancel()
+        self._pending = []
+
 # --- Image Processing ---
-def get_image_base64(image_raw: Image.Image) -> Optional[str]:
-    """Chuyển đối tượng PIL Image sang base64 data URL."""
-    try:
-        buffered = BytesIO()
-        img_format = image_raw.format if image_raw.format else "JPEG"
-        if img_format not in ["JPEG", "PNG", "GIF", "WEBP"]:
-             logger.warning(f"Định dạng ảnh không được hỗ trợ trực tiếp '{img_format}', chuyển đổi sang JPEG.")
-             img_format = "JPEG"
-             if image_raw.mode != "RGB":
-                 image_raw = image_raw.convert("RGB")
-
-        image_raw.save(buffered, format=img_format)
-        img_byte = buffered.getvalue()
-        mime_type = f"image/{img_format.lower()}"
-        base64_str = base64.b64encode(img_byte).decode('utf-8')
-        return f"data:{mime_type};base64,{base64_str}"
-    except Exception as e:
-         logger.error(f"Lỗi chuyển đổi ảnh sang base64: {e}", exc_info=True)
-         return None
+class ImagePreprocessor:
+    """Thu nhỏ + nén lại ảnh trong process pool (Pillow giữ GIL khi giải mã/resize ảnh lớn).
+
+    Pool được tạo khi cần lần đầu; nếu process con chết (BrokenProcessPool) pool được tạo lại.
+    """
+    def __init__(self, max_workers=IMAGE_WORKERS, max_dimension=IMAGE_MAX_DIMENSION, max_short_side=IMAGE_MAX_SHORT_SIDE,
+                 max_pixels=IMAGE_MAX_PIXELS, output_format=IMAGE_OUTPUT_FORMAT, quality=IMAGE_QUALITY):
+        self.max_workers = max_workers
+        self.options = {
+            "max_dimension": max_dimension,
+            "max_short_side": max_short_side,
+            "max_pixels": max_pixels,
+            "output_format": output_format,
+            "quality": quality,
+        }
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None and self.max_workers > 0:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    async def process(self, data):
+        """
+        Trả về (bytes ảnh đã xử lý, mime_type). data là bytes hoặc file nhị phân (vd. file upload đã spool).
+        Khi chạy trong thread, Pillow đọc thẳng từ file; process con thì cần bytes (dữ liệu phải pickle được)
+        nên file được đọc ngoài event loop ngay trước khi gửi đi.
+        """
+        started = time.perf_counter()
+        executor = self._get_executor()
+        if isinstance(data, (bytes, bytearray)):
+            size_in = len(data)
+        else:
+            data.seek(0, os.SEEK_END)
+            size_in = data.tell()
+            data.seek(0)
+            if executor is not None:
+                data = await asyncio.to_thread(data.read)
+        job = functools.partial(preprocess_image_bytes, data, **self.options)
+        try:
+            if executor is None:
+                processed, mime_type, size = await asyncio.to_thread(job)
+            else:
+                processed, mime_type, size = await asyncio.get_running_loop().run_in_executor(executor, job)
+        except BrokenProcessPool:
+            logger.warning("Process pool xử lý ảnh bị hỏng, tạo lại pool.")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            processed, mime_type, size = await asyncio.get_running_loop().run_in_executor(self._get_executor(), job)
+        runtime_metrics.observe("image.preprocess", (time.perf_counter() - started) * 1000)
+        runtime_metrics.incr("image.bytes_in", size_in)
+        runtime_metrics.incr("image.bytes_out", len(processed))
+        logger.info(f"Đã xử lý ảnh: {size_in} -> {len(processed)} bytes, {size[0]}x{size[1]} {mime_type}")
+        return processed, mime_type
+
+    async def to_data_url(self, data):
+        """Xử lý ảnh và trả về data URL; None nếu không đọc được ảnh."""
+        try:
+            processed, mime_type = await self.process(data)
+        except Exception as e:
+            logger.error(f"Lỗi xử lý ảnh: {e}", exc_info=True)
+            return None
+        return f"data:{mime_type};base64,{base64.b64encode(processed).decode('ascii')}"
+
+    async def process_image_url(self, image_url):
+        """Xử lý ảnh data URL trong image_url của tin nhắn; URL http(s) hoặc ảnh lỗi được giữ nguyên."""
+        match = DATA_URL_PATTERN.match(image_url.get("url") or "")
+        if not match:
+            return image_url
+        try:
+            data = base64.b64decode(match.group(2))
+        except ValueError as e:
+            logger.warning(f"Data URL ảnh không hợp lệ, giữ nguyên: {e}")
+            return image_url
+        data_url = await self.to_data_url(data)
+        return {**image_url, "url": data_url} if data_url else image_url
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+image_preprocessor = ImagePreprocessor()
 
 
 # --- Event Filtering ---
@@ -4503,6 +7040,8 @@ def filter_events_by_member(member_id=None):
 
     filtered = {}
     member_name = family_data.get(member_id, {}).get("name") if member_id in family_data else None
+    if sqlite_store:
+        return sqlite_store.query_events_by_member(member_id, member_name)
 
     for event_id, event in events_data.items():
         is_creator = event.get("created_by") == member_id
@@ -4521,9 +7060,15 @@ async def root():
     return {
         "name": "Trợ lý Gia đình API (Tool Calling)", "version": "1.1.0-no_weather",
         "description": "API cho ứng dụng Trợ lý Gia đình thông minh (không bao gồm thời tiết)",
-        "endpoints": ["/chat", "/chat/stream", "/suggested_questions", "/family_members", "/events", "/notes", "/search", "/session", "/analyze_image", "/transcribe_audio", "/tts", "/chat_history/{member_id}"] # Removed /weather
+        "endpoints": ["/chat", "/chat/stream", "/suggested_questions", "/family_members", "/events", "/notes", "/search", "/session", "/analyze_image", "/transcribe_audio", "/tts", "/audio/{audio_id}", "/blob/{digest}", "/chat_history/{member_id}", "/metrics"] # Removed /weather
     }
 
+# --- Metrics ---
+@app.get("/metrics")
+async def get_metrics():
+    """Số liệu runtime của tiến trình hiện tại (bộ đếm và thời gian xử lý)."""
+    return runtime_metrics.snapshot()
+
 # --- Family Members ---
 @app.get("/family_members")
 async def get_family_members():
@@ -4582,6 +7127,8 @@ async def add_event_endpoint(event: EventModel, member_id: Optional[str] = None)
 @app.get("/notes")
 async def get_notes(member_id: Optional[str] = None):
     if member_id:
+        if sqlite_store:
+            return sqlite_store.query_notes_by_member(member_id)
         return {note_id: note for note_id, note in notes_data.items()
                 if note.get("created_by") == member_id}
     return notes_data
@@ -4620,7 +7167,8 @@ async def search_endpoint(search_request: SearchRequest):
             search_request.tavily_api_key,
             search_request.query,
             search_request.openai_api_key,
-            include_domains=domains_to_include
+            include_domains=domains_to_include,
+            is_news_query=bool(search_request.is_news_query)
         )
         return {"query": search_request.query, "result": result}
     except Exception as e:
@@ -4643,15 +7191,8 @@ async def delete_session(session_id: str):
 
 @app.get("/sessions")
 async def list_sessions():
-    sessions_info = {}
-    for session_id, session_data in session_manager.sessions.items():
-        sessions_info[session_id] = {
-            "created_at": session_data.get("created_at"),
-            "last_updated": session_data.get("last_updated"),
-            "member_id": session_data.get("current_member"),
-            "message_count": len(session_data.get("messages", [])),
-        }
-    sorted_sessions = sorted(sessions_info.items(), key=lambda item: item[1].get('last_updated', ''), reverse=True)
+    sessions_info = session_manager.list_metadata()
+    sorted_sessions = sorted(sessions_info.items(), key=lambda item: item[1].get('last_updated') or '', reverse=True)
     return dict(sorted_sessions)
 
 
@@ -4708,22 +7249,27 @@ async def get_cached_suggested_questions(session_id: str):
 @app.get("/chat_history/{member_id}")
 async def get_member_chat_history(member_id: str):
     """Lấy lịch sử chat của một thành viên."""
+    if sqlite_store:
+        return sqlite_store.query_chat_history_by_member(member_id, limit=10)
     if member_id in chat_history:
         return chat_history[member_id][:10]
     return []
 
 @app.get("/chat_history/session/{session_id}")
 async def get_session_chat_history(session_id: str):
-    """Lấy lịch sử chat theo session_id (có thể chậm)."""
+    """Lấy lịch sử chat theo session_id (quét toàn bộ với backend JSON, dùng index với SQLite)."""
     session_chats = []
-    for member_id, histories in chat_history.items():
-        for history in histories:
-            if history.get("session_id") == session_id:
-                history_with_member = history.copy()
-                history_with_member["member_id"] = member_id
-                if member_id in family_data:
-                    history_with_member["member_name"] = family_data[member_id].get("name", "")
-                session_chats.append(history_with_member)
+    if sqlite_store:
+        matches = sqlite_store.query_chat_history_by_session(session_id)
+    else:
+        matches = [(member_id, history) for member_id, histories in chat_history.items()
+                   for history in histories if history.get("session_id") == session_id]
+    for member_id, history in matches:
+        history_with_member = history.copy()
+        history_with_member["member_id"] = member_id
+        if member_id in family_data:
+            history_with_member["member_name"] = family_data[member_id].get("name", "")
+        session_chats.append(history_with_member)
     session_chats.sort(key=lambda x: x.get("timestamp", ""), reverse=True)
     return session_chats
 
@@ -4735,7 +7281,8 @@ async def analyze_image_endpoint(
     openai_api_key: str = Form(...),
     member_id: Optional[str] = Form(None),
     prompt: Optional[str] = Form("Mô tả chi tiết hình ảnh này bằng tiếng Việt."),
-    content_type: str = Form("image")
+    content_type: str = Form("image"),
+    audio_by_reference: bool = Form(False)
 ):
     """Phân tích hình ảnh sử dụng OpenAI Vision."""
     if not file.content_type.startswith("image/"):
@@ -4743,17 +7290,16 @@ async def analyze_image_endpoint(
     if not openai_api_key or "sk-" not in openai_api_key:
          raise HTTPException(status_code=400, detail="OpenAI API key không hợp lệ.")
 
+    check_upload_size(file, IMAGE_UPLOAD_MAX_BYTES)
     try:
-        image_content = await file.read()
-        img = Image.open(BytesIO(image_content))
-        img_base64_url = get_image_base64(img)
+        async with upload_semaphore:
+            img_base64_url = await image_preprocessor.to_data_url(file.file)
 
         if not img_base64_url:
              raise HTTPException(status_code=500, detail="Không thể xử lý ảnh thành base64.")
 
-        client = OpenAI(api_key=openai_api_key)
-        response = await asyncio.to_thread(
-             client.chat.completions.create,
+        response = await create_chat_completion(
+             openai_api_key,
              model="gpt-4o-mini",
              messages=[
                  {"role": "system", "content": "Bạn là chuyên gia phân tích hình ảnh. Mô tả chi tiết, nếu là món ăn, nêu tên và gợi ý công thức/nguyên liệu. Nếu là hoạt động, mô tả hoạt động đó."},
@@ -4766,13 +7312,14 @@ async def analyze_image_endpoint(
         )
 
         analysis_text = response.choices[0].message.content
-        audio_response = text_to_speech_google(analysis_text)
+        audio_id, audio_response = await tts_service.respond(analysis_text, audio_by_reference)
 
         return {
             "analysis": analysis_text,
             "member_id": member_id,
             "content_type": content_type,
-            "audio_response": audio_response
+            "audio_response": audio_response,
+            "audio_id": audio_id
         }
 
     except Exception as e:
@@ -4790,56 +7337,71 @@ async def transcribe_audio_endpoint(
     if not openai_api_key or "sk-" not in openai_api_key:
          raise HTTPException(status_code=400, detail="OpenAI API key không hợp lệ.")
 
-    temp_audio_path = os.path.join(TEMP_DIR, f"{uuid.uuid4()}_{file.filename}")
+    check_upload_size(file, AUDIO_UPLOAD_MAX_BYTES)
     try:
-        audio_content = await file.read()
-        with open(temp_audio_path, "wb") as f:
-            f.write(audio_content)
-
-        client = OpenAI(api_key=openai_api_key)
-        with open(temp_audio_path, "rb") as audio_file_obj:
-            transcript = await asyncio.to_thread(
-                client.audio.transcriptions.create,
-                model="whisper-1",
-                file=audio_file_obj
-            )
+        # Stream thẳng file đã spool của Starlette vào request multipart, không đọc toàn bộ vào RAM
+        text = await transcribe_audio_cached(openai_api_key, file.filename or "audio.wav", file.file)
 
-        return {"text": transcript.text}
+        return {"text": text}
 
     except Exception as e:
         logger.error(f"Lỗi khi xử lý file audio: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Lỗi khi xử lý file audio: {str(e)}")
-    finally:
-        if os.path.exists(temp_audio_path):
-            try: os.remove(temp_audio_path)
-            except OSError: pass
 
 
 @app.post("/tts")
 async def text_to_speech_endpoint(
     text: str = Form(...),
     lang: str = Form(default="vi"),
-    slow: bool = Form(default=False)
+    slow: bool = Form(default=False),
+    audio_by_reference: bool = Form(default=False)
 ):
-    """Chuyển đổi text thành audio base64 dùng gTTS."""
+    """Chuyển đổi text thành audio dùng gTTS (base64, hoặc chỉ audio_id nếu audio_by_reference)."""
     try:
         if not text:
             raise HTTPException(status_code=400, detail="Thiếu nội dung văn bản.")
 
-        audio_base64 = text_to_speech_google(text, lang, slow)
-        if audio_base64:
+        audio_id, audio_base64 = await tts_service.respond(text, audio_by_reference, lang, slow)
+        if audio_id:
             return {
                 "audio_data": audio_base64,
+                "audio_id": audio_id,
+                "audio_url": f"/audio/{audio_id}",
                 "format": "mp3",
                 "lang": lang,
                 "provider": "Google TTS"
             }
         else:
             raise HTTPException(status_code=500, detail="Không thể tạo file âm thanh.")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Lỗi trong text_to_speech_endpoint: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Lỗi xử lý TTS: {str(e)}")
 
+@app.get("/audio/{audio_id}")
+async def get_audio_endpoint(audio_id: str):
+    """Tải audio MP3 đã tổng hợp theo audio_id (trả về trong /chat, /chat/stream, /analyze_image, /tts)."""
+    audio_data = await tts_service.get_audio(audio_id)
+    if audio_data is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy audio.")
+    # audio_id là hash của nội dung nên có thể cache lâu dài phía client
+    return Response(content=audio_data, media_type="audio/mpeg",
+                    headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@app.get("/blob/{digest}")
+async def get_blob_endpoint(digest: str, mime_type: str = "application/octet-stream"):
+    """Tải ảnh/audio đã lưu theo tham chiếu blob:sha256:<digest> trong session và lịch sử chat."""
+    data = blob_store.get(digest)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy blob.")
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "X-Content-Type-Options": "nosniff"}
+    if mime_type not in BLOB_SERVABLE_MIME_TYPES:
+        # Nội dung do người dùng tải lên: không bao giờ phục vụ inline với kiểu có thể thực thi (HTML, SVG...)
+        mime_type = "application/octet-stream"
+        headers["Content-Disposition"] = f'attachment; filename="{digest}"'
+    return Response(content=data, media_type=mime_type, headers=headers)
+
 # Removed /weather/{location} endpoint
 
 # ----- Server Startup/Shutdown Hooks -----
@@ -4847,16 +7409,41 @@ async def text_to_speech_endpoint(
 async def startup_event():
     """Các tác vụ cần thực hiện khi khởi động server."""
     logger.info("Khởi động Family Assistant API server (Tool Calling, No Weather)")
+    session_manager.migrate_legacy_sessions()
+    session_manager.start_background_flush()
+    await http_client.start()
+    chat_summary_queue.start()
+    tts_service.start_pruning()
+    global feng_shui_precompute_task
+    try:
+        await asyncio.to_thread(cleanup_temp_dir)
+    except Exception as e:
+        logger.error(f"Lỗi khi dọn thư mục tạm: {e}", exc_info=True)
+    if OPENAI_API_KEY_ENV:
+        feng_shui_precompute_task = asyncio.create_task(feng_shui_precompute_loop(OPENAI_API_KEY_ENV))
     logger.info("Đã tải dữ liệu và sẵn sàng hoạt động.")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Các tác vụ cần thực hiện khi đóng server."""
     logger.info("Đóng Family Assistant API server...")
-    save_data(FAMILY_DATA_FILE, family_data)
-    save_data(EVENTS_DATA_FILE, events_data)
-    save_data(NOTES_DATA_FILE, notes_data)
-    save_data(CHAT_HISTORY_FILE, chat_history)
+    await chat_summary_queue.stop()
+    if sqlite_store:
+        # Mỗi thay đổi đã được commit; không ghi đè toàn bộ bảng bằng dữ liệu trong bộ nhớ của worker này
+        sqlite_store.close()
+    else:
+        save_data(FAMILY_DATA_FILE, family_data)
+        save_data(EVENTS_DATA_FILE, events_data)
+        save_data(NOTES_DATA_FILE, notes_data)
+        save_data(CHAT_HISTORY_FILE, chat_history)
+    await session_manager.stop_background_flush()
+    if feng_shui_precompute_task is not None:
+        feng_shui_precompute_task.cancel()
+        await asyncio.gather(feng_shui_precompute_task, return_exceptions=True)
+    await openai_pool.aclose()
+    await http_client.aclose()
+    tts_service.shutdown()
+    image_preprocessor.shutdown()
     session_manager._save_sessions()
     logger.info("Đã lưu dữ liệu. Server tắt.")
 
@@ -4868,8 +7455,15 @@ if __name__ == "__main__":
     parser.add_argument("--host", type=str, default="0.0.0.0", help="Host IP")
     parser.add_argument("--port", type=int, default=8000, help="Port")
     parser.add_argument("--reload", action="store_true", help="Auto reload server on code changes")
+    parser.add_argument("--migrate-sqlite", action="store_true", help="Migrate dữ liệu JSON sang SQLite (SQLITE_DB_FILE) rồi thoát")
     args = parser.parse_args()
 
+    if args.migrate_sqlite:
+        migration_store = sqlite_store or SqliteDataStore(SQLITE_DB_FILE)
+        migration_store.migrate_from_json(data_store, SQLITE_FILE_TABLES, force=True)
+        logger.info(f"Đã migrate dữ liệu JSON sang {SQLITE_DB_FILE}")
+        raise SystemExit(0)
+
     log_level = "debug" if args.reload else "info"
 
     logger.info(f"Khởi động Trợ lý Gia đình API (Tool Calling - No Weather) trên http://{args.host}:{args.port}")
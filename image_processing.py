@@ -0,0 +1,60 @@
+"""Tiền xử lý ảnh trước khi gửi tới model vision.
+
+Module tách riêng khỏi app.py và chỉ phụ thuộc Pillow để các process con của
+ProcessPoolExecutor import nhanh, không khởi tạo lại dữ liệu/kết nối của server.
+"""
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+OUTPUT_FORMATS = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def target_size(width, height, max_dimension, max_short_side, max_pixels):
+    """Kích thước sau khi thu nhỏ (giữ tỉ lệ, không phóng to) theo cạnh dài, cạnh ngắn và tổng số pixel."""
+    scale = 1.0
+    if max_dimension and max(width, height) > max_dimension:
+        scale = min(scale, max_dimension / max(width, height))
+    if max_short_side and min(width, height) > max_short_side:
+        scale = min(scale, max_short_side / min(width, height))
+    if max_pixels and width * height * scale * scale > max_pixels:
+        scale = min(scale, (max_pixels / (width * height)) ** 0.5)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def preprocess_image_bytes(data, max_dimension=2048, max_short_side=768, max_pixels=2048 * 768,
+                           output_format="JPEG", quality=85):
+    """
+    Xoay theo EXIF, thu nhỏ, bỏ metadata và nén lại ảnh. data là bytes hoặc file nhị phân đã mở.
+    Trả về (bytes, mime_type, (width, height)).
+    """
+    output_format = output_format.upper() if output_format.upper() in OUTPUT_FORMATS else "JPEG"
+    source = BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+    with Image.open(source) as img:
+        size = target_size(img.width, img.height, max_dimension, max_short_side, max_pixels)
+        if img.format == "JPEG":
+            # Giải mã JPEG ở độ phân giải giảm sẵn (nhanh hơn và tốn ít bộ nhớ hơn nhiều với ảnh điện thoại)
+            img.draft("RGB", size)
+        img = ImageOps.exif_transpose(img)
+        size = target_size(img.width, img.height, max_dimension, max_short_side, max_pixels)
+
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if output_format == "WEBP" and has_alpha:
+            img = img.convert("RGBA")
+        elif has_alpha:
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img.convert("RGBA"), mask=img.convert("RGBA").getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+
+        buffered = BytesIO()
+        # Không truyền exif/icc_profile khi lưu: metadata (GPS, thiết bị...) bị loại bỏ
+        if output_format == "JPEG":
+            img.save(buffered, format="JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            img.save(buffered, format="WEBP", quality=quality, method=4)
+        return buffered.getvalue(), OUTPUT_FORMATS[output_format], img.size
@@ -0,0 +1,15 @@
+"""Cấu hình chung cho test.
+
+app.py đọc DATA_DIR/STORAGE_BACKEND và tải dữ liệu ngay khi import, nên biến môi trường
+phải được đặt trước khi bất kỳ file test nào import app: mọi file dữ liệu được tạo trong
+một thư mục tạm, không đụng tới data/ của repo.
+"""
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="family-assistant-test-")
+os.environ["STORAGE_BACKEND"] = "json"
@@ -0,0 +1,82 @@
+"""Test BlobStore: ghi/đọc theo SHA-256, thay payload base64 trong tin nhắn bằng tham chiếu và khôi phục lại."""
+import base64
+import hashlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+PAYLOAD = bytes(range(256)) * 16
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    blob_store = app.BlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(app, "blob_store", blob_store)
+    return blob_store
+
+
+def test_put_get_round_trip_and_dedup(store):
+    digest = store.put(PAYLOAD)
+
+    assert digest == hashlib.sha256(PAYLOAD).hexdigest()
+    assert store.put(PAYLOAD) == digest
+    assert store.get(digest) == PAYLOAD
+
+
+@pytest.mark.parametrize("digest", ["0" * 64, "../../etc/passwd", "ABC", "", None])
+def test_get_unknown_or_invalid_digest_returns_none(store, digest):
+    assert store.get(digest) is None
+
+
+def test_offload_and_resolve_message_round_trip(store):
+    data_url = "data:image/png;base64," + base64.b64encode(PAYLOAD).decode("ascii")
+    audio = base64.b64encode(PAYLOAD[::-1]).decode("ascii")
+    messages = [
+        {"role": "user", "content": [
+            {"type": "text", "text": "xem ảnh"},
+            {"type": "image_url", "image_url": {"url": data_url, "detail": "low"}},
+            {"type": "audio", "audio_data": audio},
+        ]},
+        {"role": "assistant", "content": "được"},
+    ]
+
+    offloaded = app.offload_message_blobs(messages)
+    image_url = offloaded[0]["content"][1]["image_url"]
+    assert image_url["url"] == app.BLOB_REF_PREFIX + hashlib.sha256(PAYLOAD).hexdigest()
+    assert image_url["mime_type"] == "image/png"
+    assert offloaded[0]["content"][2]["audio_data"].startswith(app.BLOB_REF_PREFIX)
+    assert offloaded[1] is messages[1]
+
+    assert app.resolve_message_blobs(offloaded) == messages
+
+
+def test_small_payloads_stay_inline(store):
+    small = "data:image/png;base64," + base64.b64encode(b"nho").decode("ascii")
+    content = [{"type": "image_url", "image_url": {"url": small}}]
+
+    assert app.offload_content_blobs(content) == content
+
+
+def test_missing_blob_resolves_to_placeholder(store):
+    messages = [{"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": app.BLOB_REF_PREFIX + "f" * 64, "mime_type": "image/png"}}]}]
+
+    assert app.resolve_message_blobs(messages)[0]["content"] == [{"type": "text", "text": app.MISSING_BLOB_PLACEHOLDER}]
+
+
+def test_blob_endpoint_serves_only_allow_listed_types_inline(store):
+    digest = store.put(b"<script>alert(1)</script>")
+    client = TestClient(app.app)
+
+    image = client.get(f"/blob/{digest}", params={"mime_type": "image/png"})
+    assert image.headers["content-type"] == "image/png"
+    assert image.headers["x-content-type-options"] == "nosniff"
+    assert "content-disposition" not in image.headers
+
+    html = client.get(f"/blob/{digest}", params={"mime_type": "text/html"})
+    assert html.headers["content-type"] == "application/octet-stream"
+    assert html.headers["content-disposition"].startswith("attachment")
+
+    assert client.get(f"/blob/{'0' * 64}").status_code == 404
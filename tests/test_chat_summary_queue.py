@@ -0,0 +1,52 @@
+"""Test ChatSummaryQueue khi chưa có worker: task tóm tắt nền được giữ tham chiếu và lỗi được ghi log."""
+import asyncio
+import logging
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def summaries(monkeypatch):
+    """Thay LLM và ghi chat_history bằng hàm giả; trả về danh sách (member, session, tóm tắt, số tin nhắn)."""
+    written = []
+
+    async def fake_summary(messages, api_key):
+        await asyncio.sleep(0.01)
+        if api_key == "sk-boom":
+            raise RuntimeError("LLM sập")
+        return f"tóm tắt {len(messages)}"
+
+    monkeypatch.setattr(app, "generate_chat_summary", fake_summary)
+    monkeypatch.setattr(app, "update_chat_history_summary", lambda *args: written.append(args))
+    monkeypatch.setattr(app, "chat_history_summarized_count", lambda member_id, session_id: 0)
+    return written
+
+
+def test_fallback_task_is_tracked_until_done(summaries):
+    queue = app.ChatSummaryQueue()
+
+    async def main():
+        queue.submit("m1", "s1", ["a", "b"], "sk-test")
+        assert len(queue._tasks) == 1
+        await asyncio.gather(*queue._tasks)
+
+    asyncio.run(main())
+    assert summaries == [("m1", "s1", "tóm tắt 2", 2)]
+    assert not queue._tasks and not queue._states
+
+
+def test_fallback_task_error_is_logged(summaries, caplog):
+    queue = app.ChatSummaryQueue()
+
+    async def main():
+        queue.submit("m1", "s1", ["a"], "sk-boom")
+        await asyncio.gather(*queue._tasks, return_exceptions=True)
+        await asyncio.sleep(0)  # chạy done-callback
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(main())
+    assert summaries == []
+    assert not queue._tasks
+    assert any("LLM sập" in record.getMessage() for record in caplog.records)
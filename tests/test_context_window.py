@@ -0,0 +1,90 @@
+"""Test build_context_messages: cắt theo lượt trong ngân sách token, bỏ ảnh cũ và chèn tóm tắt cuốn chiếu."""
+import app
+
+
+def make_turns(count, text="x" * 400):
+    messages = []
+    for i in range(count):
+        messages.append({"role": "user", "content": f"câu hỏi {i} {text}"})
+        messages.append({"role": "assistant", "content": f"trả lời {i} {text}"})
+    return messages
+
+
+def test_short_history_is_kept_verbatim():
+    messages = make_turns(2, text="ngắn")
+    context = app.build_context_messages("hệ thống", "ctx-short", messages, None, token_budget=6000, recent_turns=4)
+
+    assert context[0] == {"role": "system", "content": "hệ thống"}
+    assert [msg["content"] for msg in context[1:]] == [msg["content"] for msg in messages]
+
+
+def test_old_turns_are_trimmed_to_fit_budget():
+    messages = make_turns(10)
+    turn_tokens = sum(app.estimate_message_tokens(msg) for msg in messages[:2])
+    budget = turn_tokens * 3 + app.estimate_text_tokens("hệ thống") + app.CONTEXT_MESSAGE_OVERHEAD_TOKENS
+
+    context = app.build_context_messages("hệ thống", "ctx-trim", messages, None, token_budget=budget, recent_turns=1)
+
+    assert [msg["content"] for msg in context[1:]] == [msg["content"] for msg in messages[-6:]]
+
+
+def test_recent_turns_are_kept_even_over_budget():
+    messages = make_turns(5)
+    context = app.build_context_messages("hệ thống", "ctx-recent", messages, None, token_budget=300, recent_turns=3)
+
+    # Lượt hiện tại luôn được giữ; các lượt gần đây được giữ khi từng lượt không vượt ngân sách
+    assert context[-1]["content"] == messages[-1]["content"]
+    assert len(context) - 1 == 6
+
+
+def test_turns_are_never_split_between_tool_calls_and_results():
+    messages = make_turns(3) + [
+        {"role": "user", "content": "thêm sự kiện"},
+        {"role": "assistant", "content": None, "tool_calls": [
+            {"id": "call_1", "type": "function", "function": {"name": "add_event", "arguments": "{}"}}]},
+        {"role": "tool", "tool_call_id": "call_1", "content": "đã thêm"},
+        {"role": "assistant", "content": "Đã thêm sự kiện."},
+    ]
+    context = app.build_context_messages("hệ thống", "ctx-tools", messages, None, token_budget=200, recent_turns=1)
+
+    roles = [msg["role"] for msg in context[1:]]
+    assert roles == ["user", "assistant", "tool", "assistant"]
+
+
+def test_images_are_kept_only_in_current_turn():
+    image = {"type": "image_url", "image_url": {"url": "https://example.com/a.jpg"}}
+    messages = [
+        {"role": "user", "content": [{"type": "text", "text": "ảnh cũ"}, image]},
+        {"role": "assistant", "content": "đã xem"},
+        {"role": "user", "content": [{"type": "text", "text": "ảnh mới"}, image]},
+    ]
+    context = app.build_context_messages("hệ thống", "ctx-images", messages, None, token_budget=6000, recent_turns=4)
+
+    assert context[1]["content"][1] == {"type": "text", "text": app.STRIPPED_IMAGE_PLACEHOLDER}
+    assert context[3]["content"][1] == image
+
+
+def test_cached_summary_replaces_trimmed_turns():
+    messages = make_turns(6)
+    covered = 4
+    app.context_summary_cache.set("ctx-summary", {
+        "summary": "Hai lượt đầu hỏi về lịch họp.",
+        "covered": covered,
+        "fingerprint": app.context_summary_fingerprint(
+            [app.session_message_for_api(msg) for msg in messages], covered),
+    })
+
+    context = app.build_context_messages("hệ thống", "ctx-summary", messages, None, token_budget=600, recent_turns=1)
+
+    assert context[1]["role"] == "system"
+    assert "Hai lượt đầu hỏi về lịch họp." in context[1]["content"]
+    assert context[2]["role"] == "user"
+
+
+def test_summary_for_rewritten_history_is_ignored():
+    messages = make_turns(6)
+    app.context_summary_cache.set("ctx-stale", {"summary": "cũ", "covered": 4, "fingerprint": "khác"})
+
+    context = app.build_context_messages("hệ thống", "ctx-stale", messages, None, token_budget=600, recent_turns=1)
+
+    assert [msg["role"] for msg in context[1:]] == ["user", "assistant", "user", "assistant"]
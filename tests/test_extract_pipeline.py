@@ -0,0 +1,61 @@
+"""Test tavily_extract_cached: mỗi URL một request, giữ nguồn xong trước hạn chót, dừng sớm khi đủ nội dung."""
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def tavily(monkeypatch):
+    """Thay tavily_extract bằng hàm giả; delays[url] là số giây chờ, trả về danh sách URL đã gọi."""
+    delays, calls = {}, []
+
+    async def fake_extract(api_key, urls, timeout=30, **kwargs):
+        (url,) = urls
+        calls.append(url)
+        await asyncio.sleep(delays.get(url, 0.01))
+        return {"results": [{"url": url + "/", "raw_content": f"nội dung {url} " * 50}]}
+
+    monkeypatch.setattr(app, "tavily_extract", fake_extract)
+    monkeypatch.setattr(app, "extract_cache", app.TTLCache("test_extract", max_size=16, ttl_seconds=60))
+    monkeypatch.setattr(app, "EXTRACT_MAX_CONCURRENCY", 0)
+    return delays, calls
+
+
+def extract(urls, **kwargs):
+    return asyncio.run(app.tavily_extract_cached("tvly-test", urls, **kwargs))
+
+
+def test_deadline_keeps_finished_pages_and_drops_slow_one(tavily):
+    delays, calls = tavily
+    delays["https://slow.example"] = 5
+
+    result = extract(["https://a.example", "https://slow.example", "https://b.example"], deadline=0.2)
+
+    assert [item["url"] for item in result["results"]] == ["https://a.example/", "https://b.example/"]
+    # Nguồn xong trước hạn được cache theo URL đã gửi
+    assert app.extract_cache.get("https://a.example") is not None
+    assert app.extract_cache.get("https://slow.example") is None
+    assert sorted(calls) == ["https://a.example", "https://b.example", "https://slow.example"]
+
+
+def test_stops_early_once_enough_content(tavily):
+    delays, calls = tavily
+    delays["https://b.example"] = 5
+
+    result = extract(["https://a.example", "https://b.example"], deadline=2, max_total_len=100)
+
+    assert [item["url"] for item in result["results"]] == ["https://a.example/"]
+
+
+def test_cached_pages_skip_requests_and_bounded_fan_out(tavily, monkeypatch):
+    delays, calls = tavily
+    monkeypatch.setattr(app, "EXTRACT_MAX_CONCURRENCY", 1)
+    extract(["https://a.example"])
+    calls.clear()
+
+    result = extract(["https://a.example", "https://b.example", "https://c.example"])
+
+    assert calls == ["https://b.example", "https://c.example"]
+    assert len(result["results"]) == 3
@@ -0,0 +1,59 @@
+"""Test phân loại ý định bằng luật (classify_query_locally) trước khi gọi LLM."""
+import asyncio
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("query", ["xin chào", "Cảm ơn bạn!", "ok", "thêm lịch họp phụ huynh", "xóa ghi chú đi chợ"])
+def test_small_talk_and_event_commands_need_no_lookup(query):
+    assert app.classify_query_locally(query) == {"intent": None, "result": None}
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("thời tiết Đà Nẵng ngày mai", (True, "Da Nang", "ngày mai")),
+    ("thời tiết hôm nay ở hà nội thế nào", (True, "Hanoi", "hôm nay")),
+    ("nhiệt độ đà lạt thứ 7", (True, "Da Lat", "thứ 7")),
+    ("Thời tiết  SÀI GÒN", (True, "Ho Chi Minh City", None)),
+])
+def test_clear_weather_questions_are_classified_locally(query, expected):
+    assert app.classify_query_locally(query) == {"intent": "weather", "result": expected}
+
+
+@pytest.mark.parametrize("query", [
+    "mai ở huế có nên mang ô không",   # tư vấn: cần LLM
+    "giá vàng hôm nay",                 # tìm kiếm
+    "thời tiết hà nội và huế",          # nhiều địa điểm
+    "thời tiết sài gòn tối nay",        # mốc thời gian mơ hồ
+    "thời tiết ở quê tôi",              # địa điểm chưa biết
+    "kể chuyện cười đi",
+    "",
+])
+def test_ambiguous_questions_fall_through_to_llm(query):
+    assert app.classify_query_locally(query) is None
+
+
+def collect_decisions(query, tavily_api_key="tvly-test"):
+    async def collect():
+        return [decision async for decision in app.route_search_intent(query, "sk-test", tavily_api_key)]
+    return asyncio.run(collect())
+
+
+def test_router_uses_fast_path_without_calling_classifiers(monkeypatch):
+    async def unexpected(*args):
+        raise AssertionError("không được gọi bộ phân loại LLM")
+
+    monkeypatch.setattr(app, "INTENT_FAST_PATH", True)
+    monkeypatch.setattr(app, "OPENWEATHERMAP_API_KEY", "owm-test")
+    monkeypatch.setattr(app, "detect_search_intent", unexpected)
+    monkeypatch.setattr(app.WeatherQueryParser, "parse_weather_query", staticmethod(unexpected))
+    monkeypatch.setattr(app.WeatherAdvisor, "detect_weather_advice_need", staticmethod(unexpected))
+
+    assert collect_decisions("xin chào") == []
+    [decision] = collect_decisions("thời tiết huế ngày mai")
+    assert decision["intent"] == "weather" and decision["result"] == (True, "Hue", "ngày mai")
+
+    # Không có API thời tiết: câu hỏi thời tiết không cần tra cứu gì thêm
+    monkeypatch.setattr(app, "OPENWEATHERMAP_API_KEY", None)
+    assert collect_decisions("thời tiết huế ngày mai") == []
@@ -0,0 +1,119 @@
+"""Test route_search_intent/check_search_need: chạy song song các bộ phân loại, xét theo ưu tiên và thử ý định kế tiếp."""
+import asyncio
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def classifiers(monkeypatch):
+    """Thay ba bộ phân loại LLM bằng hàm giả; trả về dict kết quả (sửa được), danh sách lời gọi,
+    thời gian chờ (giây) theo tên và danh sách bộ phân loại bị huỷ."""
+    results = {
+        "advice": (True, "clothing", "Hue", None),
+        "weather": (True, "Hue", None),
+        "search": (True, "thời tiết huế", False, False),
+    }
+    calls, delays, cancelled = [], {}, []
+
+    def fake(name):
+        async def classify(*args):
+            calls.append(name)
+            try:
+                await asyncio.sleep(delays.get(name, 0.01))
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+            return results[name]
+        return classify
+
+    monkeypatch.setattr(app, "INTENT_FAST_PATH", False)
+    monkeypatch.setattr(app, "INTENT_ROUTER_MODE", "chain")
+    monkeypatch.setattr(app, "OPENWEATHERMAP_API_KEY", "owm-test")
+    monkeypatch.setattr(app.WeatherAdvisor, "detect_weather_advice_need", staticmethod(fake("advice")))
+    monkeypatch.setattr(app.WeatherQueryParser, "parse_weather_query", staticmethod(fake("weather")))
+    monkeypatch.setattr(app, "detect_search_intent", fake("search"))
+    return results, calls, delays, cancelled
+
+
+def first_decision(query):
+    async def run():
+        decisions = app.route_search_intent(query, "sk-test", "tvly-test")
+        try:
+            return await decisions.__anext__()
+        finally:
+            await decisions.aclose()
+    return asyncio.run(run())
+
+
+def test_classifiers_start_together_and_lower_ones_cancelled_on_close(classifiers):
+    results, calls, delays, cancelled = classifiers
+    delays.update({"weather": 5, "search": 5})
+
+    started = time.perf_counter()
+    assert first_decision("nên mặc gì ở huế")["intent"] == "advice"
+    assert time.perf_counter() - started < 1
+    assert sorted(calls) == ["advice", "search", "weather"]
+    assert sorted(cancelled) == ["search", "weather"]
+
+
+def test_negative_classifier_moves_to_next(classifiers):
+    results, calls, delays, cancelled = classifiers
+    results["advice"] = (False, None, None, None)
+
+    assert first_decision("thời tiết huế")["intent"] == "weather"
+
+
+def test_no_intent_turn_costs_one_round_trip(classifiers):
+    results, calls, delays, cancelled = classifiers
+    results.update({"advice": (False, None, None, None), "weather": (False, None, None), "search": (False, None, False, False)})
+    delays.update({"advice": 0.2, "weather": 0.2, "search": 0.2})
+
+    async def run():
+        return [decision async for decision in app.route_search_intent("xin hỏi", "sk-test", "tvly-test")]
+
+    started = time.perf_counter()
+    assert asyncio.run(run()) == []
+    # Ba bộ phân loại chạy song song: tổng thời gian xấp xỉ một lời gọi, không phải ba
+    assert time.perf_counter() - started < 0.5
+
+
+def test_lower_classifier_keeps_running_while_caller_fetches(classifiers):
+    results, calls, delays, cancelled = classifiers
+
+    async def run():
+        decisions = app.route_search_intent("nên mặc gì ở huế", "sk-test", "tvly-test")
+        try:
+            first = await decisions.__anext__()
+            await asyncio.sleep(0.05)  # người gọi đang lấy dữ liệu cho ý định đầu tiên
+            second = await decisions.__anext__()
+            return first["intent"], second["intent"]
+        finally:
+            await decisions.aclose()
+
+    assert asyncio.run(run()) == ("advice", "weather")
+    assert cancelled == []
+
+
+def test_check_search_need_falls_back_when_intent_has_no_data(classifiers, monkeypatch):
+    results, calls, delays, cancelled = classifiers
+
+    async def no_weather(self, **kwargs):
+        return None, None
+
+    async def fake_search(*args, **kwargs):
+        return "kết quả tìm kiếm"
+
+    monkeypatch.setattr(app.WeatherService, "get_bundle", no_weather)
+    monkeypatch.setattr(app, "search_and_summarize", fake_search)
+
+    prompt = asyncio.run(app.check_search_need([{"role": "user", "content": "nên mặc gì ở huế"}], "sk-test", "tvly-test"))
+    # Tư vấn không có dữ liệu thời tiết -> thử "weather"; weather báo lỗi thời tiết thay vì tìm kiếm web
+    assert "LỖI THỜI TIẾT" in prompt
+
+    results["weather"] = (False, None, None)
+    prompt = asyncio.run(app.check_search_need([{"role": "user", "content": "nên mặc gì ở huế"}], "sk-test", "tvly-test"))
+    assert "kết quả tìm kiếm" in prompt
+    assert sorted(calls) == ["advice", "advice", "search", "search", "weather", "weather"]
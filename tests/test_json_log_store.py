@@ -0,0 +1,108 @@
+"""Test JsonLogStore: replay write-ahead log, dòng ghi dở, push/patch list và compaction."""
+import json
+import os
+
+import app
+
+
+def make_store(tmp_path):
+    return app.JsonLogStore(compact_threshold_bytes=10 ** 9), str(tmp_path / "data.json")
+
+
+def read_log_entries(file_path):
+    with open(file_path + ".log", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_append_replays_sets_and_deletes(tmp_path):
+    store, file_path = make_store(tmp_path)
+    data = {"a": {"name": "An"}, "b": {"name": "Bình"}}
+    store.append(file_path, data, ["a", "b"])
+    del data["a"]
+    data["b"]["name"] = "Bình 2"
+    store.append(file_path, data, ["a", "b"])
+
+    assert store.load(file_path) == {"b": {"name": "Bình 2"}}
+    assert [entry["op"] for entry in read_log_entries(file_path)] == ["set", "set", "del", "set"]
+
+
+def test_append_writes_only_changed_keys(tmp_path):
+    store, file_path = make_store(tmp_path)
+    data = {str(i): i for i in range(100)}
+    store.write_snapshot(file_path, data)
+    data["7"] = "bảy"
+    store.append(file_path, data, ["7"])
+
+    assert read_log_entries(file_path) == [{"op": "set", "key": "7", "value": "bảy"}]
+    assert store.load(file_path)["7"] == "bảy"
+
+
+def test_truncated_last_line_is_dropped(tmp_path):
+    store, file_path = make_store(tmp_path)
+    store.append(file_path, {"a": 1}, ["a"])
+    with open(file_path + ".log", "ab") as f:
+        f.write(b'{"op": "set", "key": "b", "val')
+
+    assert store.load(file_path) == {"a": 1}
+    # Phần ghi dở bị cắt bỏ nên các bản ghi sau vẫn replay được
+    store.append(file_path, {"a": 1, "c": 3}, ["c"])
+    assert store.load(file_path) == {"a": 1, "c": 3}
+
+
+def test_corrupt_line_in_middle_is_skipped(tmp_path):
+    store, file_path = make_store(tmp_path)
+    store.append(file_path, {"a": 1}, ["a"])
+    with open(file_path + ".log", "a", encoding="utf-8") as f:
+        f.write("không phải json\n")
+    store.append(file_path, {"b": 2}, ["b"])
+
+    assert store.load(file_path) == {"a": 1, "b": 2}
+
+
+def test_push_and_patch_keep_list_bounded(tmp_path):
+    store, file_path = make_store(tmp_path)
+    for i in range(5):
+        store.push(file_path, "m1", {"n": i, "session_id": f"s{i % 4}"}, limit=3)
+    # Khớp bản mới nhất của session, không phụ thuộc vị trí trong list
+    store.patch(file_path, "m1", "s3", {"summary": "tóm tắt"})
+    # Session không còn trong list bị bỏ qua thay vì làm hỏng dữ liệu
+    store.patch(file_path, "m1", "s1", {"summary": "x"})
+
+    assert store.load(file_path) == {"m1": [
+        {"n": 4, "session_id": "s0"}, {"n": 3, "session_id": "s3", "summary": "tóm tắt"}, {"n": 2, "session_id": "s2"}]}
+    assert all("n" in entry["value"] for entry in read_log_entries(file_path) if entry["op"] == "push")
+
+
+def test_compaction_folds_log_into_snapshot(tmp_path):
+    store, file_path = make_store(tmp_path)
+    store.write_snapshot(file_path, {"a": 1})
+    store.append(file_path, {"a": 1, "b": 2}, ["b"])
+    store.push(file_path, "list", "x")
+    expected = store.load(file_path)
+
+    store._compact(file_path)
+
+    assert not os.path.exists(file_path + ".log")
+    assert not os.path.exists(file_path + ".log.compacting")
+    with open(file_path, encoding="utf-8") as f:
+        assert json.load(f) == expected
+    assert store.load(file_path) == expected
+
+
+def test_leftover_compacting_log_is_replayed_before_log(tmp_path):
+    store, file_path = make_store(tmp_path)
+    store.append(file_path, {"a": 1}, ["a"])
+    # Mô phỏng crash giữa lúc compaction: log cũ đã đổi tên, log mới ghi tiếp sau đó
+    os.replace(file_path + ".log", file_path + ".log.compacting")
+    store.append(file_path, {"a": 2}, ["a"])
+
+    assert store.load(file_path) == {"a": 2}
+
+
+def test_write_snapshot_discards_log(tmp_path):
+    store, file_path = make_store(tmp_path)
+    store.append(file_path, {"a": 1}, ["a"])
+    store.write_snapshot(file_path, {"b": 2})
+
+    assert not os.path.exists(file_path + ".log")
+    assert store.load(file_path) == {"b": 2}
@@ -0,0 +1,97 @@
+"""Test SessionManager: mỗi session một file, tải lười, LRU có pin và tách file sessions cũ."""
+import json
+import os
+
+import app
+
+
+def make_manager(tmp_path, cache_size=200, legacy_sessions_file=None):
+    return app.SessionManager(
+        sessions_dir=str(tmp_path / "sessions"),
+        index_file=str(tmp_path / "sessions_index.json"),
+        flush_interval=0,
+        cache_size=cache_size,
+        legacy_sessions_file=legacy_sessions_file,
+    )
+
+
+def test_each_session_is_stored_in_its_own_file(tmp_path):
+    manager = make_manager(tmp_path)
+    manager.get_session("s1")
+    manager.update_session("s1", {"messages": [{"role": "user", "content": "chào"}], "current_member": "m1"})
+
+    with open(tmp_path / "sessions" / "s1.json", encoding="utf-8") as f:
+        assert json.load(f)["messages"] == [{"role": "user", "content": "chào"}]
+    assert manager.list_metadata()["s1"]["message_count"] == 1
+    assert manager.list_metadata()["s1"]["member_id"] == "m1"
+
+
+def test_unsafe_session_id_is_hashed_inside_sessions_dir(tmp_path):
+    manager = make_manager(tmp_path)
+    path = manager._session_path("../../etc/passwd")
+
+    assert os.path.dirname(path) == str(tmp_path / "sessions")
+    assert os.path.basename(path).startswith("sha256-")
+
+
+def test_sessions_are_loaded_lazily_from_index(tmp_path):
+    manager = make_manager(tmp_path)
+    manager.get_session("s1")
+    manager.update_session("s1", {"messages": [{"role": "user", "content": "xin chào"}]})
+    manager._save_sessions()
+
+    reopened = make_manager(tmp_path)
+    assert "s1" in reopened.list_metadata()
+    assert not reopened.sessions
+    assert reopened.get_session("s1")["messages"] == [{"role": "user", "content": "xin chào"}]
+
+
+def test_lru_evicts_least_recently_used_after_writing(tmp_path):
+    manager = make_manager(tmp_path, cache_size=2)
+    for session_id in ("s1", "s2", "s3"):
+        manager.get_session(session_id)
+        manager.update_session(session_id, {"suggested_question": session_id})
+
+    assert list(manager.sessions) == ["s2", "s3"]
+    # Session bị đẩy ra vẫn đọc lại được từ file
+    assert manager.get_session("s1")["suggested_question"] == "s1"
+
+
+def test_pinned_session_is_not_evicted_until_unpinned(tmp_path):
+    manager = make_manager(tmp_path, cache_size=1)
+    session = manager.get_session("s1")
+    manager.pin("s1")
+    manager.get_session("s2")
+    manager.get_session("s3")
+    assert manager.sessions.get("s1") is session
+
+    # Thay đổi của request đang giữ session vẫn được ghi
+    session["messages"].append({"role": "user", "content": "đang xử lý"})
+    manager.update_session("s1", {})
+    manager.unpin("s1")
+    manager.get_session("s2")
+
+    assert list(manager.sessions) == ["s2"]
+    assert manager.get_session("s1")["messages"] == [{"role": "user", "content": "đang xử lý"}]
+
+
+def test_legacy_sessions_file_is_migrated_once_without_renaming(tmp_path):
+    legacy_file = str(tmp_path / "sessions_data.json")
+    legacy = {"old": {"messages": [{"role": "user", "content": "cũ"}], "current_member": "m1"}}
+    with open(legacy_file, "w", encoding="utf-8") as f:
+        json.dump(legacy, f)
+
+    manager = make_manager(tmp_path, legacy_sessions_file=legacy_file)
+    manager.migrate_legacy_sessions()
+
+    assert os.path.exists(legacy_file)
+    assert os.path.exists(tmp_path / "sessions" / ".legacy_migrated")
+    assert manager.get_session("old")["messages"] == [{"role": "user", "content": "cũ"}]
+
+    # Lần khởi động sau: đã có marker nên file cũ không được đọc lại
+    with open(legacy_file, "w", encoding="utf-8") as f:
+        json.dump({"other": {"messages": []}}, f)
+    reopened = make_manager(tmp_path, legacy_sessions_file=legacy_file)
+    reopened.migrate_legacy_sessions()
+    assert "other" not in reopened.list_metadata()
+    assert "old" in reopened.list_metadata()
@@ -0,0 +1,75 @@
+"""Test SingleFlight: gộp lời gọi đồng thời cùng key, không giữ kết quả sau khi xong."""
+import asyncio
+
+import pytest
+
+import app
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = app.SingleFlight("test_shared")
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "kết quả"
+
+    async def main():
+        return await asyncio.gather(*(flight.do("key", work) for _ in range(5)))
+
+    assert asyncio.run(main()) == ["kết quả"] * 5
+    assert len(calls) == 1
+
+
+def test_different_keys_and_later_calls_run_again():
+    flight = app.SingleFlight("test_keys")
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0)
+        return value
+
+    async def main():
+        first = await asyncio.gather(flight.do("a", lambda: work("a")), flight.do("b", lambda: work("b")))
+        again = await flight.do("a", lambda: work("a2"))
+        return first, again
+
+    assert asyncio.run(main()) == (["a", "b"], "a2")
+    assert calls == ["a", "b", "a2"]
+
+
+def test_exception_reaches_every_waiter_and_clears_key():
+    flight = app.SingleFlight("test_error")
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("lỗi")
+
+    async def main():
+        results = await asyncio.gather(flight.do("key", fail), flight.do("key", fail), return_exceptions=True)
+        assert not flight._inflight
+        return results
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelled_caller_does_not_cancel_shared_task():
+    flight = app.SingleFlight("test_cancel")
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "xong"
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do("key", work))
+        follower = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "xong"
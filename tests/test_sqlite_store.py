@@ -0,0 +1,96 @@
+"""Test SqliteDataStore: phát hiện bảng do worker khác ghi, tải lại theo bảng và lịch sử chat."""
+import asyncio
+
+import app
+
+
+def open_stores(tmp_path):
+    db_path = str(tmp_path / "family.db")
+    return app.SqliteDataStore(db_path), app.SqliteDataStore(db_path)
+
+
+def test_changed_tables_reports_only_other_workers_writes(tmp_path):
+    worker_a, worker_b = open_stores(tmp_path)
+    try:
+        worker_a.save("events", {"e1": {"title": "Họp", "created_by": "m1"}}, ["e1"])
+
+        assert worker_a.changed_tables() == set()
+        assert worker_b.changed_tables() == {"events"}
+        assert worker_b.load("events") == {"e1": {"title": "Họp", "created_by": "m1"}}
+        # Đã thấy phiên bản mới: lần kiểm tra sau không báo lại
+        assert worker_b.changed_tables() == set()
+
+        worker_b.save("notes", {"n1": {"title": "Ghi chú"}}, ["n1"])
+        assert worker_a.changed_tables() == {"notes"}
+    finally:
+        worker_a.close()
+        worker_b.close()
+
+
+def test_save_with_changed_keys_updates_and_deletes(tmp_path):
+    store, other = open_stores(tmp_path)
+    try:
+        data = {"e1": {"title": "A"}, "e2": {"title": "B"}}
+        store.save("events", data)
+        del data["e1"]
+        data["e2"]["title"] = "B2"
+        store.save("events", data, ["e1", "e2"])
+
+        assert other.load("events") == {"e2": {"title": "B2"}}
+    finally:
+        store.close()
+        other.close()
+
+
+def test_chat_history_push_patch_and_limit(tmp_path):
+    store, other = open_stores(tmp_path)
+    try:
+        store.save("chat_history", {"m1": [{"session_id": "old", "timestamp": "t0"}]})
+        for i in range(4):
+            store.push("chat_history", "m1", {"session_id": f"s{i}", "timestamp": f"t{i + 1}"}, limit=3)
+        store.patch("chat_history", "m1", "s2", {"summary": "tóm tắt"})
+
+        history = other.load("chat_history")["m1"]
+        assert [entry["session_id"] for entry in history] == ["s3", "s2", "s1"]
+        assert history[1]["summary"] == "tóm tắt"
+        assert store.query_chat_history_by_member("m1", limit=1) == [history[0]]
+        assert [entry["session_id"] for _, entry in other.query_chat_history_by_session("s2")] == ["s2"]
+        assert other.changed_tables() == {"chat_history"}
+    finally:
+        store.close()
+        other.close()
+
+
+def test_patch_matches_session_after_other_worker_pushed(tmp_path):
+    worker_a, worker_b = open_stores(tmp_path)
+    try:
+        worker_a.push("chat_history", "m1", {"session_id": "s1", "timestamp": "t1"})
+        # Worker A tóm tắt s1 (vị trí 0 theo bộ nhớ của A) trong khi worker B vừa thêm s2 lên đầu
+        worker_b.push("chat_history", "m1", {"session_id": "s2", "timestamp": "t2"})
+        worker_a.patch("chat_history", "m1", "s1", {"summary": "tóm tắt s1", "summarized_count": 4})
+
+        history = worker_b.load("chat_history")["m1"]
+        assert [entry["session_id"] for entry in history] == ["s2", "s1"]
+        assert "summary" not in history[0]
+        assert history[1]["summary"] == "tóm tắt s1" and history[1]["summarized_count"] == 4
+    finally:
+        worker_a.close()
+        worker_b.close()
+
+
+def test_reload_shared_data_reloads_only_changed_tables(tmp_path, monkeypatch):
+    worker_a, worker_b = open_stores(tmp_path)
+    events, notes = {"stale": {}}, {"local": {"title": "chưa ghi"}}
+    monkeypatch.setattr(app, "sqlite_store", worker_b)
+    monkeypatch.setattr(app, "events_data", events)
+    monkeypatch.setattr(app, "notes_data", notes)
+    try:
+        worker_a.save("events", {"e1": {"title": "Họp"}}, ["e1"])
+        asyncio.run(app.reload_shared_data_if_stale())
+
+        # Cập nhật tại chỗ: các tham chiếu tới dict toàn cục vẫn thấy dữ liệu mới
+        assert app.events_data is events and events == {"e1": {"title": "Họp"}}
+        assert notes == {"local": {"title": "chưa ghi"}}
+    finally:
+        worker_a.close()
+        worker_b.close()
@@ -0,0 +1,88 @@
+"""Test transcribe_audio_cached: cache theo hash nội dung audio, gộp request đồng thời theo API key."""
+import asyncio
+import io
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def whisper(monkeypatch):
+    """Thay Whisper bằng hàm giả; trả về danh sách (api_key, nội dung file) của mỗi lời gọi."""
+    calls = []
+
+    async def fake_transcription(api_key, model, file):
+        filename, audio = file
+        calls.append((api_key, None))
+        await asyncio.sleep(0.01)
+        # Đọc sau khi chờ: file phải còn mở dù request dẫn đầu đã bị huỷ
+        content = audio if isinstance(audio, bytes) else audio.read()
+        calls[-1] = (api_key, content)
+        if api_key == "sk-bad":
+            raise RuntimeError("API key không hợp lệ")
+        return SimpleNamespace(text=f"transcript {len(content)}")
+
+    monkeypatch.setattr(app, "create_transcription", fake_transcription)
+    monkeypatch.setattr(app, "transcription_cache", app.TTLCache("test_transcription", max_size=16, ttl_seconds=60))
+    return calls
+
+
+def spooled(data):
+    spool = tempfile.SpooledTemporaryFile(max_size=8)
+    spool.write(data)
+    spool.seek(0)
+    return spool
+
+
+def test_same_audio_is_transcribed_once(whisper):
+    async def main():
+        first = await app.transcribe_audio_cached("sk-a", "a.wav", b"audio-1")
+        # Cùng nội dung, khác nguồn (file upload) và khác API key: dùng lại transcript đã cache
+        second = await app.transcribe_audio_cached("sk-b", "b.wav", spooled(b"audio-1"))
+        return first, second
+
+    assert asyncio.run(main()) == ("transcript 7", "transcript 7")
+    assert whisper == [("sk-a", b"audio-1")]
+
+
+def test_concurrent_identical_uploads_share_one_call(whisper):
+    async def main():
+        return await asyncio.gather(*(app.transcribe_audio_cached("sk-a", "a.wav", spooled(b"audio-2")) for _ in range(4)))
+
+    assert asyncio.run(main()) == ["transcript 7"] * 4
+    assert len(whisper) == 1
+
+
+def test_bad_key_error_is_not_shared_or_cached(whisper):
+    async def main():
+        results = await asyncio.gather(
+            app.transcribe_audio_cached("sk-bad", "a.wav", b"audio-3"),
+            app.transcribe_audio_cached("sk-good", "a.wav", b"audio-3"),
+            return_exceptions=True,
+        )
+        again = await app.transcribe_audio_cached("sk-good", "a.wav", b"audio-3")
+        return results, again
+
+    (bad, good), again = asyncio.run(main())
+    assert isinstance(bad, RuntimeError)
+    assert good == again == "transcript 7"
+    assert [api_key for api_key, _ in whisper] == ["sk-bad", "sk-good"]
+
+
+def test_leader_upload_closed_after_copy_does_not_break_shared_call(whisper):
+    async def main():
+        upload = spooled(b"audio-4")
+        leader = asyncio.ensure_future(app.transcribe_audio_cached("sk-a", "a.wav", upload))
+        follower = asyncio.ensure_future(app.transcribe_audio_cached("sk-a", "a.wav", io.BytesIO(b"audio-4")))
+        while not whisper:
+            await asyncio.sleep(0.001)
+        # Starlette đóng file của request khi client ngắt kết nối
+        leader.cancel()
+        upload.close()
+        return await follower
+
+    assert asyncio.run(main()) == "transcript 7"
+    assert whisper == [("sk-a", b"audio-4")]
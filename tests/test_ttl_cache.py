@@ -0,0 +1,88 @@
+"""Test TTLCache: hết hạn theo TTL, đẩy ra theo LRU, lưu xuống đĩa chỉ các key thay đổi."""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import app
+
+
+def read_log_entries(file_path):
+    with open(file_path + ".log", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_get_returns_default_after_ttl():
+    cache = app.TTLCache("test_ttl", max_size=10, ttl_seconds=60)
+    cache.set("fresh", 1)
+    cache.set("expired", 2, ttl_seconds=-1)
+
+    assert cache.get("fresh") == 1
+    assert cache.get("expired", "mặc định") == "mặc định"
+    assert len(cache) == 1
+
+
+def test_lru_eviction_keeps_recently_read_keys():
+    cache = app.TTLCache("test_lru", max_size=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_hit_and_miss_are_counted():
+    cache = app.TTLCache("test_metrics", max_size=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("missing")
+
+    counters = app.runtime_metrics.snapshot()["counters"]
+    assert counters["cache.test_metrics.hit"] == 1
+    assert counters["cache.test_metrics.miss"] == 1
+
+
+def test_persisted_entries_survive_restart(tmp_path):
+    persist_file = str(tmp_path / "cache.json")
+    cache = app.TTLCache("test_persist", max_size=2, ttl_seconds=60, persist_file=persist_file)
+    cache.set("a", {"intent": "weather"})
+    cache.set("b", {"intent": "search"})
+    cache.set("c", {"intent": None})   # đẩy "a" ra
+    cache.set("gone", 1, ttl_seconds=-1)
+
+    reloaded = app.TTLCache("test_persist", max_size=2, ttl_seconds=60, persist_file=persist_file)
+    assert reloaded.get("a") is None
+    assert reloaded.get("gone") is None
+    assert reloaded.get("c") == {"intent": None}
+
+
+def test_persist_appends_only_changed_keys(tmp_path):
+    persist_file = str(tmp_path / "cache.json")
+    cache = app.TTLCache("test_persist_log", max_size=10, ttl_seconds=60, persist_file=persist_file)
+    for i in range(5):
+        cache.set(f"k{i}", i)
+    cache.delete("k0")
+
+    entries = read_log_entries(persist_file)
+    assert [(entry["op"], entry["key"]) for entry in entries] == [
+        ("set", "k0"), ("set", "k1"), ("set", "k2"), ("set", "k3"), ("set", "k4"), ("del", "k0")
+    ]
+    assert entries[-2]["value"]["v"] == 4
+
+
+def test_detect_query_intent_caches_and_returns_copies(monkeypatch):
+    calls = []
+
+    async def fake_completion(api_key, **kwargs):
+        calls.append(kwargs["messages"][-1]["content"])
+        message = SimpleNamespace(content=json.dumps({"need_search": True, "search_query": "giá vàng"}))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(app, "create_chat_completion", fake_completion)
+    first = asyncio.run(app.detect_query_intent("Giá vàng  hôm nay test-cache", "sk-test"))
+    first["need_search"] = False
+    second = asyncio.run(app.detect_query_intent("giá vàng hôm nay test-cache", "sk-test"))
+
+    assert len(calls) == 1
+    assert second["need_search"] is True and second["search_query"] == "giá vàng"
@@ -0,0 +1,47 @@
+"""Test TTSService: audio ghi xuống đĩa trước khi trả audio_id, đọc lại từ đĩa trong thread (không chặn event loop)."""
+import asyncio
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+@pytest.fixture
+def tts(tmp_path, monkeypatch):
+    service = app.TTSService(audio_dir=str(tmp_path / "audio"), max_workers=1)
+    monkeypatch.setattr(app, "synthesize_speech_mp3", lambda text, lang, slow: f"mp3:{text}".encode("utf-8"))
+    monkeypatch.setattr(app, "tts_service", service)
+    return service
+
+
+def test_audio_survives_restart_and_is_read_off_the_loop(tts, monkeypatch):
+    audio_id = asyncio.run(tts.synthesize("xin chào"))
+    # Instance mới (khởi động lại/worker khác) chỉ có dữ liệu trên đĩa
+    restarted = app.TTSService(audio_dir=tts.audio_dir, max_workers=1)
+    read_threads = []
+    read_disk = restarted._read_disk
+
+    def tracking_read_disk(audio_id):
+        read_threads.append(threading.current_thread())
+        return read_disk(audio_id)
+
+    monkeypatch.setattr(restarted, "_read_disk", tracking_read_disk)
+
+    assert asyncio.run(restarted.get_audio(audio_id)) == "mp3:xin chào".encode("utf-8")
+    assert read_threads and read_threads[0] is not threading.main_thread()
+    # Lần sau lấy từ bộ nhớ, không đọc đĩa nữa
+    assert asyncio.run(restarted.get_audio(audio_id)) is not None
+    assert len(read_threads) == 1
+
+
+def test_audio_endpoint_serves_disk_tier_and_rejects_bad_ids(tts):
+    audio_id = asyncio.run(tts.synthesize("tạm biệt"))
+    tts._memory.clear()
+    client = TestClient(app.app)
+
+    response = client.get(f"/audio/{audio_id}")
+    assert response.status_code == 200
+    assert response.content == "mp3:tạm biệt".encode("utf-8")
+    assert client.get("/audio/..%2Fsecret").status_code == 404
@@ -0,0 +1,109 @@
+"""Test upload: middleware 413 theo Content-Length, check_upload_size, ảnh đọc thẳng từ file spool và dọn TEMP_DIR."""
+import asyncio
+import os
+import tempfile
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from fastapi.testclient import TestClient
+
+import app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setitem(app.UPLOAD_SIZE_LIMITS, "/analyze_image", 1024)
+    return TestClient(app.app)
+
+
+def test_oversized_upload_is_rejected_before_body_is_read(client):
+    body = b"0" * (1024 + app.UPLOAD_FORM_OVERHEAD_BYTES + 1)
+    response = client.post("/analyze_image", content=body,
+                           headers={"content-type": "multipart/form-data; boundary=x"})
+
+    assert response.status_code == 413
+
+
+def test_upload_within_limit_reaches_endpoint(client):
+    response = client.post("/analyze_image", files={"file": ("note.txt", b"nho", "text/plain")},
+                           data={"openai_api_key": "sk-test"})
+
+    # Qua middleware; endpoint từ chối vì không phải ảnh
+    assert response.status_code == 400
+
+
+def make_upload(size):
+    spooled = tempfile.SpooledTemporaryFile(max_size=16)
+    spooled.write(b"a" * size)
+    spooled.seek(0)
+    return UploadFile(file=spooled, filename="audio.wav")
+
+
+def test_check_upload_size_uses_spooled_size():
+    upload = make_upload(100)
+    assert app.check_upload_size(upload, 100) == 100
+    assert upload.file.tell() == 0
+
+    with pytest.raises(HTTPException) as error:
+        app.check_upload_size(make_upload(101), 100)
+    assert error.value.status_code == 413
+
+
+def test_cleanup_temp_dir_removes_only_old_leftovers(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "TEMP_DIR", str(tmp_path))
+    old_file, new_file, old_dir = tmp_path / "old.wav", tmp_path / "new.wav", tmp_path / "old_dir"
+    old_file.write_bytes(b"1")
+    new_file.write_bytes(b"2")
+    old_dir.mkdir()
+    (old_dir / "part").write_bytes(b"3")
+    two_hours_ago = time.time() - 7200
+    for path in (old_file, old_dir):
+        os.utime(path, (two_hours_ago, two_hours_ago))
+
+    assert app.cleanup_temp_dir(max_age=3600) == 2
+    assert sorted(os.listdir(tmp_path)) == ["new.wav"]
+
+
+def test_analyze_image_passes_spooled_file_to_preprocessor(monkeypatch):
+    received = []
+
+    async def fake_to_data_url(data):
+        received.append(data.read() if hasattr(data, "read") else None)
+        return "data:image/jpeg;base64,AAAA"
+
+    async def fake_completion(api_key, **kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Một bức ảnh."))])
+
+    async def fake_tts(text, by_reference):
+        return None, None
+
+    monkeypatch.setattr(app.image_preprocessor, "to_data_url", fake_to_data_url)
+    monkeypatch.setattr(app, "create_chat_completion", fake_completion)
+    monkeypatch.setattr(app.tts_service, "respond", fake_tts)
+
+    response = TestClient(app.app).post("/analyze_image", files={"file": ("a.jpg", b"jpeg-bytes", "image/jpeg")},
+                                        data={"openai_api_key": "sk-test"})
+
+    assert response.status_code == 200
+    assert response.json()["analysis"] == "Một bức ảnh."
+    # Nhận file đã spool (đọc được), không phải bytes đã buffer sẵn
+    assert received == [b"jpeg-bytes"]
+
+
+def test_image_preprocessor_decodes_spooled_file_in_thread_mode():
+    from PIL import Image
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024)
+    Image.new("RGB", (3000, 1500), (20, 120, 200)).save(spooled, "PNG")
+    spooled.seek(0)
+    preprocessor = app.ImagePreprocessor(max_workers=0, max_dimension=1000, max_short_side=768)
+
+    processed, mime_type = asyncio.run(preprocessor.process(spooled))
+
+    assert mime_type == "image/jpeg"
+    with Image.open(BytesIO(processed)) as img:
+        assert img.size == (1000, 500)
+    assert not spooled.closed